@@ -1,2 +1,9 @@
-from .GLOBAL_charge_exchange import GLOBAL
 from .default import default_scatter, test_strip_ions
+
+
+def __getattr__(name):
+    # GLOBAL (and with it scipy) is only imported when it is used
+    if name == "GLOBAL":
+        from .GLOBAL_charge_exchange import GLOBAL
+        return GLOBAL
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
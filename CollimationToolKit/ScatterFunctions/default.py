@@ -1,3 +1,6 @@
+import numpy as np
+
+
 def default_scatter(self, particle, idx=[]):
         # default behaviour: black hole
         if not hasattr(particle.state, "__iter__"):
@@ -19,6 +22,8 @@ def test_strip_ions(self, particle, idx=[]):
     if not hasattr(particle.state, "__iter__"):
         particle.qratio = (particle.Z-1) / particle.q0
     else:
-        particle[idx].qratio = np.divide(particle.Z[idx]-1, particle.q0[idx])
-        tmp_qratio = particle.qratio    # this is needed to...
-        particle.qratio = tmp_qratio    # ... trigger the qratio setter
+        n_part = len(particle.state)
+        qratio = np.array(np.broadcast_to(particle.qratio, n_part), dtype=float)
+        qratio[idx] = np.divide(np.broadcast_to(particle.Z, n_part)[idx] - 1,
+                                np.broadcast_to(particle.q0, n_part)[idx])
+        particle.qratio = qratio    # the setter updates chi
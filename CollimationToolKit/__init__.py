@@ -1,11 +1,43 @@
-import pysixtrack
-from . import elements
-from . import ScatterFunctions
-from .loader_mad import iter_from_madx_sequence_ctk
+import importlib
 
 
-# monkey patching iter_from_madx_sequence() to include LimitPolygon loader
-pysixtrack.loader_mad.iter_from_madx_sequence_old = pysixtrack.loader_mad.iter_from_madx_sequence
-pysixtrack.line.iter_from_madx_sequence_old = pysixtrack.line.iter_from_madx_sequence
-pysixtrack.loader_mad.iter_from_madx_sequence = iter_from_madx_sequence_ctk
-pysixtrack.line.iter_from_madx_sequence = iter_from_madx_sequence_ctk
+# submodules are only imported when first used, so that e.g. worker processes
+# which only need the aperture files do not pay for pysixtrack or GLOBAL
+_submodules = [
+    "elements",
+    "ScatterFunctions",
+    "loader_mad",
+    "aperture_files",
+    "polygon",
+    "line_cache",
+    "tracking",
+    "losses",
+    "checkpoint",
+    "margins",
+]
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module("." + name, __name__)
+    if name == "iter_from_madx_sequence_ctk":
+        from .loader_mad import iter_from_madx_sequence_ctk
+        return iter_from_madx_sequence_ctk
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + _submodules + ["iter_from_madx_sequence_ctk"])
+
+
+def patch_pysixtrack_loader():
+    # monkey patching iter_from_madx_sequence() to include LimitPolygon loader,
+    # e.g. for pysixtrack.Line.from_madx_sequence(); calling it again has
+    # no further effect
+    import pysixtrack
+    from .loader_mad import iter_from_madx_sequence_ctk
+
+    for module in [pysixtrack.loader_mad, pysixtrack.line]:
+        if module.iter_from_madx_sequence is not iter_from_madx_sequence_ctk:
+            module.iter_from_madx_sequence_old = module.iter_from_madx_sequence
+            module.iter_from_madx_sequence = iter_from_madx_sequence_ctk
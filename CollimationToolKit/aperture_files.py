@@ -0,0 +1,244 @@
+'''
+This module reads polygon aperture profiles from files.
+
+Supported are
+ - text files with one whitespace separated vertex "x y" per line, the rings
+   of apertures with several rings (see polygon.py) are separated by a line
+   "nan nan",
+ - .npy files with an array of shape (2, n_vertices),
+ - .npz files with a single array or an array named "aperture",
+ - profile libraries (extension .aplib), i.e. many named polygons packed
+   into one file, which are referred to as "<library file>::<profile name>".
+   As MAD-X only accepts existing files as apertype, the MAD-X loader looks
+   up profiles of an apertype="<library file>" by the element name and the
+   names of its parent classes.
+
+A profile library is a valid .npy file holding the coordinates of all
+profiles as one (2, n_total) array, followed by a second .npy record with
+the index of the profiles (name, first and last vertex). It is opened with
+np.load(mmap_mode='r'), so loading a profile does not copy the coordinates.
+Use write_profile_library() or convert_aperture_file() to create binary
+files from the text format.
+
+Parsed profiles are kept in a module-level cache, so every file is parsed
+only once, no matter how many elements of a sequence refer to it. The cache
+is keyed on the path, the modification time and the size of the file; a file
+that changed on disk is parsed again.
+'''
+
+import os
+import io
+import csv
+import concurrent.futures
+import numpy as np
+from CollimationToolKit.polygon import PolygonGeometry, as_readonly_vertices
+
+
+library_separator = '::'
+library_extension = '.aplib'
+# the name field is widened when writing libraries with longer names
+library_index_dtype = [('name', 'U64'), ('start', 'i8'), ('stop', 'i8')]
+
+# path -> (mtime, size, PolygonGeometry)
+_aperture_file_cache = {}
+# path -> (mtime, size, coordinates, {name: (start, stop)}, {name: geometry})
+_profile_library_cache = {}
+
+
+def split_library_reference(apertype):
+    # "lib.aplib::name" -> ("lib.aplib", "name"), "file.aper" -> ("file.aper", None)
+    if library_separator in apertype:
+        filename, name = apertype.rsplit(library_separator, 1)
+        return filename, name
+    return apertype, None
+
+
+def is_aperture_file(apertype):
+    filename, name = split_library_reference(apertype)
+    return os.path.isfile(filename)
+
+
+def is_profile_library(filename):
+    return filename.lower().endswith(library_extension)
+
+
+def library_profile_names(filename):
+    return _get_profile_library(filename)[3].keys()
+
+
+def read_text_aperture_file(filename):
+    # whitespace separated text file, one vertex "x y" per line
+    with open(filename,'r') as aper_file:
+        input_file_str = ''
+        for line in aper_file:
+            if line.strip(): # ignore empty lines
+                input_file_str += line.replace('\t',' ')
+                # csv delimiter must be ' '
+    with io.StringIO(input_file_str) as file_from_str:
+        aper_reader = csv.reader(file_from_str, delimiter=' ',
+                                 skipinitialspace=True,
+                                 quoting=csv.QUOTE_NONNUMERIC)
+        #reader -> list and non-numpy transposing
+        aper_coords = list(map(list, zip(*aper_reader)))
+    return aper_coords
+
+
+def read_aperture_file(filename):
+    # returns the vertices of the profile as (2, n_vertices) array or lists
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npy':
+        return np.load(filename, mmap_mode='r', allow_pickle=False)
+    elif extension == '.npz':
+        with np.load(filename, allow_pickle=False) as npz_file:
+            if 'aperture' in npz_file.files:
+                return npz_file['aperture']
+            elif len(npz_file.files) == 1:
+                return npz_file[npz_file.files[0]]
+            raise ValueError(f"{filename} must contain a single array "
+                             "or an array named 'aperture'")
+    else:
+        return read_text_aperture_file(filename)
+
+
+def load_aperture_geometry(apertype):
+    # returns the shared, immutable geometry of the profile in a file or
+    # of a named profile in a library ("<library>::<name>")
+    filename, name = split_library_reference(apertype)
+    if name is not None:
+        return _load_library_geometry(filename, name)
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    cached = _aperture_file_cache.get(path)
+    if (cached is not None
+            and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size):
+        return cached[2]
+    return _store_aperture_file(path, stat, read_aperture_file(path))
+
+
+def _store_aperture_file(path, stat, aperture):
+    geometry = PolygonGeometry(as_readonly_vertices(aperture))
+    _aperture_file_cache[path] = (stat.st_mtime_ns, stat.st_size, geometry)
+    return geometry
+
+
+def _read_aperture_file_with_stat(path):
+    # runs in the worker processes of load_aperture_geometries(), the stat
+    # is taken before reading, so a file changed meanwhile is read again
+    stat = os.stat(path)
+    return stat, np.asarray(read_aperture_file(path), dtype=float)
+
+
+def load_aperture_geometries(apertypes, max_workers=None, executor="thread"):
+    # loads many profiles concurrently in a "thread" or "process" pool,
+    # returns {apertype: geometry}. The geometries end up in the same cache
+    # as the ones from load_aperture_geometry().
+    geometries = {}
+    files = []
+    for apertype in set(apertypes):
+        filename, name = split_library_reference(apertype)
+        if name is not None:
+            # library profiles are memory-mapped, nothing to parse
+            geometries[apertype] = _load_library_geometry(filename, name)
+        else:
+            files.append(apertype)
+
+    if executor == "thread":
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            for apertype, geometry in zip(files,
+                                          pool.map(load_aperture_geometry, files)):
+                geometries[apertype] = geometry
+    elif executor == "process":
+        paths = [os.path.abspath(filename) for filename in files]
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+            for apertype, path, (stat, aperture) in zip(
+                    files, paths, pool.map(_read_aperture_file_with_stat, paths)):
+                geometries[apertype] = _store_aperture_file(path, stat, aperture)
+    else:
+        raise ValueError('executor must be "thread" or "process"')
+    return geometries
+
+
+def clear_aperture_file_cache():
+    _aperture_file_cache.clear()
+    _profile_library_cache.clear()
+
+
+#-------------------------------------------------------------------------------
+#------- Profile libraries --------------------------------------------------
+#-------------------------------------------------------------------------------
+
+def _read_npy_header(npy_file):
+    version = np.lib.format.read_magic(npy_file)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(npy_file)
+    return np.lib.format.read_array_header_2_0(npy_file)
+
+
+def read_profile_library_index(filename):
+    # the index is stored as second .npy record behind the coordinates
+    with open(filename, 'rb') as library_file:
+        shape, fortran_order, dtype = _read_npy_header(library_file)
+        library_file.seek(library_file.tell()
+                          + int(np.prod(shape)) * dtype.itemsize)
+        index = np.lib.format.read_array(library_file, allow_pickle=False)
+    return {str(name): (int(start), int(stop))
+            for name, start, stop in index}
+
+
+def _get_profile_library(filename):
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    cached = _profile_library_cache.get(path)
+    if (cached is None
+            or cached[0] != stat.st_mtime_ns or cached[1] != stat.st_size):
+        coords = np.load(path, mmap_mode='r', allow_pickle=False)
+        index = read_profile_library_index(path)
+        cached = (stat.st_mtime_ns, stat.st_size, coords, index, {})
+        _profile_library_cache[path] = cached
+    return cached
+
+
+def _load_library_geometry(filename, name):
+    mtime, size, coords, index, geometries = _get_profile_library(filename)
+    if name not in geometries:
+        if name not in index:
+            raise KeyError(f'Profile "{name}" not found in library {filename}')
+        start, stop = index[name]
+        geometries[name] = PolygonGeometry(
+            as_readonly_vertices(coords[:, start:stop]))
+    return geometries[name]
+
+
+def write_profile_library(profiles, filename):
+    # profiles: dict {name: aperture or aperture file}
+    names = list(profiles.keys())
+    apertures = []
+    for name in names:
+        aperture = profiles[name]
+        if isinstance(aperture, str):
+            aperture = read_aperture_file(aperture)
+        apertures.append(as_readonly_vertices(aperture))
+    stops = np.cumsum([aperture.shape[1] for aperture in apertures])
+    name_length = max([64] + [len(name) for name in names])
+    index = np.zeros(len(names), dtype=[('name', 'U%d' % name_length)]
+                                      + library_index_dtype[1:])
+    index['name'] = names
+    index['start'] = stops - [aperture.shape[1] for aperture in apertures]
+    index['stop'] = stops
+    if len(apertures) > 0:
+        coords = np.concatenate(apertures, axis=1)
+    else:
+        coords = np.zeros((2, 0))
+    with open(filename, 'wb') as library_file:
+        np.lib.format.write_array(library_file, np.ascontiguousarray(coords))
+        np.lib.format.write_array(library_file, index)
+
+
+def convert_aperture_file(filename, outfile):
+    # converts a text aperture file to .npy or .npz (chosen by extension)
+    vertices = np.array(read_text_aperture_file(filename), dtype=float)
+    if outfile.lower().endswith('.npz'):
+        np.savez(outfile, aperture=vertices)
+    else:
+        with open(outfile, 'wb') as npy_file:
+            np.lib.format.write_array(npy_file, vertices)
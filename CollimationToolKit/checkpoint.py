@@ -0,0 +1,110 @@
+'''
+This module saves and restores the state of long tracking runs, so that a
+preempted run can be resumed where it was instead of from turn zero.
+
+A checkpoint is a single .npz file with
+ - all attributes of the particles (per-particle arrays and reference
+   quantities, including custom arrays like Z and A),
+ - the turn at which tracking continues,
+ - the state of the numpy random generator used by the scatter functions
+   (e.g. GLOBAL draws the new charge states from it),
+ - the position of a LossWriter, whose file and histogram are cut back to
+   this position on restart.
+It is written to a temporary file which then replaces the previous
+checkpoint, so a crash while writing leaves the previous one intact.
+
+Checkpoints are taken between turns; track_with_checkpoints() takes care of
+it and resumes from an existing checkpoint automatically. A resumed run
+gives exactly the same particles and loss records as an uninterrupted one.
+'''
+
+import os
+import numpy as np
+import pysixtrack
+
+
+checkpoint_format = 1
+
+# attributes of the particles which are not saved
+_skipped_attributes = ["_m", "lost_particles"]
+
+
+def save_checkpoint(filename, particles, turn, loss_writer=None):
+    # turn: the next turn to be tracked
+    arrays = {"format": np.array(checkpoint_format), "turn": np.array(turn)}
+    for key, value in particles.__dict__.items():
+        if key in _skipped_attributes:
+            continue
+        value = np.asarray(value)
+        if value.dtype == object:
+            raise ValueError(f"Particle attribute {key} cannot be saved")
+        arrays["particles/" + key] = value
+
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    arrays["random/keys"] = keys
+    arrays["random/state"] = np.array([pos, has_gauss])
+    arrays["random/cached_gaussian"] = np.array(cached_gaussian)
+
+    if loss_writer is not None:
+        for key, value in loss_writer.get_checkpoint().items():
+            arrays["losses/" + key] = np.asarray(value)
+
+    tmp_filename = filename + ".tmp%d" % os.getpid()
+    with open(tmp_filename, 'wb') as checkpoint_file:
+        np.savez(checkpoint_file, **arrays)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def load_checkpoint(filename, loss_writer=None, restore_random_state=True):
+    # returns (particles, turn). The loss writer (opened with append=True)
+    # is cut back to the checkpoint.
+    with np.load(filename, allow_pickle=False) as checkpoint:
+        if int(checkpoint["format"]) != checkpoint_format:
+            raise ValueError(f"{filename} has an unknown checkpoint format")
+        particles = pysixtrack.Particles()
+        for key in checkpoint.files:
+            if key.startswith("particles/"):
+                value = checkpoint[key]
+                particles.__dict__[key[len("particles/"):]] = (
+                    value.item() if value.ndim == 0 else value)
+        particles.lost_particles = []
+        turn = int(checkpoint["turn"])
+
+        if restore_random_state:
+            pos, has_gauss = checkpoint["random/state"]
+            np.random.set_state(("MT19937", checkpoint["random/keys"], int(pos),
+                                 int(has_gauss),
+                                 float(checkpoint["random/cached_gaussian"])))
+
+        if loss_writer is not None:
+            if "losses/position" not in checkpoint.files:
+                raise ValueError(f"{filename} has no loss writer state")
+            loss_writer.restore_checkpoint(
+                {key: checkpoint["losses/" + key]
+                 for key in ["position", "n_written", "counts"]})
+    return particles, turn
+
+
+def track_with_checkpoints(line, particles, n_turns, filename,
+                           checkpoint_every=100, loss_writer=None):
+    # tracks particles through line for n_turns turns and saves a checkpoint
+    # to filename every checkpoint_every turns and at the end. If filename
+    # exists, the run is resumed from it and particles is ignored; a loss
+    # writer must then be opened with append=True. Returns the surviving
+    # particles.
+    if os.path.isfile(filename):
+        particles, first_turn = load_checkpoint(filename, loss_writer)
+    else:
+        first_turn = 0
+
+    for turn in range(first_turn, n_turns):
+        if turn > first_turn and turn % checkpoint_every == 0:
+            save_checkpoint(filename, particles, turn, loss_writer)
+        particles.turn = turn
+        if line.track(particles) is not None:
+            # all particles lost
+            break
+    save_checkpoint(filename, particles, max(first_turn, n_turns), loss_writer)
+    return particles
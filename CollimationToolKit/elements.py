@@ -1,18 +1,68 @@
 from pysixtrack.elements import Element
-from operator import sub, mul
+from pysixtrack import elements as pysixtrack_elements
 from CollimationToolKit.ScatterFunctions import default_scatter, test_strip_ions
+from CollimationToolKit.polygon import PolygonGeometry, np_is_right_of, map_is_right_of
+from CollimationToolKit.polygon import match_native_shape, simplify_polygon
+from CollimationToolKit.polygon import as_readonly_vertices, polygon_contains
+from CollimationToolKit.polygon import inside_from_crossings, fill_rules
+from CollimationToolKit.aperture_files import load_aperture_geometry
 import numpy as np
 import types
 
 
 
+def _track_and_record_losses(element, track, particle):
+    # hands the particles lost in element to its loss writer, if any
+    if element.loss_writer is None:
+        return track(particle)
+    vectorized = hasattr(particle.state, "__iter__")
+    n_lost_before = len(particle.lost_particles) if vectorized else 0
+    ret = track(particle)
+    if vectorized:
+        for lost in particle.lost_particles[n_lost_before:]:
+            element.loss_writer.push_particles(element.loss_element_index, lost)
+        # the records are on disk, keeping the particles would let the
+        # memory grow with the number of losses again
+        del particle.lost_particles[n_lost_before:]
+    elif particle.state != 1:
+        element.loss_writer.push_particles(element.loss_element_index, particle)
+    return ret
+
+
+def _state_without_loss_writer(element):
+    # the loss writer (an open file) stays with the element it was attached
+    # to, copies and pickled elements do not write into it
+    state = element.__dict__.copy()
+    state.pop("loss_writer", None)
+    state.pop("loss_element_index", None)
+    return state
+
+
+def _get_cached_geometry(element):
+    # the precomputed geometry of element.aperture is cached on the element.
+    # It keeps a read-only copy of the vertices and is rebuilt if the
+    # aperture was replaced or changed in place; element.aperture itself
+    # stays as it was set (e.g. a list, for to_dict()).
+    geometry = getattr(element, "_geometry", None)
+    aperture = element.aperture
+    if geometry is not None and (
+            aperture is geometry.aperture
+            or np.array_equal(geometry.aperture, np.asarray(aperture, dtype=float),
+                              equal_nan=True)):
+        return geometry
+    geometry = PolygonGeometry(as_readonly_vertices(aperture))
+    element._geometry = geometry
+    return geometry
+
+
 #-------------------------------------------------------------------------------
 #------- Polygonal aperture class -------------------------------------------
 #-------------------------------------------------------------------------------
 
 class LimitPolygon(Element):
     # the input coords must be ordered, i.e the lines connecting 
-    # neighbours must be the sides of the polygon
+    # neighbours must be the sides of the polygon. Several rings (e.g.
+    # holes) are separated by a column of NaN, see polygon.py
     #
     # convention: aperture[0] = x-coords, aperture[1] = y-coords
     _description = [
@@ -21,82 +71,100 @@ class LimitPolygon(Element):
             "m",
             "Array with coords of polygon vertices",
             lambda: [[-1.0,1.0,1.0,-1.0], [1.0,1.0,-1.0,-1.0]]
-        )
+        ),
+        (
+            "low_precision",
+            "",
+            "Classify vectors in float32, rechecking uncertain cases in float64",
+            False
+        ),
+        (
+            "fill_rule",
+            "",
+            "Inside of several rings: evenodd or nonzero (winding number)",
+            "evenodd"
+        ),
     ]
+
+    def __post_init__(self):
+        if self.fill_rule not in fill_rules:
+            raise ValueError(f"fill_rule must be one of {fill_rules}")
       
-    @staticmethod
-    def np_is_right_of(line_start, line_end, point):
-        # decides if point is right of line going through line_start and 
-        # line_end by checking the 3rd dimension direction of the cross 
-        # product of the involved vectors
-        def __crossproduct_z__(vector1, vector2):
-            return np.multiply(vector1[0],vector2[1]) - np.multiply(vector1[1],vector2[0])
-        
-        return __crossproduct_z__(line_end-line_start, point-line_start) > 0.0
-    
-    @staticmethod
-    def map_is_right_of(line_start, line_end, point):
-        # pedestrian implementation of np_is_right_of()
-        def __crossproduct_z__(vector1, vector2):
-            z_coord = list(map(sub, list(map(mul,vector1[0],vector2[1])),
-                                    list(map(mul,vector1[1],vector2[0]))
-                          ))
-            return z_coord
-        
-        def _get_to_length(vec, num):
-            for dim in [0,1]:
-                value = vec[dim][0]
-                vec[dim] = [value for i in range(num)]
-            return vec
-        
-        #make input mappable against each other
-        max_len = max(len(line_start[0]), len(line_end[0]), len(point[0]))
-        if len(line_start[0]) == 1:
-            line_start = _get_to_length(line_start, max_len)
-        if len(line_end[0]) == 1:
-            line_end = _get_to_length(line_end, max_len)
-        if len(point[0]) == 1:
-            point = _get_to_length(point, max_len)
-        
-        vec_line = [list(map(sub,le,ls)) for le,ls in zip(line_end, line_start)]
-        vec_line_to_point = [list(map(sub,pt,ls)) for pt,ls in zip(point, line_start)]
-        z_coord = __crossproduct_z__(vec_line, vec_line_to_point)
-        return [z > 0.0 for z in z_coord]
+    np_is_right_of = staticmethod(np_is_right_of)
+
+    map_is_right_of = staticmethod(map_is_right_of)
+
+    # set by losses.attach_loss_writer()
+    loss_writer = None
+    loss_element_index = None
+
+    def __getstate__(self):
+        return _state_without_loss_writer(self)
 
+    @classmethod
+    def from_geometry(cls, geometry):
+        # elements created this way share the (immutable) geometry
+        newpolygon = cls(aperture=geometry.aperture)
+        newpolygon._geometry = geometry
+        return newpolygon
 
+    @classmethod
+    def from_file(cls, filename):
+        # text, .npy or .npz file, or "<library file>::<profile name>"
+        return cls.from_geometry(load_aperture_geometry(filename))
+
+    def get_geometry(self):
+        return _get_cached_geometry(self)
+
+    def to_native(self, tolerance=1e-6):
+        # returns an equivalent LimitRect, LimitEllipse or LimitRectEllipse
+        # if the polygon is one of these shapes within tolerance, else None
+        shape = match_native_shape(self.get_geometry().aperture, tolerance)
+        if shape is None:
+            return None
+        class_name, params = shape
+        return getattr(pysixtrack_elements, class_name)(**params)
+
+    def simplify(self, max_deviation):
+        # returns a new LimitPolygon with fewer vertices, which lies inside
+        # this one and deviates from it by at most max_deviation
+        vertices = simplify_polygon(self.get_geometry().aperture, max_deviation)
+        simplified = self.from_geometry(PolygonGeometry(as_readonly_vertices(vertices)))
+        simplified.low_precision = self.low_precision
+        simplified.fill_rule = self.fill_rule
+        return simplified
 
     def track(self, particle):
+        return _track_and_record_losses(self, self._track, particle)
+
+    def _track(self, particle):
+        geometry = self.get_geometry()
+        if self.low_precision and hasattr(particle.state, "__iter__"):
+            return self._track_low_precision(geometry, particle)
         if not hasattr(particle.state, "__iter__"):
-            if isinstance(self.aperture, np.ndarray):
-                self.aperture = self.aperture.tolist()
             func_array = lambda x: x
-            func_expand_dims = lambda x, axis: x
-            func_roll = lambda array,shift, axis:   [array[0][-1*shift:] + array[0][:-1*shift],\
-                                                    array[1][-1*shift:] + array[1][:-1*shift]]
             func_is_right_of = self.map_is_right_of
             func_output = lambda odd_or_even,tmp1,tmp2: int(odd_or_even)
             func_shape = lambda x: len(x)
+            aper_1 = geometry.vertex_list
+            aper_2 = geometry.vertex_list_rolled
+            refpoint = [list(geometry.refpoint_list[0]),
+                        list(geometry.refpoint_list[1])]
+            refpoint_is_right = geometry.refpoint_is_right_list
         else:
             func_array = np.array
-            func_expand_dims = np.expand_dims
-            func_roll = np.roll
-            
             func_is_right_of = self.np_is_right_of
             func_output = np.where
             func_shape = lambda x: x.shape
-            
-        
-        
-        aper_1 = func_expand_dims(self.aperture, axis=2)
-        aper_2 = func_roll(aper_1, 1, axis=1)
-        # prepare reference point outside aperture
-        refpoint = func_array([[1.1*abs(max(aper_1[0]))], [1.1*abs(max(aper_1[1]))]] )
-        
+            aper_1 = geometry.aper_1
+            aper_2 = geometry.aper_2
+            refpoint = geometry.refpoint
+            refpoint_is_right = geometry.refpoint_is_right
+
         coords = func_array([[particle.x], [particle.y]])
         
 
         particle_is_right = func_is_right_of(aper_1, aper_2, coords)
-        refpoint_is_right = func_is_right_of(aper_1, aper_2, refpoint)
         
         aper_1_is_right = func_is_right_of(coords, refpoint, aper_1)
         aper_2_is_right = func_is_right_of(coords, refpoint, aper_2)
@@ -109,11 +177,13 @@ class LimitPolygon(Element):
                                     np.ones(func_shape(aper_1[0]), dtype=int),
                                     np.zeros(func_shape(aper_1[0]), dtype=int)
                                   ) # todo: make sure that end points are included
-        num_intersects = np.sum(lines_intersect, axis=0)
-        # if num_intersect is odd -> particle is inside aperture
-        particle.state = func_output(num_intersects % 2 == 1,
-                                     np.ones(num_intersects.shape, dtype=int),
-                                     np.zeros(num_intersects.shape, dtype=int)
+        # evenodd: if the number of intersections is odd -> particle is
+        # inside aperture
+        inside = inside_from_crossings(lines_intersect, aper_1_is_right,
+                                       self.fill_rule)
+        particle.state = func_output(inside,
+                                     np.ones(inside.shape, dtype=int),
+                                     np.zeros(inside.shape, dtype=int)
                                     )
         if not hasattr(particle.state, "__iter__"):
             if particle.state != 1:
@@ -123,6 +193,185 @@ class LimitPolygon(Element):
             if len(particle.state) == 0:
                 return "All particles lost"
 
+    def scan(self, particle, dx=0.0, dy=0.0, tilt=0.0, scale=1.0):
+        # classifies the particles against K settings of the aperture in one
+        # pass and returns the (K, n_particles) loss mask (True: lost), the
+        # particles are not changed. The settings (scalars or arrays of
+        # length K) scale the aperture, rotate it counter-clockwise by tilt
+        # and shift it by (dx, dy), in this order; the cached geometry is
+        # used for all of them.
+        dx, dy, tilt, scale = [np.asarray(setting, dtype=float)[:, None]
+                               for setting in np.broadcast_arrays(
+                                   np.atleast_1d(dx), np.atleast_1d(dy),
+                                   np.atleast_1d(tilt), np.atleast_1d(scale))]
+        x = np.atleast_1d(particle.x).astype(float)[None, :] - dx
+        y = np.atleast_1d(particle.y).astype(float)[None, :] - dy
+        # particle coordinates in the frame of the unchanged aperture
+        cos_tilt = np.cos(tilt)
+        sin_tilt = np.sin(tilt)
+        x_aperture = (cos_tilt*x + sin_tilt*y)/scale
+        y_aperture = (cos_tilt*y - sin_tilt*x)/scale
+        inside = self._contains(self.get_geometry(), x_aperture.ravel(),
+                                y_aperture.ravel())
+        return ~inside.reshape(x_aperture.shape)
+
+    def signed_distance(self, x, y):
+        # distance of the points x, y to the boundary of the aperture,
+        # positive inside, e.g. for the aperture margin of particles
+        geometry = self.get_geometry()
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        distance = geometry.distance_to_boundary(x, y)
+        return np.where(self._contains(geometry, x, y), distance, -distance)
+
+    def _contains(self, geometry, x, y):
+        if not self.low_precision:
+            return geometry.contains(x, y, self.fill_rule)
+        inside, uncertain = geometry.contains_float32(x, y,
+                                                      fill_rule=self.fill_rule)
+        uncertain = np.where(uncertain)[0]
+        if len(uncertain) > 0:
+            inside[uncertain] = geometry.contains(x[uncertain], y[uncertain],
+                                                  self.fill_rule)
+        return inside
+
+    def _track_low_precision(self, geometry, particle):
+        # same result as the float64 path, but with float32 coordinates and
+        # bool masks, i.e. much less memory traffic per particle
+        x = np.asarray(particle.x, dtype=float)
+        y = np.asarray(particle.y, dtype=float)
+        inside = self._contains(geometry, x, y)
+        state = particle.state
+        if (isinstance(state, np.ndarray) and state.shape == inside.shape
+                and state.flags.writeable):
+            np.copyto(state, inside, casting='unsafe')
+        else:
+            particle.state = inside.astype(int)
+        particle.remove_lost_particles()
+        if len(particle.state) == 0:
+            return "All particles lost"
+
+
+
+#-------------------------------------------------------------------------------
+#------- Thick polygonal aperture class -------------------------------------
+#-------------------------------------------------------------------------------
+
+class LimitPolygonThick(Element):
+    # a straight (drift) section of the given length, whose polygonal
+    # aperture changes linearly from entry_aperture to exit_aperture
+    # (vertex by vertex, so both need the same number of vertices and the
+    # same ring separators).
+    # The particles are checked at the entry and at the exit only; for
+    # particles lost at the exit the crossing is found by bisection and
+    # they are moved back to it, i.e. the lost particles carry the loss
+    # location (s, x, y, ...).
+    #
+    # pysixtrack.Line.get_length() and get_s_elements() only count drifts,
+    # losses.element_s_positions() also counts these elements
+    _description = [
+        (
+            "entry_aperture",
+            "m",
+            "Array with coords of polygon vertices at the entry",
+            lambda: [[-1.0,1.0,1.0,-1.0], [1.0,1.0,-1.0,-1.0]]
+        ),
+        (
+            "exit_aperture",
+            "m",
+            "Array with coords of polygon vertices at the exit (empty: as entry)",
+            lambda: []
+        ),
+        ("length", "m", "Length of the element", 0.0),
+        ("n_bisections", "1", "Number of bisection steps for the loss location", 30),
+        ("fill_rule", "", "Inside of several rings: evenodd or nonzero", "evenodd"),
+    ]
+
+    # set by losses.attach_loss_writer()
+    loss_writer = None
+    loss_element_index = None
+
+    def __getstate__(self):
+        return _state_without_loss_writer(self)
+
+    def get_profiles(self):
+        entry = np.asarray(self.entry_aperture, dtype=float)
+        if len(self.exit_aperture) == 0:
+            return entry, entry
+        exit = np.asarray(self.exit_aperture, dtype=float)
+        if exit.shape != entry.shape:
+            raise ValueError("Entry and exit aperture need the same number of vertices")
+        return entry, exit
+
+    def track(self, particle):
+        return _track_and_record_losses(self, self._track, particle)
+
+    def _track(self, particle):
+        entry, exit = self.get_profiles()
+        length = self.length
+        is_scalar = not hasattr(particle.state, "__iter__")
+        x_entry = np.atleast_1d(particle.x).astype(float)
+        y_entry = np.atleast_1d(particle.y).astype(float)
+        inside_entry = polygon_contains(entry, x_entry, y_entry,
+                                        fill_rule=self.fill_rule)
+
+        # expanded drift as pysixtrack.elements.Drift
+        rpp = particle.rpp
+        xp = particle.px * rpp
+        yp = particle.py * rpp
+        particle.x += xp * length
+        particle.y += yp * length
+        particle.zeta += length * (particle.rvv - (1 + (xp ** 2 + yp ** 2) / 2))
+        particle.s += length
+
+        inside_exit = polygon_contains(exit, np.atleast_1d(particle.x),
+                                       np.atleast_1d(particle.y),
+                                       fill_rule=self.fill_rule)
+        inside = inside_entry & inside_exit
+
+        # fraction of the length at which the particles leave the aperture
+        crossing = np.ones(len(inside))
+        crossing[~inside_entry] = 0.0
+        exiting = np.where(inside_entry & ~inside_exit)[0]
+        if len(exiting) > 0:
+            xp_exiting = np.broadcast_to(xp, inside.shape)[exiting] * length
+            yp_exiting = np.broadcast_to(yp, inside.shape)[exiting] * length
+            low = np.zeros(len(exiting))    # inside
+            high = np.ones(len(exiting))    # outside
+            for ii in range(self.n_bisections):
+                middle = (low + high)/2
+                profiles = (entry[:, :, None]
+                            + middle[None, None, :]*(exit - entry)[:, :, None])
+                middle_inside = polygon_contains(
+                    profiles, x_entry[exiting] + xp_exiting*middle,
+                    y_entry[exiting] + yp_exiting*middle,
+                    fill_rule=self.fill_rule)
+                low = np.where(middle_inside, middle, low)
+                high = np.where(middle_inside, high, middle)
+            crossing[exiting] = high
+
+        # lost particles are moved back to where they left the aperture,
+        # all others stay where they are
+        back = length*(1 - crossing)*~inside
+        if is_scalar:
+            back = back[0]
+        if np.any(back):
+            particle.x = particle.x - xp * back
+            particle.y = particle.y - yp * back
+            particle.zeta = particle.zeta - back * (particle.rvv
+                                                    - (1 + (xp ** 2 + yp ** 2) / 2))
+            particle.s = particle.s - back
+
+        if is_scalar:
+            particle.state = int(inside[0])
+            if particle.state != 1:
+                return "Particle lost"
+        else:
+            particle.state = inside.astype(int)
+            particle.remove_lost_particles()
+            if len(particle.state) == 0:
+                return "All particles lost"
+
 
 
 #-------------------------------------------------------------------------------
@@ -130,6 +379,11 @@ class LimitPolygon(Element):
 #-------------------------------------------------------------------------------
 
 class LimitFoil(Element):
+    # particles outside of the opening hit the foil and are handed to the
+    # scatter function. The opening is the rectangle min_x...max_y, or a
+    # polygon (aperture, as LimitPolygon) or an ellipse (a, b) if given;
+    # it is rotated counter-clockwise by tilt. With hit_inside the foil
+    # covers the opening instead.
     _description = [
         ("min_x", "m", "Minimum horizontal aperture", -1.0),
         ("max_x", "m", "Maximum horizontal aperture", 1.0),
@@ -140,6 +394,14 @@ class LimitFoil(Element):
         ("Z", "1", "proton number of foil material", 6),
         ("A", "1", "Standard atomic weight of foil material", 12.0096), #...or use the relative atomic mass instead...
         ("scatter", "<function>", "scatter function", "this should be replaced on creation"),
+        ("aperture", "m", "Polygon vertices of the opening (empty: rectangle)",
+         lambda: []),
+        ("a", "m", "Horizontal semiaxis of an elliptical opening (0: none)", 0.0),
+        ("b", "m", "Vertical semiaxis of an elliptical opening (0: none)", 0.0),
+        ("tilt", "rad", "Rotation of the opening", 0.0),
+        ("hit_inside", "", "The foil covers the opening instead", False),
+        ("fill_rule", "", "Inside of several polygon rings: evenodd or nonzero",
+         "evenodd"),
     ]
 
     def __post_init__(self):
@@ -155,14 +417,91 @@ class LimitFoil(Element):
             if not type(self.scatter) == type(lambda: None):
                 raise ValueError("scatter must be function")
             self.scatter = types.MethodType(self.scatter, self)
+        if (self.a != 0 or self.b != 0) and not (self.a > 0 and self.b > 0):
+            raise ValueError("An elliptical opening needs both semiaxes a and b > 0")
+        if len(self.aperture) > 0 and self.a > 0:
+            raise ValueError("The opening can be a polygon or an ellipse, not both")
+        if self.fill_rule not in fill_rules:
+            raise ValueError(f"fill_rule must be one of {fill_rules}")
+
+    # set by losses.attach_loss_writer()
+    loss_writer = None
+    loss_element_index = None
+
+    def get_geometry(self):
+        return _get_cached_geometry(self)
+
+    @property
+    def is_rectangular(self):
+        return (len(self.aperture) == 0 and self.a == 0 and self.b == 0
+                and self.tilt == 0 and not self.hit_inside)
+
+    def hits(self, x, y):
+        # bool array of the points x, y hitting the foil, classified once
+        # against the shape of the opening
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        if self.tilt != 0:
+            cos_tilt = np.cos(self.tilt)
+            sin_tilt = np.sin(self.tilt)
+            x, y = cos_tilt*x + sin_tilt*y, cos_tilt*y - sin_tilt*x
+        if len(self.aperture) > 0:
+            inside = self.get_geometry().contains(x, y, self.fill_rule)
+        elif self.a > 0 and self.b > 0:
+            inside = (x/self.a)**2 + (y/self.b)**2 < 1
+        else:
+            inside = ((x > self.min_x) & (x < self.max_x)
+                      & (y > self.min_y) & (y < self.max_y))
+        return inside if self.hit_inside else ~inside
+
+    def __getstate__(self):
+        # the bound scatter method refers back to the foil, only the
+        # function itself is pickled (by reference)
+        state = _state_without_loss_writer(self)
+        state["scatter"] = self.scatter.__func__
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.scatter = types.MethodType(self.scatter, self)
+
+    def scan(self, particle, min_x=None, max_x=None, min_y=None, max_y=None):
+        # returns the (K, n_particles) mask of the particles hitting the foil
+        # for K settings of its edges in one pass, e.g. a scan of the gap;
+        # the particles are not changed and scatter is not called. Settings
+        # are scalars or arrays of length K, None keeps the element's value.
+        if not self.is_rectangular:
+            raise ValueError("scan() needs a foil with a rectangular opening")
+        limits = [getattr(self, name) if value is None else value
+                  for name, value in [("min_x", min_x), ("max_x", max_x),
+                                      ("min_y", min_y), ("max_y", max_y)]]
+        min_x, max_x, min_y, max_y = [np.asarray(limit, dtype=float)[:, None]
+                                      for limit in np.broadcast_arrays(
+                                          *map(np.atleast_1d, limits))]
+        x = np.atleast_1d(particle.x)[None, :]
+        y = np.atleast_1d(particle.y)[None, :]
+        return (x <= min_x) | (x >= max_x) | (y <= min_y) | (y >= max_y)
 
     
     def track(self, particle):
+        return _track_and_record_losses(self, self._track, particle)
+
+    def _track(self, particle):
 
         x = particle.x
         y = particle.y
 
-        if not hasattr(particle.state, "__iter__"):
+        if not self.is_rectangular:
+            hits = self.hits(x, y)
+            if not hasattr(particle.state, "__iter__"):
+                if hits[0]:
+                    self.scatter(particle)
+            else:
+                hitting_particles_idx = np.where(hits)[0]
+                # only particles hitting the foil are scattered
+                if len(hitting_particles_idx) > 0:
+                    self.scatter(particle, idx = hitting_particles_idx)
+        elif not hasattr(particle.state, "__iter__"):
             if (x < self.min_x or x > self.max_x
                     or y < self.min_y or y > self.max_y):
                 self.scatter(particle)
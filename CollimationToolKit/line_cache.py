@@ -0,0 +1,288 @@
+'''
+This module saves and loads ready-to-track lines, including the elements of
+the CollimationToolKit, so that jobs do not have to rebuild the line from a
+MAD-X sequence (and thus do not need cpymad) on every start.
+
+All element parameters are stored as packed arrays in a single .npz file
+(no pickling): one array per element class and scalar field, and for list or
+array valued fields (e.g. Multipole.knl, LimitPolygon.aperture) one array with
+the concatenated values plus offsets and shapes. Values that are shared by
+several elements (e.g. the geometry of LimitPolygons loaded from the same
+aperture file) are stored only once and are shared again after loading.
+Scatter functions of LimitFoil elements are stored by reference
+("module:function") and have to be importable when the line is loaded.
+
+The file also holds a hash of the source sequence, see sequence_hash(), to
+detect if a cached line is outdated.
+'''
+
+import os
+import json
+import hashlib
+import importlib
+import types
+import numpy as np
+import pysixtrack
+from pysixtrack import elements as pysixtrack_elements
+from CollimationToolKit import elements as ctk_elements
+
+
+format_version = 1
+
+# kind of the individual values of a "packed" field
+_kind_scalar = 0
+_kind_list = 1
+_kind_array = 2
+
+
+def _default_classes():
+    classes = {}
+    for module in [pysixtrack_elements, ctk_elements]:
+        for name, value in vars(module).items():
+            if isinstance(value, type) and issubclass(value, pysixtrack_elements.Element):
+                classes[name] = value
+    return classes
+
+
+def _function_reference(function):
+    if isinstance(function, types.MethodType):
+        function = function.__func__
+    reference = function.__module__ + ':' + function.__qualname__
+    if '<' in reference:
+        raise ValueError(f"Cannot store reference to {reference}, "
+                         "scatter functions must be defined at module level")
+    return reference
+
+
+def _resolve_function_reference(reference):
+    module_name, qualname = reference.split(':')
+    function = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        function = getattr(function, name)
+    return function
+
+
+def _is_scalar(value):
+    return isinstance(value, (bool, int, float, np.bool_, np.integer, np.floating))
+
+
+def _pack_field(arrays, key, values):
+    # stores the values of one field of all elements of a class in arrays,
+    # returns the layout of the field
+    if all(callable(value) for value in values):
+        arrays[key] = np.array([_function_reference(value) for value in values])
+        return "function"
+    if all(isinstance(value, str) for value in values):
+        arrays[key] = np.array(values, dtype=str)
+        return "str"
+    if all(_is_scalar(value) for value in values):
+        arrays[key] = np.array(values)
+        return "scalar"
+
+    # everything else is packed into one array, identical objects only once
+    unique_ids = {}
+    unique_values = []
+    refs = np.zeros(len(values), dtype=np.int64)
+    for ii, value in enumerate(values):
+        if id(value) not in unique_ids:
+            unique_ids[id(value)] = len(unique_values)
+            unique_values.append(value)
+        refs[ii] = unique_ids[id(value)]
+    unique_arrays = [np.asarray(value) for value in unique_values]
+    for value, array in zip(unique_values, unique_arrays):
+        if array.dtype == object:
+            raise ValueError(f"Cannot store value {value!r} of {key}")
+    max_ndim = max(array.ndim for array in unique_arrays)
+    shapes = np.zeros((len(unique_arrays), max_ndim), dtype=np.int64)
+    for ii, array in enumerate(unique_arrays):
+        shapes[ii, :array.ndim] = array.shape
+    kinds = [_kind_array if isinstance(value, np.ndarray)
+             else _kind_scalar if _is_scalar(value)
+             else _kind_list
+             for value in unique_values]
+    arrays[key + "/data"] = np.concatenate(
+        [array.ravel() for array in unique_arrays])
+    arrays[key + "/ndim"] = np.array([array.ndim for array in unique_arrays])
+    arrays[key + "/shape"] = shapes
+    arrays[key + "/kind"] = np.array(kinds, dtype=np.int8)
+    arrays[key + "/ref"] = refs
+    return "packed"
+
+
+def _unpack_field(arrays, key, layout):
+    if layout == "function":
+        return [_resolve_function_reference(str(reference))
+                for reference in arrays[key]]
+    if layout in ["str", "scalar"]:
+        return arrays[key].tolist()
+
+    data = arrays[key + "/data"]
+    unique_values = []
+    offset = 0
+    for ndim, shape, kind in zip(arrays[key + "/ndim"], arrays[key + "/shape"],
+                                 arrays[key + "/kind"]):
+        shape = tuple(shape[:ndim])
+        size = int(np.prod(shape))
+        array = data[offset:offset + size].reshape(shape)
+        offset += size
+        if kind == _kind_array:
+            array.flags.writeable = False
+            unique_values.append(array)
+        else:
+            unique_values.append(array.tolist())
+    return [unique_values[ref] for ref in arrays[key + "/ref"]]
+
+
+def save_line(line, filename, source_hash=""):
+    arrays = {}
+    class_names = []
+    element_class = np.zeros(len(line.elements), dtype=np.int64)
+    elements_by_class = {}
+    for ii, element in enumerate(line.elements):
+        class_name = element.__class__.__name__
+        if class_name not in elements_by_class:
+            elements_by_class[class_name] = []
+            class_names.append(class_name)
+        element_class[ii] = class_names.index(class_name)
+        elements_by_class[class_name].append(element)
+
+    fields = {}
+    for class_name in class_names:
+        class_elements = elements_by_class[class_name]
+        fields[class_name] = {}
+        for field in class_elements[0].get_fields():
+            fields[class_name][field] = _pack_field(
+                arrays, class_name + "/" + field,
+                [getattr(element, field) for element in class_elements]
+            )
+
+    meta = {
+        "format_version": format_version,
+        "source_hash": source_hash,
+        "classes": class_names,
+        "fields": fields,
+    }
+    arrays["__meta__"] = np.array(json.dumps(meta))
+    arrays["element_names"] = np.array(line.element_names, dtype=str)
+    arrays["element_class"] = element_class
+
+    # write to a temporary file first, so concurrent readers never see
+    # a partially written line
+    tmp_filename = filename + ".tmp%d" % os.getpid()
+    with open(tmp_filename, 'wb') as line_file:
+        np.savez(line_file, **arrays)
+    os.replace(tmp_filename, filename)
+
+
+def _read_meta(arrays):
+    meta = json.loads(str(arrays["__meta__"]))
+    if meta["format_version"] != format_version:
+        raise ValueError(f"Unsupported line cache format {meta['format_version']}")
+    return meta
+
+
+def read_source_hash(filename):
+    with np.load(filename, allow_pickle=False) as arrays:
+        return _read_meta(arrays)["source_hash"]
+
+
+def load_line(filename, source_hash=None, classes=None):
+    # if source_hash is given, the line must have been saved from the
+    # same source
+    if classes is None:
+        classes = _default_classes()
+    with np.load(filename, allow_pickle=False) as npz_file:
+        arrays = {key: npz_file[key] for key in npz_file.files}
+    meta = _read_meta(arrays)
+    if source_hash is not None and meta["source_hash"] != source_hash:
+        raise ValueError(f"{filename} was not created from this source")
+
+    elements_by_class = {}
+    for class_idx, class_name in enumerate(meta["classes"]):
+        cls = classes[class_name]
+        field_values = {
+            field: _unpack_field(arrays, class_name + "/" + field, layout)
+            for field, layout in meta["fields"][class_name].items()
+        }
+        n_elements = int(np.sum(arrays["element_class"] == class_idx))
+        class_elements = [
+            cls(**{field: values[ii] for field, values in field_values.items()})
+            for ii in range(n_elements)
+        ]
+        _share_polygon_geometries(class_elements)
+        elements_by_class[class_name] = iter(class_elements)
+
+    line = pysixtrack.Line(elements=[], element_names=[])
+    for name, class_idx in zip(arrays["element_names"], arrays["element_class"]):
+        element = next(elements_by_class[meta["classes"][class_idx]])
+        line.append_element(element, str(name))
+    return line
+
+
+def _share_polygon_geometries(class_elements):
+    # LimitPolygons that shared their aperture before saving share it again,
+    # they also get one common geometry, built by the element cache like
+    # any other (with a read-only copy of the vertices)
+    geometries = {}
+    for element in class_elements:
+        if isinstance(element, ctk_elements.LimitPolygon):
+            key = id(element.aperture)
+            if key not in geometries:
+                geometries[key] = element.get_geometry()
+            element._geometry = geometries[key]
+
+
+#-------------------------------------------------------------------------------
+#------- Validation against the MAD-X sequence ------------------------------
+#-------------------------------------------------------------------------------
+
+# loader options which do not change the resulting line
+_options_without_effect = ["stats", "preload_workers", "preload_executor",
+                           "name_map"]
+
+
+def _element_attributes(ee):
+    if hasattr(ee, "items"):
+        # cpymad elements are mappings of their attributes
+        return sorted(ee.items())
+    return sorted((kk, vv) for kk, vv in vars(ee).items()
+                  if isinstance(vv, (int, float, str, list, tuple)))
+
+
+def sequence_hash(sequence, **loader_options):
+    # hash of everything iter_from_madx_sequence_ctk() uses to build the line,
+    # including the content of aperture files
+    from CollimationToolKit.loader_mad import _resolve_apertype
+    from CollimationToolKit.aperture_files import split_library_reference
+
+    sha = hashlib.sha256()
+    sha.update(repr(sorted((kk, vv) for kk, vv in loader_options.items()
+                           if kk not in _options_without_effect)).encode())
+    sha.update(repr(getattr(sequence, "length", None)).encode())
+    apertypes = {}
+    for ee, pp in zip(sequence.elements, sequence.element_positions()):
+        sha.update(repr((ee.name, ee.base_type.name, pp)).encode())
+        sha.update(repr(_element_attributes(ee)).encode())
+        if loader_options.get("install_apertures") and ee.apertype not in apertypes:
+            apertypes[ee.apertype] = _resolve_apertype(ee.apertype)
+    for apertype in sorted(apertypes):
+        if apertypes[apertype] is not None:
+            filename, name = split_library_reference(apertype)
+            with open(filename, 'rb') as aper_file:
+                sha.update(hashlib.sha256(aper_file.read()).digest())
+    return sha.hexdigest()
+
+
+def line_from_madx_sequence_cached(sequence, filename, **loader_options):
+    # loads the line from filename if it was built from the same sequence
+    # with the same options, otherwise builds it and saves it to filename
+    from CollimationToolKit.loader_mad import iter_from_madx_sequence_ctk
+
+    source_hash = sequence_hash(sequence, **loader_options)
+    if os.path.isfile(filename) and read_source_hash(filename) == source_hash:
+        return load_line(filename)
+    line = pysixtrack.Line(elements=[], element_names=[])
+    for name, element in iter_from_madx_sequence_ctk(sequence, **loader_options):
+        line.append_element(element, name)
+    save_line(line, filename, source_hash=source_hash)
+    return line
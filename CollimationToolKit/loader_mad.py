@@ -12,16 +12,31 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import os
-import io
-import csv
+import time
+import tempfile
 import numpy as np
 from pysixtrack import elements as pysixtrack_elements
 from CollimationToolKit.elements import LimitPolygon
+from CollimationToolKit import aperture_files
+from CollimationToolKit.aperture_files import load_aperture_geometry, is_aperture_file
+
+# aperture types known to MAD-X, these are never looked up as files
+mad_apertypes = {
+    "circle",
+    "ellipse",
+    "rectangle",
+    "lhcscreen",
+    "marguerite",
+    "rectellipse",
+    "racetrack",
+    "octagon",
+}
 
 # The following function is a modified version of iter_from_madx_sequence()
 # from pysixtrack.loader_mad.py. It was modified to load apertures provided
 # as files to MAD-X as LimitPolygon class elements in pysixtrack.
+# Besides text files, apertype can refer to .npy/.npz files or to a profile
+# in a profile library ("<library file>::<profile name>"), see aperture_files.py
 # You may obtain the original source code at
 # https://github.com/SixTrack/pysixtrack
 def iter_from_madx_sequence_ctk(
@@ -31,6 +46,104 @@ def iter_from_madx_sequence_ctk(
     exact_drift=False,
     drift_threshold=1e-6,
     install_apertures=False,
+    stats=None,
+    preload_workers=None,
+    preload_executor="thread",
+    merge_drifts=False,
+    name_map=None,
+    thin_apertures=False,
+    aperture_s_resolution=None,
+    demote_polygons=False,
+    demote_tolerance=1e-6,
+    simplify_deviation=None,
+):
+    # If a dict is given as stats, it is filled with the time spent on
+    # reading aperture files ("io_time") and on everything else, i.e.
+    # mostly accessing and converting the MAD-X elements ("conversion_time").
+    #
+    # If preload_workers is given, all distinct aperture files are collected
+    # first and loaded concurrently by a "thread" or "process" pool
+    # (preload_executor) with that many workers before the line is built.
+    #
+    # With merge_drifts, consecutive drifts (including the ones created for
+    # markers, monitors, collimators, ...) are merged into one and zero-length
+    # drifts without an aperture are dropped. If a dict is given as name_map,
+    # it receives {new name: [original names]} for every element that
+    # replaces several original ones.
+    #
+    # With thin_apertures, runs of identical consecutive apertures, which are
+    # only separated by drifts (and inactive multipoles), are checked only at
+    # the first and the last aperture of the run. As the particles move on
+    # straight lines there, this is exact for convex apertures; non-convex
+    # polygons are only thinned if there is no drift length between them.
+    # Losses are then only localized to within the run; with
+    # aperture_s_resolution, additional checks are kept so that kept checks
+    # are not further apart than this (if the sequence allows).
+    # Removed apertures are added to name_map under the next kept aperture.
+    #
+    # With demote_polygons, polygon profiles which are rectangles, ellipses
+    # or rectellipses within demote_tolerance are installed as the native
+    # (cheaper) pysixtrack aperture elements. The names of these apertures
+    # are listed in stats["demoted_apertures"].
+    #
+    # If simplify_deviation is given, the remaining polygon profiles are
+    # simplified, see LimitPolygon.simplify(). The simplified profiles lie
+    # inside the original ones, so losses are never under-counted.
+    # stats["simplified_profiles"] holds {profile: (n_vertices before,
+    # n_vertices after)}.
+    io_time = [0.0]
+    apertype_files = {}
+    demoted = []
+    simplified = {}
+    element_iter = _iter_from_madx_sequence_ctk(
+        sequence, classes, ignored_madtypes, exact_drift, drift_threshold,
+        install_apertures, io_time, apertype_files, preload_workers,
+        preload_executor, demote_tolerance if demote_polygons else None,
+        demoted, simplify_deviation, simplified
+    )
+    if merge_drifts:
+        element_iter = _merge_drifts(element_iter, name_map)
+    if thin_apertures:
+        element_iter = _thin_apertures(element_iter, aperture_s_resolution,
+                                       name_map)
+    if stats is None:
+        yield from element_iter
+        return
+
+    total_time = 0.0
+    n_elements = 0
+    while True:
+        t_start = time.perf_counter()
+        name_element = next(element_iter, None)
+        total_time += time.perf_counter() - t_start
+        if name_element is not None:
+            n_elements += 1
+        stats["io_time"] = io_time[0]
+        stats["conversion_time"] = total_time - io_time[0]
+        stats["n_elements"] = n_elements
+        stats["n_apertypes"] = len(apertype_files)
+        stats["demoted_apertures"] = demoted
+        stats["simplified_profiles"] = simplified
+        if name_element is None:
+            break
+        yield name_element
+
+
+def _iter_from_madx_sequence_ctk(
+    sequence,
+    classes,
+    ignored_madtypes,
+    exact_drift,
+    drift_threshold,
+    install_apertures,
+    io_time,
+    apertype_files,
+    preload_workers,
+    preload_executor,
+    demote_tolerance,
+    demoted,
+    simplify_deviation,
+    simplified,
 ):
 
     if exact_drift:
@@ -42,6 +155,25 @@ def iter_from_madx_sequence_ctk(
     elements = seq.elements
     ele_pos = seq.element_positions()
 
+    geometries = {}
+    natives = {}
+    simplified_geometries = {}
+    if install_apertures and preload_workers:
+        references = set()
+        for ee in elements:
+            apertype = ee.apertype
+            if apertype not in apertype_files:
+                t_start = time.perf_counter()
+                apertype_files[apertype] = _resolve_apertype(apertype)
+                io_time[0] += time.perf_counter() - t_start
+            if apertype_files[apertype] is not None:
+                references.add(_aperture_reference(ee, apertype_files[apertype]))
+        t_start = time.perf_counter()
+        geometries.update(aperture_files.load_aperture_geometries(
+            references, max_workers=preload_workers, executor=preload_executor
+        ))
+        io_time[0] += time.perf_counter() - t_start
+
     old_pp = 0.0
     i_drift = 0
     for ee, pp in zip(elements, ele_pos):
@@ -205,66 +337,251 @@ def iter_from_madx_sequence_ctk(
 
         yield eename, newele
 
-        if (
-            install_apertures
-            and hasattr(ee, "aperture")
-            and (min(ee.aperture) > 0)
-        ):
-            if ee.apertype == "rectangle":
+        if not install_apertures:
+            continue
+
+        # modifications to load LimitPolygon
+        # the filesystem is only checked once per distinct apertype string,
+        # apertype_files holds None (no file), "file" or the profile names
+        # of a library
+        apertype = ee.apertype
+        if apertype not in apertype_files:
+            t_start = time.perf_counter()
+            apertype_files[apertype] = _resolve_apertype(apertype)
+            io_time[0] += time.perf_counter() - t_start
+        if apertype_files[apertype] is not None:
+            # this is checked first because the other aperture
+            # installation checks for aperture > 0
+            # elements using the same file share one cached geometry
+            reference = _aperture_reference(ee, apertype_files[apertype])
+            if reference not in geometries:
+                t_start = time.perf_counter()
+                geometries[reference] = load_aperture_geometry(reference)
+                io_time[0] += time.perf_counter() - t_start
+            newaperture = LimitPolygon.from_geometry(geometries[reference])
+            if demote_tolerance is not None:
+                if reference not in natives:
+                    natives[reference] = newaperture.to_native(demote_tolerance)
+                if natives[reference] is not None:
+                    newaperture = natives[reference].copy()
+                    demoted.append(eename + "_aperture")
+            if (simplify_deviation is not None
+                    and isinstance(newaperture, LimitPolygon)):
+                if reference not in simplified_geometries:
+                    simplified_geometries[reference] = newaperture.simplify(
+                        simplify_deviation).get_geometry()
+                    simplified[reference] = (
+                        geometries[reference].n_vertices,
+                        simplified_geometries[reference].n_vertices
+                    )
+                newaperture = LimitPolygon.from_geometry(
+                    simplified_geometries[reference])
+            yield eename + "_aperture", newaperture
+        # /modifications to load LimitPolygon
+
+        elif hasattr(ee, "aperture") and (min(ee.aperture) > 0):
+            if apertype == "rectangle":
                 newaperture = pysixtrack_elements.LimitRect(
                     min_x=-ee.aperture[0],
                     max_x=ee.aperture[0],
                     min_y=-ee.aperture[1],
                     max_y=ee.aperture[1],
                 )
-            elif ee.apertype == "ellipse":
+            elif apertype == "ellipse":
                 newaperture = pysixtrack_elements.LimitEllipse(
                     a=ee.aperture[0], b=ee.aperture[1]
                 )
-            elif ee.apertype == "circle":
+            elif apertype == "circle":
                 newaperture = pysixtrack_elements.LimitEllipse(
                     a=ee.aperture[0], b=ee.aperture[0]
                 )
-            elif ee.apertype == "rectellipse":
+            elif apertype == "rectellipse":
                 newaperture = pysixtrack_elements.LimitRectEllipse(
                     max_x=ee.aperture[0],
                     max_y=ee.aperture[1],
                     a=ee.aperture[2],
                     b=ee.aperture[3],
                 )
-
             else:
-                # modifications to load LimitPolygon
-                if not os.path.isfile(ee.apertype):
-                    raise ValueError("Aperture type not recognized")
+                raise ValueError("Aperture type not recognized")
 
             yield eename + "_aperture", newaperture
-        # modifications to load LimitPolygon
-        elif install_apertures & os.path.isfile(ee.apertype):
-            # this was put here because the other aperture 
-            # installation checks for aperture > 0
-            with open(ee.apertype,'r') as aper_file:
-                input_file_str = ''
-                for line in aper_file:
-                    if line.strip(): # ignore empty lines
-                        input_file_str += line.replace('\t',' ')
-                        # csv delimiter must be ' '
-            with io.StringIO(input_file_str) as file_from_str:
-                aper_reader = csv.reader(file_from_str, delimiter=' ',
-                                         skipinitialspace=True,
-                                         quoting=csv.QUOTE_NONNUMERIC)
-                #reader -> list and non-numpy transposing
-                aper_coords = list(map(list, zip(*aper_reader)))
-            newaperture = LimitPolygon(
-                aperture = aper_coords
-            )
-            yield eename + "_aperture", newaperture
-        # /modifications to load LimitPolygon
 
     if hasattr(seq, "length") and seq.length > old_pp:
         yield "drift_%d" % i_drift, myDrift(length=(seq.length - old_pp))
 
 
+def _merge_drifts(element_iter, name_map):
+    drift_types = ["Drift", "DriftExact"]
+    if name_map is None:
+        name_map = {}
+    group = []      # consecutive drifts of the same type
+    dropped = []    # names of dropped zero-length drifts
+
+    for name, element in element_iter:
+        is_drift = element.__class__.__name__ in drift_types
+        if is_drift and (not group or type(group[0][1]) is type(element)):
+            group.append((name, element))
+            continue
+
+        if group:
+            newname, newdrift, names = _merge_drift_group(group, name)
+            group = []
+            if newdrift is None:
+                dropped += names
+            else:
+                if len(dropped + names) > 1:
+                    name_map[newname] = dropped + names
+                dropped = []
+                yield newname, newdrift
+
+        if is_drift:
+            group = [(name, element)]
+            continue
+        if dropped:
+            name_map[name] = dropped + [name]
+            dropped = []
+        yield name, element
+
+    if group:
+        newname, newdrift, names = _merge_drift_group(group, None)
+        if newdrift is not None:
+            if len(dropped + names) > 1:
+                name_map[newname] = dropped + names
+            yield newname, newdrift
+
+
+def _merge_drift_group(group, next_name):
+    # returns the name of the merged drift, the drift (None if it can be
+    # dropped) and the names of the original drifts
+    names = [name for name, drift in group]
+    length = sum(drift.length for name, drift in group)
+    if next_name is not None and next_name == names[-1] + "_aperture":
+        # keep the name of the element the aperture belongs to
+        newname = names[-1]
+    elif length == 0:
+        return None, None, names
+    else:
+        newname = names[0]
+    if len(group) == 1:
+        return newname, group[0][1], names
+    return newname, type(group[0][1])(length=length), names
+
+
+aperture_types = ["LimitRect", "LimitEllipse", "LimitRectEllipse", "LimitPolygon"]
+
+
+def _is_aperture(element):
+    return element.__class__.__name__ in aperture_types
+
+
+def _same_aperture(aperture, other):
+    if type(aperture) is not type(other):
+        return False
+    if isinstance(aperture, LimitPolygon):
+        return (aperture.fill_rule == other.fill_rule
+                and (aperture.get_geometry() is other.get_geometry()
+                     or np.array_equal(aperture.aperture, other.aperture,
+                                       equal_nan=True)))
+    return aperture.to_dict() == other.to_dict()
+
+
+def _is_convex_aperture(aperture):
+    if isinstance(aperture, LimitPolygon):
+        return aperture.get_geometry().is_convex
+    return True
+
+
+def _drift_length(element):
+    if element.__class__.__name__ in ["Drift", "DriftExact"]:
+        return element.length
+    return 0.0
+
+
+def _is_transparent(element, allow_length):
+    # elements that do not change the direction of the particles
+    if element.__class__.__name__ in ["Drift", "DriftExact"]:
+        return allow_length or element.length == 0
+    if element.__class__.__name__ == "Multipole":
+        strengths = list(element.knl) + list(element.ksl) + [element.hxl, element.hyl]
+        return not np.any(strengths)
+    return False
+
+
+def _thin_apertures(element_iter, s_resolution, name_map):
+    if name_map is None:
+        name_map = {}
+    run = []            # (name, element, s or None for non-apertures)
+    run_convex = False
+    s = 0.0
+
+    for name, element in element_iter:
+        if run:
+            if _is_aperture(element) and _same_aperture(element, run[0][1]):
+                run.append((name, element, s))
+                continue
+            if _is_transparent(element, run_convex):
+                run.append((name, element, None))
+                s += _drift_length(element)
+                continue
+            yield from _flush_aperture_run(run, s_resolution, name_map)
+            run = []
+        if _is_aperture(element):
+            run = [(name, element, s)]
+            run_convex = _is_convex_aperture(element)
+            continue
+        s += _drift_length(element)
+        yield name, element
+
+    if run:
+        yield from _flush_aperture_run(run, s_resolution, name_map)
+
+
+def _flush_aperture_run(run, s_resolution, name_map):
+    apertures = [ii for ii, (name, element, s) in enumerate(run) if s is not None]
+    keep = {apertures[0], apertures[-1]}
+    if s_resolution is not None:
+        last_kept = apertures[0]
+        for previous, current in zip(apertures[:-1], apertures[1:]):
+            if (run[current][2] - run[last_kept][2] > s_resolution
+                    and previous != last_kept):
+                keep.add(previous)
+                last_kept = previous
+    removed = []
+    for ii, (name, element, s) in enumerate(run):
+        if s is not None and ii not in keep:
+            removed.append(name)
+            continue
+        if s is not None and removed:
+            name_map[name] = removed + [name]
+            removed = []
+        yield name, element
+
+
+def _resolve_apertype(apertype):
+    if apertype in mad_apertypes or not is_aperture_file(apertype):
+        return None
+    filename, name = aperture_files.split_library_reference(apertype)
+    if name is None and aperture_files.is_profile_library(filename):
+        return frozenset(aperture_files.library_profile_names(filename))
+    return "file"
+
+
+def _aperture_reference(ee, profile_names):
+    # profiles in a library given as apertype are looked up by the name of
+    # the element or of one of its parent classes
+    if profile_names == "file":
+        return ee.apertype
+    parent = ee
+    while True:
+        if parent.name in profile_names:
+            return ee.apertype + aperture_files.library_separator + parent.name
+        if parent.parent.name == parent.name:
+            break
+        parent = parent.parent
+    raise ValueError(f'No profile for "{ee.name}" in library {ee.apertype}')
+
+
 class MadPoint(object):
     @classmethod
     def from_survey(cls, name, mad):
@@ -364,6 +681,131 @@ class MadPoint(object):
         return np.dot(dd, self.ex), np.dot(dd, self.ey)
 
 
+class MadPoints(object):
+    # Array-backed collection of MadPoint objects for many names at once.
+    # The twiss/survey tables are indexed once by name and the rotation
+    # frames of all points are computed in one batch. Attributes are arrays
+    # with the points along the first axis, e.g. p.shape == (n_points, 3).
+    @classmethod
+    def from_survey(cls, names, mad):
+        return cls(names, mad, use_twiss=False, use_survey=True)
+
+    @classmethod
+    def from_twiss(cls, names, mad):
+        return cls(names, mad, use_twiss=True, use_survey=False)
+
+    def __init__(self, names, mad, use_twiss=True, use_survey=True):
+
+        self.use_twiss = use_twiss
+        self.use_survey = use_survey
+
+        if not (use_survey) and not (use_twiss):
+            raise ValueError(
+                "use_survey and use_twiss cannot be False at the same time"
+            )
+
+        self.names = list(names)
+        if use_twiss:
+            twiss = mad.table.twiss
+            table_names = twiss.name
+        if use_survey:
+            survey = mad.table.survey
+            table_names = survey.name
+
+        # first occurrence of every name, as in MadPoint
+        row_of_name = {}
+        for row, table_name in enumerate(table_names):
+            row_of_name.setdefault(table_name, row)
+        idx = np.array([row_of_name[name] for name in self.names], dtype=int)
+        n_points = len(idx)
+
+        if use_twiss:
+            self.tx = np.asarray(twiss.x)[idx]
+            self.ty = np.asarray(twiss.y)[idx]
+            self.tpx = np.asarray(twiss.px)[idx]
+            self.tpy = np.asarray(twiss.py)[idx]
+        else:
+            self.tx = None
+            self.ty = None
+            self.tpx = None
+            self.tpy = None
+
+        if use_survey:
+            self.sx = np.asarray(survey.x)[idx]
+            self.sy = np.asarray(survey.y)[idx]
+            self.sz = np.asarray(survey.z)[idx]
+            self.sp = np.stack([self.sx, self.sy, self.sz], axis=1)
+            theta = np.asarray(survey.theta)[idx]
+            phi = np.asarray(survey.phi)[idx]
+            psi = np.asarray(survey.psi)[idx]
+        else:
+            self.sx = None
+            self.sy = None
+            self.sz = None
+            self.sp = None
+            theta = np.zeros(n_points)
+            phi = np.zeros(n_points)
+            psi = np.zeros(n_points)
+
+        thetam = np.zeros((n_points, 3, 3))
+        thetam[:, 0, 0] = np.cos(theta)
+        thetam[:, 0, 2] = np.sin(theta)
+        thetam[:, 1, 1] = 1
+        thetam[:, 2, 0] = -np.sin(theta)
+        thetam[:, 2, 2] = np.cos(theta)
+        phim = np.zeros((n_points, 3, 3))
+        phim[:, 0, 0] = 1
+        phim[:, 1, 1] = np.cos(phi)
+        phim[:, 1, 2] = np.sin(phi)
+        phim[:, 2, 1] = -np.sin(phi)
+        phim[:, 2, 2] = np.cos(phi)
+        psim = np.zeros((n_points, 3, 3))
+        psim[:, 0, 0] = np.cos(psi)
+        psim[:, 0, 1] = -np.sin(psi)
+        psim[:, 1, 0] = np.sin(psi)
+        psim[:, 1, 1] = np.cos(psi)
+        psim[:, 2, 2] = 1
+        wm = np.einsum("nij,njk,nkl->nil", thetam, phim, psim)
+        # columns of wm are the unit vectors of the local frames
+        self.ex = wm[:, :, 0]
+        self.ey = wm[:, :, 1]
+        self.ez = wm[:, :, 2]
+
+        self.p = np.zeros((n_points, 3))
+
+        if use_twiss:
+            self.p += self.ex * self.tx[:, None] + self.ey * self.ty[:, None]
+
+        if use_survey:
+            self.p += self.sp
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, ii):
+        # single MadPoint, without looking up the tables again
+        point = MadPoint.__new__(MadPoint)
+        point.use_twiss = self.use_twiss
+        point.use_survey = self.use_survey
+        point.name = self.names[ii]
+        for attr in ["tx", "ty", "tpx", "tpy", "sx", "sy", "sz", "sp"]:
+            values = getattr(self, attr)
+            setattr(point, attr, None if values is None else values[ii])
+        point.ex = self.ex[ii]
+        point.ey = self.ey[ii]
+        point.ez = self.ez[ii]
+        point.p = self.p[ii]
+        return point
+
+    def dist(self, other):
+        # other: MadPoints of the same length or a single MadPoint
+        return np.sqrt(np.sum((self.p - other.p) ** 2, axis=-1))
+
+    def distxy(self, other):
+        dd = self.p - other.p
+        return np.sum(dd * self.ex, axis=-1), np.sum(dd * self.ey, axis=-1)
+
+
 def mad_benchmark(mtype, attrs, pc=0.2, x=0, px=0, y=0, py=0, t=0, pt=0):
     import pysixtrack
     from cpymad.madx import Madx
@@ -374,10 +816,12 @@ def mad_benchmark(mtype, attrs, pc=0.2, x=0, px=0, y=0, py=0, t=0, pt=0):
     madtype.clone("mm", **attrs)
     mad.input("bench: line=(mm)")
     mad.use(sequence="bench")
-    mad.track(onepass=True, dump=False)
-    mad.start(x=x, px=px, y=y, py=py, t=t, pt=pt)
-    mad.run()
-    mad.endtrack()
+    # MAD-X writes checkpoint_restart.dat into its working directory
+    with tempfile.TemporaryDirectory() as track_dir, mad.chdir(track_dir):
+        mad.track(onepass=True, dump=False)
+        mad.start(x=x, px=px, y=y, py=py, t=t, pt=pt)
+        mad.run()
+        mad.endtrack()
     p_mad = pysixtrack.Particles.from_madx_track(mad)
     p_six = p_mad.copy(0)
     line = pysixtrack.Line.from_madx_sequence(
@@ -386,3 +830,142 @@ def mad_benchmark(mtype, attrs, pc=0.2, x=0, px=0, y=0, py=0, t=0, pt=0):
     line.track(p_six)
     p_mad.copy(-1).compare(p_six, rel_tol=0)
     return mad, line, p_mad, p_six
+
+
+# MAD-X and pysixtrack names of the coordinates compared by mad_benchmark_batch()
+benchmark_coordinates = [("x", "x"), ("px", "px"), ("y", "y"), ("py", "py"),
+                         ("t", "tau"), ("pt", "ptau")]
+
+
+class MadBenchmarkResult(object):
+    def __init__(self, mad, line, element_types, deviations):
+        # deviations: (n_elements, n_coordinates) maximum absolute deviation
+        # over all particles for every element parameter set
+        self.mad = mad
+        self.line = line
+        self.element_types = element_types
+        self.deviations = deviations
+
+    def max_deviation_per_type(self):
+        # {mad type: {coordinate: maximum absolute deviation}}
+        result = {}
+        for mtype in dict.fromkeys(self.element_types):
+            rows = [ii for ii, tt in enumerate(self.element_types) if tt == mtype]
+            max_deviation = np.max(self.deviations[rows], axis=0)
+            result[mtype] = {mad_name: float(value) for (mad_name, six_name), value
+                             in zip(benchmark_coordinates, max_deviation)}
+        return result
+
+    def report(self):
+        lines = ["%-14s" % "type" + "".join("%12s" % mad_name for mad_name, six_name
+                                          in benchmark_coordinates)]
+        for mtype, deviation in self.max_deviation_per_type().items():
+            lines.append("%-14s" % mtype + "".join("%12.3e" % value
+                                                   for value in deviation.values()))
+        return "\n".join(lines)
+
+
+def mad_benchmark_batch(elements, pc=0.2, particle="proton", exact_drift=True,
+                        loader_options=None, **start):
+    # batched version of mad_benchmark(): elements is a list of (mtype, attrs)
+    # and start gives the initial x, px, y, py, t, pt (arrays or scalars).
+    # All elements are put into one sequence, separated by observed markers,
+    # and all particles are tracked through it in one MAD-X session. Every
+    # element is then tracked with the loaded line, starting from the
+    # coordinates MAD-X observed in front of it, and compared with the
+    # coordinates behind it, so deviations do not add up along the sequence.
+    import pysixtrack
+    from cpymad.madx import Madx
+
+    loader_options = {} if loader_options is None else loader_options
+    mad_names = [mad_name for mad_name, six_name in benchmark_coordinates]
+    initial = np.broadcast_arrays(*[np.atleast_1d(np.asarray(start.get(name, 0.0),
+                                                             dtype=float))
+                                    for name in mad_names])
+    unknown = set(start) - set(mad_names)
+    if unknown:
+        raise ValueError(f"Unknown initial coordinates {sorted(unknown)}")
+
+    mad = Madx(stdout=False)
+    mad.beam(particle=particle, pc=pc)
+    markers = ["ctk_bench_m%d" % ii for ii in range(len(elements) + 1)]
+    for marker in markers:
+        mad.command.marker.clone(marker)
+    sequence = [markers[0]]
+    for ii, (mtype, attrs) in enumerate(elements):
+        mad.command[mtype].clone("ctk_bench_e%d" % ii, **attrs)
+        sequence += ["ctk_bench_e%d" % ii, markers[ii + 1]]
+    mad.input("ctk_bench: line=(%s)" % ", ".join(sequence))
+    mad.use(sequence="ctk_bench")
+    # MAD-X writes checkpoint_restart.dat into its working directory
+    with tempfile.TemporaryDirectory() as track_dir, mad.chdir(track_dir):
+        mad.track(onepass=True, dump=False, onetable=True)
+        for marker in markers:
+            mad.observe(place=marker)
+        for values in zip(*initial):
+            mad.start(**dict(zip(mad_names, values)))
+        mad.run()
+        mad.endtrack()
+
+    table = mad.table.trackone
+    places = np.array([name.split(":")[0].lower() for name in table.row_names()])
+    numbers = np.asarray(table.number, dtype=int)
+    columns = {name: np.asarray(table[name], dtype=float) for name in mad_names}
+
+    # drifts are merged and apertures thinned within every element only, as
+    # merging across the markers would drop them
+    loader_options = dict(loader_options)
+    merge_drifts = loader_options.pop("merge_drifts", False)
+    thin_apertures = loader_options.pop("thin_apertures", False)
+    aperture_s_resolution = loader_options.pop("aperture_s_resolution", None)
+    name_map = loader_options.pop("name_map", None)
+    loaded = list(iter_from_madx_sequence_ctk(mad.sequence.ctk_bench,
+                                              exact_drift=exact_drift,
+                                              **loader_options))
+    loaded_names = [name for name, element in loaded]
+    line = pysixtrack.Line(elements=[], element_names=[])
+    marker_idx = []
+    for ii, marker in enumerate(markers):
+        start = loaded_names.index(marker)
+        marker_idx.append(len(line.elements))
+        line.append_element(loaded[start][1], marker)
+        if ii == len(elements):
+            break
+        segment = iter(loaded[start + 1:loaded_names.index(markers[ii + 1])])
+        if merge_drifts:
+            segment = _merge_drifts(segment, name_map)
+        if thin_apertures:
+            segment = _thin_apertures(segment, aperture_s_resolution, name_map)
+        for name, element in segment:
+            line.append_element(element, name)
+
+    beam = mad.sequence.ctk_bench.beam
+    deviations = np.full((len(elements), len(benchmark_coordinates)), np.nan)
+    for ii in range(len(elements)):
+        rows_in = np.where(places == markers[ii])[0]
+        rows_out = np.where(places == markers[ii + 1])[0]
+        # particles lost in MAD-X in between are not compared
+        common, idx_in, idx_out = np.intersect1d(numbers[rows_in], numbers[rows_out],
+                                                 return_indices=True)
+        if len(common) == 0:
+            continue
+        rows_in = rows_in[idx_in]
+        rows_out = rows_out[idx_out]
+        p_six = pysixtrack.Particles(
+            p0c=beam.pc*1e9, mass0=beam.mass*1e9, q0=beam.charge,
+            **{six_name: columns[mad_name][rows_in]
+               for mad_name, six_name in benchmark_coordinates})
+        p_six.state = np.ones(len(common), dtype=int)
+        p_six.partid = np.arange(len(common))
+        for element in line.elements[marker_idx[ii] + 1:marker_idx[ii + 1]]:
+            element.track(p_six)
+        # particles lost at installed apertures are removed from p_six, the
+        # others are compared by partid (MAD-X tracks without apertures)
+        if np.size(p_six.partid) == 0:
+            continue
+        rows_out = rows_out[np.atleast_1d(p_six.partid)]
+        deviations[ii] = [np.max(np.abs(getattr(p_six, six_name)
+                                        - columns[mad_name][rows_out]))
+                          for mad_name, six_name in benchmark_coordinates]
+    element_types = [mtype for mtype, attrs in elements]
+    return MadBenchmarkResult(mad, line, element_types, deviations)
@@ -0,0 +1,238 @@
+'''
+This module streams loss records to disk while tracking.
+
+A LossWriter buffers the particles lost at LimitPolygon and LimitFoil
+elements (see attach_loss_writer()) or records pushed directly, e.g. the
+losses of tracking.track_parallel(), and appends them in chunks to a single
+file. The file starts with a .npy record with the field names, followed by
+one .npy record per field and chunk, so it is columnar, can be appended to
+and a crash can at most lose the last, incomplete chunk (read_losses()
+ignores it).
+
+Particles whose losses were written are removed from the lost_particles list
+of the tracked particles, so memory does not grow with the number of losses.
+
+Alongside, the writer keeps the number of losses per element. This
+histogram along s is written to "<filename>.hist.npz" on every flush
+(atomically), so it can be read with read_loss_histogram() while the run
+is still going.
+'''
+
+import os
+import numpy as np
+
+
+loss_fields = ["partid", "turn", "element", "x", "px", "y", "py", "zeta", "delta",
+               "s"]
+_int_fields = ["partid", "turn", "element"]
+# order of the arguments of LossWriter.push()
+_push_fields = ["element", "turn", "partid", "x", "px", "y", "py", "zeta", "delta",
+                "s"]
+
+
+def histogram_filename(filename):
+    return filename + ".hist.npz"
+
+
+class LossWriter(object):
+    def __init__(self, filename, element_s=None, element_names=None,
+                 chunk_size=100000, append=False):
+        # element_s and element_names describe the line, they are set by
+        # attach_loss_writer() if not given. With append, records are added
+        # to an existing file and the histogram is continued.
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.element_s = None if element_s is None else np.asarray(element_s, dtype=float)
+        self.element_names = None if element_names is None else list(element_names)
+        self._buffer = {field: [] for field in loss_fields}
+        self._n_buffered = 0
+        self.n_written = 0
+        self.counts = np.zeros(0 if element_s is None else len(element_s),
+                               dtype=np.int64)
+
+        if append and os.path.isfile(filename):
+            # an incomplete chunk at the end (e.g. after a crash) is dropped
+            end = None
+            for chunk, end in _iter_chunks(filename):
+                self.n_written += len(chunk["partid"])
+            with open(filename, 'r+b') as loss_file:
+                loss_file.truncate(end if end is not None
+                                   else _header_size(filename))
+            if os.path.isfile(histogram_filename(filename)):
+                histogram = read_loss_histogram(filename)
+                self._add_counts(histogram["counts"])
+        else:
+            with open(filename, 'wb') as loss_file:
+                np.lib.format.write_array(loss_file, np.array(loss_fields))
+
+    def _add_counts(self, counts):
+        if len(counts) > len(self.counts):
+            self.counts = np.concatenate(
+                [self.counts, np.zeros(len(counts) - len(self.counts), dtype=np.int64)])
+        self.counts[:len(counts)] += counts
+
+    def push(self, element, turn, partid, x, px, y, py, zeta, delta, s):
+        # all arguments can be scalars or arrays of the same length,
+        # s is where the particles were lost
+        columns = np.broadcast_arrays(element, turn, partid, x, px, y, py, zeta,
+                                      delta, s)
+        n_records = columns[0].size
+        if n_records == 0:
+            return
+        for field, column in zip(_push_fields, columns):
+            dtype = np.int64 if field in _int_fields else float
+            self._buffer[field].append(np.array(column, dtype=dtype).ravel())
+        self._add_counts(np.bincount(self._buffer["element"][-1]))
+        self._n_buffered += n_records
+        if self._n_buffered >= self.chunk_size:
+            self.flush()
+
+    def push_particles(self, element, particle):
+        # records all particles of particle (e.g. a set of lost particles)
+        # as lost at element
+        self.push(element, particle.turn, particle.partid, particle.x,
+                  particle.px, particle.y, particle.py, particle.zeta,
+                  particle.delta, particle.s)
+
+    def push_records(self, losses):
+        # losses: dict of arrays as tracking.TrackingResult.losses
+        self.push(*[losses[field] for field in _push_fields])
+
+    def flush(self):
+        if self._n_buffered > 0:
+            with open(self.filename, 'ab') as loss_file:
+                for field in loss_fields:
+                    np.lib.format.write_array(loss_file,
+                                              np.concatenate(self._buffer[field]))
+                    self._buffer[field] = []
+            self.n_written += self._n_buffered
+            self._n_buffered = 0
+        self._write_histogram()
+
+    def _write_histogram(self):
+        n_elements = len(self.counts)
+        if self.element_s is not None:
+            n_elements = max(n_elements, len(self.element_s))
+        counts = np.zeros(n_elements, dtype=np.int64)
+        counts[:len(self.counts)] = self.counts
+        s = np.full(n_elements, np.nan)
+        names = np.full(n_elements, "", dtype=object)
+        if self.element_s is not None:
+            s[:len(self.element_s)] = self.element_s
+        if self.element_names is not None:
+            names[:len(self.element_names)] = self.element_names
+        filename = histogram_filename(self.filename)
+        tmp_filename = filename + ".tmp%d" % os.getpid()
+        with open(tmp_filename, 'wb') as histogram_file:
+            np.savez(histogram_file, s=s, counts=counts,
+                     names=names.astype(str), n_written=self.n_written)
+        os.replace(tmp_filename, filename)
+
+    def get_checkpoint(self):
+        # flushes and returns what restore_checkpoint() needs to continue
+        # from this point, see checkpoint.py
+        self.flush()
+        return {"position": os.path.getsize(self.filename),
+                "n_written": self.n_written, "counts": self.counts.copy()}
+
+    def restore_checkpoint(self, state):
+        # drops all records pushed after get_checkpoint() returned state,
+        # e.g. the ones of a run preempted after its last checkpoint
+        position = int(state["position"])
+        if os.path.getsize(self.filename) < position:
+            raise ValueError(f"{self.filename} is shorter than at the checkpoint")
+        self._buffer = {field: [] for field in loss_fields}
+        self._n_buffered = 0
+        with open(self.filename, 'r+b') as loss_file:
+            loss_file.truncate(position)
+        self.n_written = int(state["n_written"])
+        self.counts = np.array(state["counts"], dtype=np.int64)
+        self._write_histogram()
+
+    @property
+    def histogram(self):
+        # (s, counts) of all losses pushed so far, including the buffered ones
+        return self.element_s, self.counts
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def attach_loss_writer(line, writer):
+    # LimitPolygon(Thick) and LimitFoil elements of line push their losses into
+    # writer (None detaches it). Native pysixtrack apertures are not
+    # covered, use LimitPolygon or tracking.track_parallel() for those.
+    from CollimationToolKit.elements import LimitPolygon, LimitFoil
+    from CollimationToolKit.elements import LimitPolygonThick
+
+    if writer is not None:
+        if writer.element_s is None:
+            writer.element_s = element_s_positions(line)
+        if writer.element_names is None:
+            writer.element_names = list(line.element_names)
+    for ii, element in enumerate(line.elements):
+        if isinstance(element, (LimitPolygon, LimitPolygonThick, LimitFoil)):
+            element.loss_writer = writer
+            element.loss_element_index = ii
+
+
+def element_s_positions(line):
+    # s at the entry of every element like Line.get_s_elements(), but
+    # counting the length of thick apertures as well
+    from pysixtrack.elements import Drift, DriftExact
+    from CollimationToolKit.elements import LimitPolygonThick
+
+    s = np.zeros(len(line.elements))
+    s_element = 0.0
+    for ii, element in enumerate(line.elements):
+        s[ii] = s_element
+        if isinstance(element, (Drift, DriftExact, LimitPolygonThick)):
+            s_element += element.length
+    return s
+
+
+def _header_size(filename):
+    with open(filename, 'rb') as loss_file:
+        np.lib.format.read_array(loss_file, allow_pickle=False)
+        return loss_file.tell()
+
+
+def _iter_chunks(filename):
+    # yields (chunk, file position after the chunk), the fields are taken
+    # from the file
+    with open(filename, 'rb') as loss_file:
+        fields = [str(field) for field in
+                  np.lib.format.read_array(loss_file, allow_pickle=False)]
+        while True:
+            chunk = {}
+            try:
+                for field in fields:
+                    chunk[field] = np.lib.format.read_array(loss_file,
+                                                            allow_pickle=False)
+            except (ValueError, EOFError):
+                # end of file or an incomplete chunk
+                return
+            yield chunk, loss_file.tell()
+
+
+def read_losses(filename):
+    # returns all complete chunks as dict of arrays
+    columns = {field: [] for field in loss_fields}
+    for chunk, end in _iter_chunks(filename):
+        for field, values in chunk.items():
+            columns.setdefault(field, []).append(values)
+    return {field: np.concatenate(values) if values
+            else np.zeros(0, dtype=np.int64 if field in _int_fields else float)
+            for field, values in columns.items()}
+
+
+def read_loss_histogram(filename):
+    # {"s", "counts", "names", "n_written"} as written by the last flush
+    with np.load(histogram_filename(filename), allow_pickle=False) as histogram:
+        return {key: histogram[key] for key in histogram.files}
@@ -0,0 +1,137 @@
+'''
+This module skips LimitPolygon checks of particles which cannot have
+reached the aperture yet.
+
+Most particles stay far from the aperture for many elements, but every
+LimitPolygon checks all of them against all edges. track_with_margins()
+tracks like pysixtrack.Line.track(), but keeps for every particle what was
+known at its last aperture check: its distance to the boundary (the signed
+distance, positive inside), the aperture it was checked against and its
+distance from the origin. The user gives an upper bound of the transverse
+excursion of the particles between two LimitPolygon elements. A particle is
+skipped at a LimitPolygon if, even after moving by the accumulated bound,
+ - it is still inside the same aperture it was checked against last, or
+ - it is still inside the largest circle around the origin which fits into
+   the aperture (its inscribed radius).
+
+Margins are kept per geometry, fill rule and precision of the elements, and
+particles within the rounding errors of the classification (float32 with
+low_precision) are always checked again. If the bound holds, the result is
+exactly the same as with Line.track(). All other elements, including other
+apertures, are tracked as usual.
+'''
+
+import numpy as np
+from CollimationToolKit.elements import LimitPolygon, _track_and_record_losses
+
+
+# per-particle arrays kept aligned by remove_lost_particles()
+_margin_arrays = ("_margin_distance", "_margin_geometry", "_margin_radius",
+                  "_margin_excursion")
+
+
+def inscribed_radius(element):
+    # radius of the largest circle around the origin inside the aperture,
+    # 0 if the origin is outside
+    return max(float(element.signed_distance(0.0, 0.0)[0]), 0.0)
+
+
+def classification_tolerance(element):
+    # the distances are computed in float64, while the element classifies
+    # with the rounding errors of its precision (float32 with low_precision).
+    # Particles closer to the boundary than this are always checked again.
+    dtype = np.float32 if element.low_precision else np.float64
+    extent = np.nanmax(np.abs(np.asarray(element.get_geometry().aperture,
+                                         dtype=float)))
+    return 64 * np.finfo(dtype).eps * extent
+
+
+def track_with_margins(line, particles, max_excursion, n_turns=1):
+    # tracks particles (with array coordinates) through line for n_turns
+    # turns, setting particles.turn. max_excursion bounds how far (in x-y)
+    # any particle moves between two consecutive LimitPolygon elements of
+    # the line, also from the last one to the first one of the next turn.
+    # Returns the number of particle checks done and skipped at LimitPolygon
+    # elements.
+    if not hasattr(particles.state, "__iter__"):
+        raise ValueError("track_with_margins() needs particles with array coordinates")
+    n_part = len(particles.state)
+    # (id(geometry), fill rule, low precision)
+    #     -> (index, inscribed radius, tolerance)
+    geometries = {}
+    for element in line.elements:
+        if isinstance(element, LimitPolygon):
+            key = _geometry_key(element)
+            if key not in geometries:
+                geometries[key] = (len(geometries), inscribed_radius(element),
+                                   classification_tolerance(element))
+
+    # nothing is known before the first check
+    particles._margin_distance = np.full(n_part, -np.inf)
+    particles._margin_geometry = np.full(n_part, -1)
+    particles._margin_radius = np.full(n_part, np.inf)
+    particles._margin_excursion = np.zeros(n_part)
+    dict_vars = particles.__dict__.get("_dict_vars")
+    particles._dict_vars = tuple(particles._dict_vars) + _margin_arrays
+    n_lost_before = len(particles.lost_particles)
+    stats = {"checked": 0, "skipped": 0}
+    try:
+        for turn in range(n_turns):
+            particles.turn = turn
+            for element in line.elements:
+                if isinstance(element, LimitPolygon):
+                    ret = _track_and_record_losses(
+                        element, lambda particles: _track_polygon(
+                            element, geometries, max_excursion, particles, stats),
+                        particles)
+                else:
+                    ret = element.track(particles)
+                if ret is not None:
+                    return stats
+    finally:
+        for tracked in [particles] + particles.lost_particles[n_lost_before:]:
+            for name in _margin_arrays:
+                tracked.__dict__.pop(name, None)
+            if dict_vars is None:
+                tracked.__dict__.pop("_dict_vars", None)
+            else:
+                tracked._dict_vars = dict_vars
+    return stats
+
+
+def _geometry_key(element):
+    return (id(element.get_geometry()), element.fill_rule,
+            bool(element.low_precision))
+
+
+def _track_polygon(element, geometries, max_excursion, particles, stats):
+    geometry = element.get_geometry()
+    geometry_index, radius, tolerance = geometries[_geometry_key(element)]
+    excursion = particles._margin_excursion
+    excursion += max_excursion
+    safe = (((particles._margin_geometry == geometry_index)
+             & (particles._margin_distance > excursion + tolerance))
+            | (particles._margin_radius + excursion < radius - tolerance))
+    check = np.where(~safe)[0]
+    stats["checked"] += len(check)
+    stats["skipped"] += len(safe) - len(check)
+    if len(check) == 0:
+        return
+
+    x = np.asarray(particles.x, dtype=float)[check]
+    y = np.asarray(particles.y, dtype=float)[check]
+    inside = element._contains(geometry, x, y)
+    distance = geometry.distance_to_boundary(x, y)
+    particles._margin_distance[check] = np.where(inside, distance, -distance)
+    particles._margin_geometry[check] = geometry_index
+    particles._margin_radius[check] = np.hypot(x, y)
+    excursion[check] = 0.0
+
+    if np.all(inside):
+        return
+    state = np.ones(len(particles.state), dtype=int)
+    state[check[~inside]] = 0
+    particles.state = state
+    particles.remove_lost_particles()
+    if len(particles.state) == 0:
+        return "All particles lost"
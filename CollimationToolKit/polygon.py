@@ -0,0 +1,470 @@
+'''
+This module provides the precomputed geometry of polygonal apertures.
+
+A PolygonGeometry holds everything the LimitPolygon tracking needs that does
+not depend on the particles, i.e. the vertices, the rolled vertices forming
+the edges and the reference point outside the aperture. It is treated as
+immutable, so several LimitPolygon elements using the same profile (e.g.
+loaded from the same aperture file) can share one instance.
+
+An aperture can consist of several rings (e.g. an outer boundary with holes,
+or separate pieces), separated by a column of NaN:
+
+    [[x_1, ..., x_n, nan, x'_1, ..., x'_m], [y_1, ..., y_n, nan, y'_1, ...]]
+
+The edges of all rings are concatenated, every ring is closed on its own,
+and all of them are checked in one pass. With the "evenodd" fill rule a point
+is inside if it is enclosed by an odd number of rings, with "nonzero" if the
+rings wind around it in total (holes must then run the other way round).
+'''
+
+from operator import sub, mul
+import numpy as np
+
+
+fill_rules = ["evenodd", "nonzero"]
+
+
+class PolygonGeometry(object):
+    # convention: aperture[0] = x-coords, aperture[1] = y-coords
+
+    def __init__(self, aperture):
+        # keep the aperture object itself to detect if an element's aperture
+        # was replaced after the geometry was computed
+        self.aperture = aperture
+        # both representations are only built when first needed, so
+        # (memory-mapped) profiles that are never tracked are never copied
+        self._list_repr = None
+        self._array_repr = None
+        self._float32_repr = None
+        self._edge_repr = None
+        self._is_convex = None
+        self._rings = None
+
+    def _get_rings(self):
+        if self._rings is None:
+            self._rings = ring_vertices(self.aperture)
+        return self._rings
+
+    @property
+    def n_vertices(self):
+        return self._get_rings()[0].shape[1]
+
+    @property
+    def n_rings(self):
+        previous = self._get_rings()[1]
+        return int(np.sum(previous >= np.arange(len(previous))))
+
+    @property
+    def is_convex(self):
+        if self._is_convex is None:
+            self._is_convex = is_convex(self.aperture)
+        return self._is_convex
+
+    def _get_list_repr(self):
+        # list representation for scalar (e.g. mpmath) particles
+        if self._list_repr is None:
+            vertices, previous = self._get_rings()
+            if vertices.shape[1] != len(self.aperture[0]):
+                # several rings, the separators are dropped
+                vertex_list = vertices.tolist()
+            elif isinstance(self.aperture, np.ndarray):
+                vertex_list = self.aperture.tolist()
+            else:
+                vertex_list = [list(self.aperture[0]), list(self.aperture[1])]
+            vertex_list_rolled = [[coords[ii] for ii in previous]
+                                  for coords in vertex_list]
+            refpoint = [[1.1*abs(max(vertex_list[0]))],
+                        [1.1*abs(max(vertex_list[1]))]]
+            refpoint_is_right = map_is_right_of(vertex_list, vertex_list_rolled,
+                                                [list(refpoint[0]),
+                                                 list(refpoint[1])])
+            self._list_repr = (vertex_list, vertex_list_rolled, refpoint,
+                               refpoint_is_right)
+        return self._list_repr
+
+    def _get_array_repr(self):
+        # array representation for vectorized tracking
+        if self._array_repr is None:
+            vertices, previous = self._get_rings()
+            aper_1 = np.expand_dims(vertices, axis=2)
+            aper_2 = aper_1[:, previous]
+            # prepare reference point outside aperture
+            refpoint = np.array([[1.1*abs(max(aper_1[0]))],
+                                 [1.1*abs(max(aper_1[1]))]])
+            # does not depend on the particles, so it is computed only once
+            refpoint_is_right = np_is_right_of(aper_1, aper_2, refpoint)
+            for array in [aper_1, aper_2, refpoint, refpoint_is_right]:
+                array.flags.writeable = False
+            self._array_repr = (aper_1, aper_2, refpoint, refpoint_is_right)
+        return self._array_repr
+
+    def _get_float32_repr(self):
+        # edges in float32, shifted to the centre of the bounding box, for
+        # contains_float32()
+        if self._float32_repr is None:
+            vertices, previous = self._get_rings()
+            center = (vertices.min(axis=1) + vertices.max(axis=1))/2
+            shifted = vertices - center[:, None]
+            x1, y1 = shifted
+            x2, y2 = shifted[:, previous]
+            dy = y2 - y1
+            slope = np.divide(x2 - x1, dy, out=np.zeros_like(dy), where=dy != 0)
+            # float32 results closer to the boundary than this are rechecked,
+            # the rounding error of y is amplified by the slope of the edge
+            scale = max(np.max(np.abs(shifted)), np.finfo(float).tiny)
+            margin = 1e-5*scale
+            edge_margin = margin + 16*np.finfo(np.float32).eps*scale*(1 + np.abs(slope))
+            edges = np.array([x1, y1, y2, slope, edge_margin],
+                             dtype=np.float32)[:, :, None]
+            # +1 for edges going up, for the winding number
+            direction = np.where(y2 > y1, 1, -1).astype(np.int8)[:, None]
+            self._float32_repr = (center, edges, np.float32(margin), direction)
+        return self._float32_repr
+
+    def contains_float32(self, x, y, chunk_size=None, fill_rule="evenodd"):
+        # ray casting in float32 with bool masks, returns (inside, uncertain)
+        # as bool arrays. Particles too close to a vertex or an edge to be
+        # classified reliably in float32 are marked as uncertain and have
+        # to be rechecked in float64.
+        _check_fill_rule(fill_rule)
+        center, edges, margin, direction = self._get_float32_repr()
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        inside = np.empty(x.shape, dtype=bool)
+        uncertain = np.empty(x.shape, dtype=bool)
+        if chunk_size is None:
+            # about 4 MB per edge-particle mask
+            chunk_size = max(1, 2**22 // self.n_vertices)
+        x1, y1, y2, slope, edge_margin = edges
+        for start in range(0, len(x), chunk_size):
+            x32 = (x[start:start + chunk_size] - center[0]).astype(np.float32)
+            y32 = (y[start:start + chunk_size] - center[1]).astype(np.float32)
+            y_from_1 = y32 - y1
+            straddles = (y_from_1 < 0) != (y32 < y2)
+            distance = x32 - (x1 + y_from_1*slope)
+            crossings = straddles & (distance < 0)
+            near = np.abs(y_from_1) < margin
+            near |= straddles & (np.abs(distance) < edge_margin)
+            if fill_rule == "evenodd":
+                inside[start:start + chunk_size] = np.logical_xor.reduce(crossings,
+                                                                         axis=0)
+            else:
+                inside[start:start + chunk_size] = np.sum(
+                    np.where(crossings, direction, 0), axis=0) != 0
+            uncertain[start:start + chunk_size] = np.any(near, axis=0)
+        return inside, uncertain
+
+    def contains(self, x, y, fill_rule="evenodd", chunk_size=None):
+        # vectorized float64 check of the points x, y (bool array)
+        def contains_chunk(x, y):
+            coords = np.array([[x], [y]])
+            return _contains(self.aper_1, self.aper_2, self.refpoint,
+                             self.refpoint_is_right, coords, fill_rule)
+        return self._in_chunks(contains_chunk, x, y, chunk_size)
+
+    def _get_edge_repr(self):
+        # start, direction and inverse squared length of the edges
+        if self._edge_repr is None:
+            start = self.aper_2
+            direction = self.aper_1 - self.aper_2
+            length2 = direction[0]**2 + direction[1]**2
+            inv_length2 = np.divide(1.0, length2, out=np.zeros_like(length2),
+                                    where=length2 > 0)
+            self._edge_repr = (start, direction, inv_length2)
+        return self._edge_repr
+
+    def distance_to_boundary(self, x, y, chunk_size=None):
+        # vectorized distance of the points x, y to the nearest edge
+        start, direction, inv_length2 = self._get_edge_repr()
+        def distance_chunk(x, y):
+            dx = x - start[0]
+            dy = y - start[1]
+            # closest point of each edge, as fraction of the edge
+            along = np.clip((dx*direction[0] + dy*direction[1])*inv_length2, 0, 1)
+            distance2 = (dx - along*direction[0])**2 + (dy - along*direction[1])**2
+            return np.sqrt(np.min(distance2, axis=0))
+        return self._in_chunks(distance_chunk, x, y, chunk_size)
+
+    def _in_chunks(self, function, x, y, chunk_size):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if chunk_size is None:
+            # about 8 MB per edge-point array
+            chunk_size = max(1, 2**20 // self.n_vertices)
+        if len(x) <= chunk_size:
+            return function(x, y)
+        return np.concatenate([function(x[start:start + chunk_size],
+                                        y[start:start + chunk_size])
+                               for start in range(0, len(x), chunk_size)])
+
+    vertex_list = property(lambda self: self._get_list_repr()[0])
+    vertex_list_rolled = property(lambda self: self._get_list_repr()[1])
+    refpoint_list = property(lambda self: self._get_list_repr()[2])
+    refpoint_is_right_list = property(lambda self: self._get_list_repr()[3])
+    aper_1 = property(lambda self: self._get_array_repr()[0])
+    aper_2 = property(lambda self: self._get_array_repr()[1])
+    refpoint = property(lambda self: self._get_array_repr()[2])
+    refpoint_is_right = property(lambda self: self._get_array_repr()[3])
+
+
+def np_is_right_of(line_start, line_end, point):
+    # decides if point is right of line going through line_start and
+    # line_end by checking the 3rd dimension direction of the cross
+    # product of the involved vectors
+    def __crossproduct_z__(vector1, vector2):
+        return np.multiply(vector1[0],vector2[1]) - np.multiply(vector1[1],vector2[0])
+
+    return __crossproduct_z__(line_end-line_start, point-line_start) > 0.0
+
+
+def map_is_right_of(line_start, line_end, point):
+    # pedestrian implementation of np_is_right_of()
+    def __crossproduct_z__(vector1, vector2):
+        z_coord = list(map(sub, list(map(mul,vector1[0],vector2[1])),
+                                list(map(mul,vector1[1],vector2[0]))
+                      ))
+        return z_coord
+
+    def _get_to_length(vec, num):
+        for dim in [0,1]:
+            value = vec[dim][0]
+            vec[dim] = [value for i in range(num)]
+        return vec
+
+    #make input mappable against each other
+    max_len = max(len(line_start[0]), len(line_end[0]), len(point[0]))
+    if len(line_start[0]) == 1:
+        line_start = _get_to_length(line_start, max_len)
+    if len(line_end[0]) == 1:
+        line_end = _get_to_length(line_end, max_len)
+    if len(point[0]) == 1:
+        point = _get_to_length(point, max_len)
+
+    vec_line = [list(map(sub,le,ls)) for le,ls in zip(line_end, line_start)]
+    vec_line_to_point = [list(map(sub,pt,ls)) for pt,ls in zip(point, line_start)]
+    z_coord = __crossproduct_z__(vec_line, vec_line_to_point)
+    return [z > 0.0 for z in z_coord]
+
+
+def ring_vertices(aperture):
+    # returns the vertices without the NaN separators of the rings and for
+    # every vertex the index of the previous vertex in its ring, i.e. the
+    # edges of all rings run from vertices[:, previous] to vertices.
+    # aperture has the shape (2, n_columns) or (2, n_columns, n_points)
+    vertices = np.asarray(aperture, dtype=float)
+    separator = np.isnan(vertices).reshape(2, vertices.shape[1], -1).any(axis=(0, 2))
+    if not np.any(separator):
+        # a single ring, the vertices (e.g. memory-mapped) are not copied
+        return vertices, np.roll(np.arange(vertices.shape[1]), 1)
+    vertices = vertices[:, ~separator]
+    ring = np.cumsum(separator)[~separator]
+    n_vertices = len(ring)
+    previous = np.arange(n_vertices) - 1
+    first = np.flatnonzero(np.diff(ring, prepend=-1) != 0)
+    last = np.append(first[1:], n_vertices) - 1
+    previous[first] = last
+    return vertices, previous
+
+
+def inside_from_crossings(lines_intersect, aper_1_is_right, fill_rule):
+    # lines_intersect marks the edges (axis 0) crossed by the line from each
+    # point to the reference point outside the aperture
+    if fill_rule == "evenodd":
+        return np.sum(lines_intersect, axis=0) % 2 == 1
+    _check_fill_rule(fill_rule)
+    # the crossings are counted with the direction of the edge, which
+    # gives the winding number (the reference point has winding number 0)
+    winding = np.sum(np.where(aper_1_is_right, 1, -1)*lines_intersect, axis=0)
+    return winding != 0
+
+
+def _check_fill_rule(fill_rule):
+    if fill_rule not in fill_rules:
+        raise ValueError(f"fill_rule must be one of {fill_rules}, not {fill_rule!r}")
+
+
+def _contains(aper_1, aper_2, refpoint, refpoint_is_right, coords, fill_rule):
+    particle_is_right = np_is_right_of(aper_1, aper_2, coords)
+    aper_1_is_right = np_is_right_of(coords, refpoint, aper_1)
+    aper_2_is_right = np_is_right_of(coords, refpoint, aper_2)
+    lines_intersect = ((particle_is_right ^ refpoint_is_right)
+                       & (aper_1_is_right ^ aper_2_is_right))
+    return inside_from_crossings(lines_intersect, aper_1_is_right, fill_rule)
+
+
+def polygon_contains(aperture, x, y, refpoint=None, fill_rule="evenodd"):
+    # vectorized version of the LimitPolygon check, returns a bool array.
+    # aperture has the shape (2, n_columns) or (2, n_columns, n_points)
+    # for a separate polygon per point, rings are separated by NaN columns
+    vertices, previous = ring_vertices(aperture)
+    aper_1 = vertices
+    if aper_1.ndim == 2:
+        aper_1 = np.expand_dims(aper_1, axis=2)
+    aper_2 = aper_1[:, previous]
+    if refpoint is None:
+        refpoint = 1.1*np.max(np.abs(aper_1), axis=1, keepdims=True)
+    coords = np.array([[x], [y]], dtype=float)
+    refpoint_is_right = np_is_right_of(aper_1, aper_2, refpoint)
+    return _contains(aper_1, aper_2, refpoint, refpoint_is_right, coords,
+                     fill_rule)
+
+
+def is_convex(aperture):
+    # all turns between neighbouring edges go the same way and the
+    # boundary goes around only once (apertures with several rings are
+    # never convex)
+    vertices = np.asarray(aperture, dtype=float)
+    if np.any(np.isnan(vertices)):
+        return False
+    edges = np.roll(vertices, -1, axis=1) - vertices
+    edges = edges[:, np.any(edges != 0, axis=0)]
+    next_edges = np.roll(edges, -1, axis=1)
+    cross = edges[0]*next_edges[1] - edges[1]*next_edges[0]
+    if np.any(cross > 0) and np.any(cross < 0):
+        return False
+    dot = edges[0]*next_edges[0] + edges[1]*next_edges[1]
+    total_turn = np.sum(np.arctan2(cross, dot))
+    return bool(abs(abs(total_turn) - 2*np.pi) < 1e-6)
+
+
+def _boundary_samples(vertices):
+    # the vertices and points along the edges, a chord deviates most
+    # from a curved boundary between its ends
+    rolled = np.roll(vertices, -1, axis=1)
+    return np.concatenate([vertices + tt*(rolled - vertices)
+                           for tt in [0.0, 0.25, 0.5, 0.75]], axis=1)
+
+
+def _ellipse_deviation(x, y, a, b):
+    # distance to the ellipse along the ray from the origin, positive outside
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.sqrt((x/a)**2 + (y/b)**2)
+        return np.where(scale > 0, np.hypot(x, y)*(1 - 1/scale), -np.inf)
+
+
+def match_native_shape(aperture, tolerance):
+    # checks if the polygon is a rectangle, an ellipse (centred at the
+    # origin) or a rectellipse within tolerance, i.e. if no point of its
+    # boundary is further than tolerance from the boundary of that shape.
+    # Returns the name and the parameters of the matching pysixtrack
+    # element, cheapest first, or None.
+    vertices = np.asarray(aperture, dtype=float)
+    if vertices.shape[1] < 3 or not is_convex(vertices):
+        return None
+    x, y = _boundary_samples(vertices)
+    min_x, max_x = vertices[0].min(), vertices[0].max()
+    min_y, max_y = vertices[1].min(), vertices[1].max()
+
+    deviation = np.max([x - max_x, min_x - x, y - max_y, min_y - y], axis=0)
+    if np.all(np.abs(deviation) <= tolerance):
+        return "LimitRect", dict(min_x=min_x, max_x=max_x,
+                                 min_y=min_y, max_y=max_y)
+
+    if abs(max_x + min_x) > 2*tolerance or abs(max_y + min_y) > 2*tolerance:
+        return None
+    half_x = (max_x - min_x)/2
+    half_y = (max_y - min_y)/2
+    deviation = _ellipse_deviation(x, y, half_x, half_y)
+    if np.all(np.abs(deviation) <= tolerance):
+        return "LimitEllipse", dict(a=half_x, b=half_y)
+
+    # the ellipse of a rectellipse is fitted to the vertices off the
+    # straight sides
+    on_ellipse = ((np.abs(vertices[0]) < half_x - tolerance)
+                  & (np.abs(vertices[1]) < half_y - tolerance))
+    if np.sum(on_ellipse) < 2:
+        return None
+    inv_a2, inv_b2 = np.linalg.lstsq(vertices[:, on_ellipse].T**2,
+                                     np.ones(np.sum(on_ellipse)), rcond=None)[0]
+    if inv_a2 <= 0 or inv_b2 <= 0:
+        return None
+    a, b = 1/np.sqrt(inv_a2), 1/np.sqrt(inv_b2)
+    deviation = np.maximum(np.maximum(np.abs(x) - half_x, np.abs(y) - half_y),
+                           _ellipse_deviation(x, y, a, b))
+    if np.all(np.abs(deviation) <= tolerance):
+        return "LimitRectEllipse", dict(max_x=half_x, max_y=half_y, a=a, b=b)
+    return None
+
+
+def _crosses_edges(start, end, vertices, rolled):
+    # True if the segment start-end properly crosses any of the edges
+    # vertices-rolled (touching a vertex or an edge is not a crossing)
+    def cross_z(origin, point1, point2):
+        return ((point1[0] - origin[0])*(point2[1] - origin[1])
+                - (point1[1] - origin[1])*(point2[0] - origin[0]))
+    side_start = cross_z(vertices, rolled, start)
+    side_end = cross_z(vertices, rolled, end)
+    side_vertex = cross_z(start, end, vertices)
+    side_rolled = cross_z(start, end, rolled)
+    return bool(np.any((side_start*side_end < 0) & (side_vertex*side_rolled < 0)))
+
+
+def simplify_polygon(aperture, max_deviation):
+    # Douglas-Peucker simplification which only cuts corners inwards: a
+    # chord replaces the vertices in between only if they all lie outside
+    # of it (or on it), not further than max_deviation, and if it does not
+    # cross the original boundary. The simplified polygon therefore always
+    # lies inside the original one.
+    vertices = np.asarray(aperture, dtype=float)
+    n_vertices = vertices.shape[1]
+    if n_vertices <= 3 or np.any(np.isnan(vertices)):
+        # apertures with several rings are not simplified
+        return vertices
+    rolled = np.roll(vertices, -1, axis=1)
+    # the inside is left of the edges of counter-clockwise polygons
+    area = np.sum(vertices[0]*rolled[1] - rolled[0]*vertices[1])
+    orientation = 1.0 if area > 0 else -1.0
+
+    # the ring is split into two chains at vertex 0 and the vertex
+    # furthest from it, indices beyond n_vertices wrap around
+    far = int(np.argmax(np.hypot(*(vertices - vertices[:, :1]))))
+    keep = np.zeros(n_vertices, dtype=bool)
+    keep[[0, far]] = True
+    stack = [(0, far), (far, n_vertices)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start = vertices[:, first]
+        end = vertices[:, last % n_vertices]
+        inner = vertices[:, first + 1:last]
+        chord = end - start
+        chord_length = np.hypot(*chord)
+        if chord_length == 0:
+            distance = np.hypot(*(inner - start[:, None]))
+            accept = False
+        else:
+            # signed distance from the chord, positive on the inner side
+            distance = orientation*(chord[0]*(inner[1] - start[1])
+                                    - chord[1]*(inner[0] - start[0]))/chord_length
+            accept = (np.all(distance <= 0) and np.all(-distance <= max_deviation)
+                      and not _crosses_edges(start[:, None], end[:, None],
+                                             vertices, rolled))
+        if not accept:
+            # vertices on the inner side will have to stay, the innermost
+            # one is the best split point, otherwise the furthest one
+            if np.any(distance > 0):
+                split = first + 1 + int(np.argmax(distance))
+            else:
+                split = first + 1 + int(np.argmax(np.abs(distance)))
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    if np.sum(keep) < 3:
+        return vertices
+    return vertices[:, keep]
+
+
+def as_readonly_vertices(aperture):
+    # float array of the vertices which can safely be shared between elements
+    # (float arrays, e.g. memory-mapped ones, are not copied)
+    vertices = np.asarray(aperture, dtype=float)
+    if vertices.ndim != 2 or vertices.shape[0] != 2:
+        raise ValueError("Polygon aperture must have the shape (2, n_vertices)")
+    if vertices.flags.writeable:
+        if vertices is aperture:
+            vertices = vertices.copy()
+        vertices.flags.writeable = False
+    return vertices
@@ -0,0 +1,197 @@
+'''
+This module tracks large particle sets through lines containing
+CollimationToolKit elements on several cores.
+
+The particles are split into contiguous shards, which are tracked in a
+process pool. All per-particle arrays are put into one shared memory block
+(inherited by the worker processes, nothing is pickled), the workers track
+their shard element by element for the requested number of turns and write
+the surviving particles back into their part of the block. Surviving
+particles are returned in their original order, together with one record per
+lost particle (where and when it was lost) and the number of losses per
+element.
+
+Scatter functions using np.random get an independent random state per shard,
+derived from the seed, so results do not depend on the number of processes.
+'''
+
+import os
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pysixtrack
+
+
+# columns of the loss records
+loss_fields = ["index", "partid", "turn", "element", "x", "px", "y", "py",
+               "zeta", "delta", "s"]
+
+# set in the worker processes by _init_worker()
+_worker_state = {}
+
+
+class TrackingResult(object):
+    def __init__(self, particles, losses, element_names):
+        # particles: surviving particles in their original order
+        # losses: dict of arrays, see loss_fields, sorted by turn, element
+        #         and original index ("index")
+        self.particles = particles
+        self.losses = losses
+        self.element_names = element_names
+        self.lost_per_element = np.bincount(losses["element"],
+                                            minlength=len(element_names))
+
+    @property
+    def n_lost(self):
+        return len(self.losses["index"])
+
+
+def _per_particle_arrays(particles):
+    n_part = len(particles.state)
+    return {key: value for key, value in particles.__dict__.items()
+            if isinstance(value, np.ndarray) and value.shape == (n_part,)}
+
+
+def _shared_block(arrays):
+    # one shared block for all arrays, returns the block and the layout
+    # {key: (dtype, offset)}
+    layout = {}
+    offset = 0
+    for key, value in arrays.items():
+        layout[key] = (value.dtype.str, offset)
+        offset += value.nbytes
+        offset += (-offset) % 8     # keep all arrays aligned
+    block = multiprocessing.RawArray('b', max(offset, 1))
+    return block, layout
+
+
+def _shared_views(block, layout, n_part):
+    return {key: np.frombuffer(block, dtype=dtype, count=n_part, offset=offset)
+            for key, (dtype, offset) in layout.items()}
+
+
+def _init_worker(block, layout, n_part, template, elements):
+    _worker_state["views"] = _shared_views(block, layout, n_part)
+    _worker_state["template"] = template
+    _worker_state["elements"] = elements
+
+
+def _track_shard(start, stop, n_turns, seed):
+    views = _worker_state["views"]
+    elements = _worker_state["elements"]
+    np.random.seed(seed)
+
+    particles = pysixtrack.Particles()
+    particles.__dict__.update(_worker_state["template"])
+    for key, view in views.items():
+        particles.__dict__[key] = view[start:stop].copy()
+    particles.lost_particles = []
+    # remove_lost_particles() has to keep all per-particle arrays aligned,
+    # including the original index and e.g. Z and A of ions
+    particles._shard_index = np.arange(start, stop)
+    particles._dict_vars = tuple(pysixtrack.Particles._dict_vars) + tuple(
+        key for key in views if not key.startswith('_')
+        and key not in pysixtrack.Particles._dict_vars
+    ) + ("_shard_index",)
+
+    records = {field: [] for field in loss_fields}
+    def record_losses(turn, element_idx):
+        for lost in particles.lost_particles:
+            n_lost = len(lost._shard_index)
+            records["index"].append(lost._shard_index)
+            records["partid"].append(np.broadcast_to(lost.partid, n_lost))
+            records["turn"].append(np.full(n_lost, turn))
+            records["element"].append(np.full(n_lost, element_idx))
+            for field in loss_fields[4:]:
+                records[field].append(np.broadcast_to(getattr(lost, field), n_lost))
+        # the records replace the lost particles, which would only pile up
+        particles.lost_particles.clear()
+
+    for turn in range(n_turns):
+        if len(particles.state) == 0:
+            break
+        for element_idx, element in enumerate(elements):
+            ret = element.track(particles)
+            record_losses(turn, element_idx)
+            if ret is not None:
+                break
+
+    # survivors go back to the beginning of the shard
+    n_alive = len(particles.state)
+    for key, view in views.items():
+        value = particles.__dict__.get(key)
+        if isinstance(value, np.ndarray) and value.shape == (n_alive,):
+            view[start:start + n_alive] = value
+        else:
+            view[start:start + n_alive] = np.broadcast_to(value, n_alive)
+    return n_alive, {field: np.concatenate(values) if values
+                     else np.zeros(0, dtype=np.int64 if field in loss_fields[:4]
+                                   else float)
+                     for field, values in records.items()}
+
+
+def track_parallel(line, particles, n_turns=1, n_processes=None, n_shards=None,
+                   seed=None):
+    # tracks particles (with per-particle arrays) through line for n_turns
+    # turns and returns a TrackingResult, particles itself is not changed.
+    # Elements must be picklable; with n_processes=1 everything runs in
+    # this process. Loss writers cannot be shared by the workers, the losses
+    # are returned instead (see LossWriter.push_records()).
+    if not hasattr(particles.state, "__iter__"):
+        raise ValueError("track_parallel() needs particles with array coordinates")
+    if n_processes is None:
+        n_processes = os.cpu_count()
+    if n_shards is None:
+        n_shards = n_processes
+    elements = list(line.elements)
+    if any(getattr(element, "loss_writer", None) is not None
+           for element in elements):
+        raise ValueError("track_parallel() cannot write losses through "
+                         "attached loss writers, detach them with "
+                         "attach_loss_writer(line, None)")
+    element_names = list(getattr(line, "element_names",
+                                 [str(ii) for ii in range(len(elements))]))
+
+    arrays = _per_particle_arrays(particles)
+    n_part = len(particles.state)
+    template = {key: value for key, value in particles.__dict__.items()
+                if key not in arrays and key != "lost_particles"}
+    block, layout = _shared_block(arrays)
+    views = _shared_views(block, layout, n_part)
+    for key, value in arrays.items():
+        views[key][:] = value
+
+    bounds = np.linspace(0, n_part, n_shards + 1).astype(int)
+    shard_seeds = [child.generate_state(4)
+                   for child in np.random.SeedSequence(seed).spawn(n_shards)]
+    shard_args = [(int(start), int(stop), n_turns, shard_seed)
+                  for start, stop, shard_seed
+                  in zip(bounds[:-1], bounds[1:], shard_seeds)]
+
+    initargs = (block, layout, n_part, template, elements)
+    if n_processes == 1:
+        random_state = np.random.get_state()
+        _init_worker(*initargs)
+        results = [_track_shard(*args) for args in shard_args]
+        _worker_state.clear()
+        np.random.set_state(random_state)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                n_processes, initializer=_init_worker,
+                initargs=initargs) as pool:
+            futures = [pool.submit(_track_shard, *args) for args in shard_args]
+            results = [future.result() for future in futures]
+
+    # merge the shards
+    alive = np.concatenate([np.arange(start, start + n_alive)
+                            for (start, stop, n_turns, shard_seed), (n_alive, records)
+                            in zip(shard_args, results)]).astype(int)
+    survivors = particles.copy()
+    survivors.lost_particles = []
+    for key, view in views.items():
+        survivors.__dict__[key] = view[alive].copy()
+    losses = {field: np.concatenate([records[field] for n_alive, records in results])
+              for field in loss_fields}
+    order = np.lexsort((losses["index"], losses["element"], losses["turn"]))
+    losses = {field: values[order] for field, values in losses.items()}
+    return TrackingResult(survivors, losses, element_names)
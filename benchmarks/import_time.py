@@ -0,0 +1,62 @@
+'''
+Measures the time needed to import CollimationToolKit (and parts of it) in
+fresh interpreters, as paid by every short-lived worker process.
+
+    python benchmarks/import_time.py [--repeat N]
+
+Reports the median wall time per import statement and the modules which
+take the most time according to python -X importtime.
+'''
+
+import argparse
+import subprocess
+import sys
+import time
+
+
+statements = [
+    "import numpy",
+    "import CollimationToolKit",
+    "from CollimationToolKit import aperture_files",
+    "import pysixtrack",
+    "import CollimationToolKit as ctk; ctk.elements",
+    "import CollimationToolKit as ctk; ctk.ScatterFunctions.GLOBAL",
+]
+
+
+def time_import(statement, repeat):
+    times = []
+    for ii in range(repeat):
+        t_start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        times.append(time.perf_counter() - t_start)
+    return sorted(times)[len(times)//2]
+
+
+def slowest_modules(statement, n_modules=5):
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                            check=True, capture_output=True, text=True).stderr
+    modules = {}
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            if self_us.strip().isdigit():
+                name = name.strip()
+                modules[name] = max(modules.get(name, 0), int(cumulative_us))
+    return sorted(((us, name) for name, us in modules.items()),
+                  reverse=True)[:n_modules]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = time_import("pass", args.repeat)
+    print(f"{'interpreter start-up':62s} {baseline*1e3:8.1f} ms")
+    for statement in statements:
+        print(f"{statement:62s} "
+              f"{(time_import(statement, args.repeat) - baseline)*1e3:8.1f} ms")
+    print("\nslowest modules of 'import CollimationToolKit as ctk; ctk.elements':")
+    for cumulative_us, name in slowest_modules(statements[4]):
+        print(f"    {name:50s} {cumulative_us/1e3:8.1f} ms")
@@ -0,0 +1,348 @@
+'''
+Throughput and peak memory of the CollimationToolKit elements and of the
+MAD-X loader, written as JSON so that results of different commits can be
+compared.
+
+    python benchmarks/run_benchmarks.py [--output results.json] [--quick]
+                                        [--select PATTERN] [--repeat N]
+                                        [--compare old_results.json]
+
+Every case is run --repeat times on fresh inputs (building the inputs is not
+timed) and once more under tracemalloc for the peak memory. The rate is
+taken from the fastest run, in particles/s for the elements and in
+elements/s for the loader. LimitRect and LimitEllipse from pysixtrack are
+included as baselines. The loader runs on synthetic sequences, MAD-X is not
+needed.
+
+With --compare, the rate and peak memory of every case are printed relative
+to the same case in an earlier result file.
+'''
+
+import argparse
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pysixtrack
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+repository = os.path.join(benchmark_dir, "..")
+sys.path.insert(0, repository)
+# the stand-ins for cpymad sequences are shared with the tests
+sys.path.insert(0, os.path.join(repository, "tests"))
+import CollimationToolKit as ctk
+from CollimationToolKit import aperture_files
+from CollimationToolKit.loader_mad import iter_from_madx_sequence_ctk
+from fake_sequence import FakeElement, FakeSequence
+
+
+full_sizes = {
+    "vertices": [4, 32, 256],
+    "particles": [1000, 10000, 100000],
+    "scalar_particles": 200,
+    "sequence_elements": [1000, 10000],
+}
+quick_sizes = {
+    "vertices": [4, 32],
+    "particles": [1000, 10000],
+    "scalar_particles": 20,
+    "sequence_elements": [200],
+}
+
+
+#-------------------------------------------------------------------------------
+#--- inputs ------------------------------------------------------------------
+#-------------------------------------------------------------------------------
+def make_particles(n_part, seed=0):
+    # uniform in a 6x6 cm square, i.e. partly outside of all apertures below
+    rng = np.random.RandomState(seed)
+    particles = pysixtrack.Particles(q0=28, mass0=238.02891*931.49410242e6)
+    particles.x = rng.uniform(-0.03, 0.03, n_part)
+    particles.px = rng.uniform(-1e-3, 1e-3, n_part)
+    particles.y = rng.uniform(-0.03, 0.03, n_part)
+    particles.py = rng.uniform(-1e-3, 1e-3, n_part)
+    particles.state = np.ones(n_part, dtype=int)
+    particles.partid = np.arange(n_part)
+    particles.Z = 92
+    return particles
+
+
+def make_scalar_particles(n_part, seed=0):
+    particles = make_particles(n_part, seed)
+    scalar_particles = []
+    for ii in range(n_part):
+        particle = pysixtrack.Particles(q0=28, mass0=particles.mass0,
+                                        x=particles.x[ii], px=particles.px[ii],
+                                        y=particles.y[ii], py=particles.py[ii])
+        particle.state = 1
+        particle.Z = 92
+        scalar_particles.append(particle)
+    return scalar_particles
+
+
+def regular_polygon(n_vertices, radius=0.02):
+    # clockwise, as the aperture files
+    angle = -np.linspace(0, 2*np.pi, n_vertices, endpoint=False)
+    return [list(radius*np.cos(angle)), list(radius*np.sin(angle))]
+
+
+def make_elements(n_vertices):
+    return {
+        "LimitRect": pysixtrack.elements.LimitRect(min_x=-0.02, max_x=0.02,
+                                                   min_y=-0.02, max_y=0.02),
+        "LimitEllipse": pysixtrack.elements.LimitEllipse(a=0.02, b=0.02),
+        "LimitPolygon": ctk.elements.LimitPolygon(
+            aperture=regular_polygon(n_vertices)),
+        "LimitPolygon_low_precision": ctk.elements.LimitPolygon(
+            aperture=regular_polygon(n_vertices), low_precision=True),
+    }
+
+
+def make_sequence(n_elements, aper_dir, n_profiles=10):
+    # quadrupoles with circular, monitors with rectangular apertures and
+    # collimators with one of n_profiles polygon aperture files
+    aper_paths = []
+    for ii in range(n_profiles):
+        aper_path = os.path.join(aper_dir, "profile%d.aper" % ii)
+        with open(aper_path, 'w') as aper_file:
+            for x, y in zip(*regular_polygon(16 + ii, 0.02 + ii*1e-3)):
+                aper_file.write("%r   %r\n" % (x, y))
+        aper_paths.append(aper_path)
+
+    elements = []
+    for ii in range(n_elements // 4):
+        at = ii*2.0
+        elements.append(FakeElement("m%d" % ii, "marker", at))
+        elements.append(FakeElement("bpm%d" % ii, "monitor", at + 0.5,
+                                    apertype="rectangle",
+                                    aperture=[0.02, 0.015]))
+        elements.append(FakeElement("mq%d" % ii, "multipole", at + 1.0,
+                                    knl=[0.0, (-1)**ii * 0.05], ksl=[0.0],
+                                    lrad=0.0, apertype="circle",
+                                    aperture=[0.025]))
+        elements.append(FakeElement("tcp%d" % ii, "marker", at + 1.5,
+                                    apertype=aper_paths[ii % n_profiles]))
+    return FakeSequence(elements, (n_elements // 4)*2.0 + 1.0)
+
+
+#-------------------------------------------------------------------------------
+#--- cases -------------------------------------------------------------------
+#-------------------------------------------------------------------------------
+class Case(object):
+    def __init__(self, name, params, n_items, unit, setup, run):
+        # setup() returns the arguments of run(), which is timed
+        self.name = name
+        self.params = params
+        self.n_items = n_items
+        self.unit = unit
+        self.setup = setup
+        self.run = run
+
+    @property
+    def key(self):
+        return "/".join([self.name] + ["%s=%s" % (kk, vv)
+                                       for kk, vv in self.params.items()])
+
+
+def track_vector(element, particles):
+    element.track(particles)
+
+
+def track_scalar(element, particles):
+    for particle in particles:
+        element.track(particle)
+
+
+def load_sequence(sequence, options):
+    for name, element in iter_from_madx_sequence_ctk(sequence, **options):
+        pass
+
+
+def aperture_cases(sizes):
+    cases = []
+    for n_vertices in sizes["vertices"]:
+        elements = make_elements(n_vertices)
+        names = ["LimitPolygon", "LimitPolygon_low_precision"]
+        if n_vertices == sizes["vertices"][0]:
+            names = ["LimitRect", "LimitEllipse"] + names
+        for name in names:
+            element = elements[name]
+            params = ({} if name in ["LimitRect", "LimitEllipse"]
+                      else {"vertices": n_vertices})
+            for n_part in sizes["particles"]:
+                cases.append(Case(name, dict(params, mode="vector", particles=n_part),
+                                  n_part, "particles",
+                                  lambda n_part=n_part: (make_particles(n_part),),
+                                  lambda particles, element=element:
+                                      track_vector(element, particles)))
+            if name == "LimitPolygon_low_precision":
+                continue    # only used for vector particles
+            n_part = sizes["scalar_particles"]
+            cases.append(Case(name, dict(params, mode="scalar", particles=n_part),
+                              n_part, "particles",
+                              lambda n_part=n_part: (make_scalar_particles(n_part),),
+                              lambda particles, element=element:
+                                  track_scalar(element, particles)))
+    return cases
+
+
+def foil_cases(sizes):
+    cases = []
+    for scatter in [ctk.elements.default_scatter, ctk.elements.test_strip_ions]:
+        foil = ctk.elements.LimitFoil(min_x=-0.015, scatter=scatter)
+        name = "LimitFoil_" + scatter.__name__
+        for n_part in sizes["particles"]:
+            cases.append(Case(name, {"mode": "vector", "particles": n_part},
+                              n_part, "particles",
+                              lambda n_part=n_part: (make_particles(n_part),),
+                              lambda particles, foil=foil:
+                                  track_vector(foil, particles)))
+        n_part = sizes["scalar_particles"]
+        cases.append(Case(name, {"mode": "scalar", "particles": n_part},
+                          n_part, "particles",
+                          lambda n_part=n_part: (make_scalar_particles(n_part),),
+                          lambda particles, foil=foil:
+                              track_scalar(foil, particles)))
+    return cases
+
+
+def loader_cases(sizes, aper_dir):
+    variants = {
+        "plain": {},
+        "apertures": {"install_apertures": True},
+        "apertures_merged": {"install_apertures": True, "merge_drifts": True,
+                             "thin_apertures": True},
+    }
+    cases = []
+    for n_elements in sizes["sequence_elements"]:
+        sequence = make_sequence(n_elements, aper_dir)
+        for variant, options in variants.items():
+            def setup(sequence=sequence, options=options):
+                # every run reads the aperture files again
+                aperture_files.clear_aperture_file_cache()
+                return sequence, options
+            cases.append(Case("iter_from_madx_sequence_ctk",
+                              {"variant": variant, "elements": n_elements},
+                              len(sequence.elements), "elements",
+                              setup, load_sequence))
+    return cases
+
+
+#-------------------------------------------------------------------------------
+#--- measurement -------------------------------------------------------------
+#-------------------------------------------------------------------------------
+def measure(case, repeat):
+    times = []
+    for ii in range(repeat):
+        args = case.setup()
+        t_start = time.perf_counter()
+        case.run(*args)
+        times.append(time.perf_counter() - t_start)
+
+    # peak memory of a separate run, inputs allocated before are not counted
+    args = case.setup()
+    tracemalloc.start()
+    case.run(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        "key": case.key,
+        "name": case.name,
+        "params": case.params,
+        "unit": case.unit,
+        "n_items": case.n_items,
+        "time_best": times[0],
+        "time_median": times[len(times)//2],
+        "rate": case.n_items / max(times[0], 1e-12),
+        "peak_memory": peak,
+    }
+
+
+def git_commit():
+    repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(args):
+    return {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pysixtrack": getattr(pysixtrack, "__version__", None),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "quick": args.quick,
+        "repeat": args.repeat,
+    }
+
+
+def compare(results, old_filename):
+    with open(old_filename) as old_file:
+        old_results = {result["key"]: result for result in json.load(old_file)["results"]}
+    print("\n%-70s %10s %10s" % ("compared to " + old_filename, "rate", "memory"))
+    for result in results:
+        old = old_results.get(result["key"])
+        if old is None:
+            continue
+        print("%-70s %9.2fx %9.2fx" % (result["key"], result["rate"] / old["rate"],
+                                       result["peak_memory"] / max(old["peak_memory"], 1)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output",
+                        default=os.path.join(benchmark_dir, "results",
+                                             "benchmark_results.json"),
+                        help="JSON file for the results (default: "
+                             "benchmarks/results/benchmark_results.json)")
+    parser.add_argument("--quick", action="store_true",
+                        help="small sizes only, e.g. as a smoke test")
+    parser.add_argument("--select", default="*",
+                        help="only run cases whose key matches this pattern")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--compare", default=None,
+                        help="earlier JSON result file to compare with")
+    args = parser.parse_args()
+
+    sizes = quick_sizes if args.quick else full_sizes
+    aper_dir = tempfile.mkdtemp()
+    try:
+        cases = (aperture_cases(sizes) + foil_cases(sizes)
+                 + loader_cases(sizes, aper_dir))
+        cases = [case for case in cases if fnmatch.fnmatch(case.key, args.select)]
+        results = []
+        for case in cases:
+            result = measure(case, args.repeat)
+            print("%-70s %12.4g %s/s %10.1f MiB" % (
+                result["key"], result["rate"], result["unit"],
+                result["peak_memory"] / 2**20))
+            results.append(result)
+    finally:
+        shutil.rmtree(aper_dir)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w') as output_file:
+        json.dump({"metadata": metadata(args), "results": results}, output_file,
+                  indent=1)
+    print("results written to " + args.output)
+    if args.compare is not None:
+        compare(results, args.compare)
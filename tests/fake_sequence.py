@@ -0,0 +1,40 @@
+'''
+Stand-ins for cpymad sequences and aperture files, shared by the loader and
+line cache tests and the benchmarks (no MAD-X needed). This is a plain
+helper module, not a test module.
+'''
+
+
+#-------------------------------------------------------------------------------
+#--- minimal stand-in for cpymad sequences (no MAD-X needed) ----------------
+#-------------------------------------------------------------------------------
+class FakeElement(object):
+    def __init__(self, name, base_type, at, **attrs):
+        self.name = name
+        self.base_type = self
+        self.parent = self
+        self.at = at
+        self.l = 0.0
+        self.apertype = "circle"
+        self.aperture = [0.0]
+        self.__dict__.update(attrs)
+        if base_type != name:
+            self.base_type = FakeElement(base_type, base_type, 0.0)
+
+
+class FakeSequence(object):
+    def __init__(self, elements, length):
+        self.elements = elements
+        self.length = length
+
+    def element_positions(self):
+        return [ee.at for ee in self.elements]
+
+
+def write_aper_file(filename, aperture):
+    with open(filename,'w') as aper_file:
+        for x, y in zip(*aperture):
+            aper_file.write(str(x) + '   ' + str(y) + '\n')
+
+
+square = [[0.02, 0.02, -0.02, -0.02], [0.02, -0.02, -0.02, 0.02]]
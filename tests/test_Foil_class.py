@@ -59,6 +59,23 @@ def test_foil_testfunction():
     assert p_testscatter.chi == p_testscatter.qratio
 
 
+def test_foil_testfunction_vec():
+    stripperfoil_test = ctk.elements.LimitFoil(
+            min_x=foil_min_x,
+            scatter=ctk.elements.test_strip_ions)
+
+    p_vec = pysixtrack.Particles(q0=28, mass0 = 238.02891*931.49410242e6)
+    p_vec.x = np.array([-0.12, 0.0, -0.12])
+    p_vec.y = np.array([0.02, 0.02, 0.0])
+    p_vec.state = np.ones_like(p_vec.x, dtype=int)
+    p_vec.Z = 92
+
+    stripperfoil_test.track(p_vec)
+
+    assert np.array_equal(p_vec.qratio, [91/28, 1.0, 91/28])
+    assert np.array_equal(p_vec.chi, p_vec.qratio)
+
+
 
 #-------------------------------------------------------------------------------
 #--- Foil with GLOBAL charge exchange code as scatter function---------------
@@ -127,3 +144,119 @@ def test_GLOBAL_vec():
             assert p_vec.delta[ii] == 0.0
     assert np.array_equal(p_vec.chi, p_vec.qratio)
 
+
+
+
+#-------------------------------------------------------------------------------
+#--- Scan over foil positions ------------------------------------------------
+#-------------------------------------------------------------------------------
+def test_foil_scan():
+    foil = ctk.elements.LimitFoil(min_x=foil_min_x)
+    N_part = 1000
+    p_vec = pysixtrack.Particles()
+    p_vec.x = np.random.uniform(low=-3e-1, high=3e-1, size=N_part)
+    p_vec.y = np.random.uniform(low=-3e-1, high=3e-1, size=N_part)
+    p_vec.state = np.ones_like(p_vec.x, dtype=int)
+
+    gaps = np.linspace(-0.2, 0.0, 5)
+    hits = foil.scan(p_vec, min_x=gaps)
+    assert hits.shape == (5, N_part)
+    assert len(p_vec.x) == N_part
+    for min_x, hit in zip(gaps, hits):
+        p_track = p_vec.copy()
+        p_track.lost_particles = []
+        p_track.partid = np.arange(N_part)
+        ctk.elements.LimitFoil(min_x=min_x).track(p_track)
+        assert np.array_equal(np.where(~hit)[0], p_track.partid)
+
+
+#-------------------------------------------------------------------------------
+#--- Polygonal and elliptical openings ---------------------------------------
+#-------------------------------------------------------------------------------
+# triangle and a rotated rectangle
+foil_openings = [
+    np.array([[0.03, -0.02, -0.02], [0.0, 0.025, -0.025]]),
+    np.array([[0.02, -0.02, -0.02, 0.02], [0.01, 0.01, -0.01, -0.01]]),
+]
+
+
+def make_foil_particles(N_part=5000):
+    p_vec = pysixtrack.Particles()
+    p_vec.x = np.random.uniform(low=-3e-2, high=3e-2, size=N_part)
+    p_vec.y = np.random.uniform(low=-3e-2, high=3e-2, size=N_part)
+    p_vec.state = np.ones_like(p_vec.x, dtype=int)
+    p_vec.partid = np.arange(N_part)
+    return p_vec
+
+
+def record_hits(recorded):
+    def scatter(self, particle, idx=[]):
+        recorded.append(np.array(idx))
+    return scatter
+
+
+@pytest.mark.parametrize("tilt", [0.0, 0.3])
+@pytest.mark.parametrize("opening", foil_openings)
+def test_foil_polygon(opening, tilt):
+    foil = ctk.elements.LimitFoil(aperture=opening, tilt=tilt)
+    p_foil = make_foil_particles()
+    p_poly = p_foil.copy()
+    p_poly.lost_particles = []
+    p_inside = p_foil.copy()
+    p_inside.lost_particles = []
+
+    foil.track(p_foil)
+    # the opening rotates with the foil, i.e. the particles rotate back
+    x, y = p_poly.x, p_poly.y
+    p_poly.x = np.cos(tilt)*x + np.sin(tilt)*y
+    p_poly.y = np.cos(tilt)*y - np.sin(tilt)*x
+    ctk.elements.LimitPolygon(aperture=opening).track(p_poly)
+    assert 0 < len(p_foil.partid) < 5000
+    assert np.array_equal(p_foil.partid, p_poly.partid)
+
+    # the foil covering the opening stops the complement
+    ctk.elements.LimitFoil(aperture=opening, tilt=tilt,
+                           hit_inside=True).track(p_inside)
+    assert np.array_equal(
+        np.sort(np.concatenate([p_inside.partid, p_foil.partid])),
+        np.arange(5000))
+
+
+def test_foil_ellipse():
+    foil = ctk.elements.LimitFoil(a=0.02, b=0.01)
+    p_foil = make_foil_particles()
+    p_ellipse = p_foil.copy()
+    p_ellipse.lost_particles = []
+    foil.track(p_foil)
+    pysixtrack.elements.LimitEllipse(a=0.02, b=0.01).track(p_ellipse)
+    assert np.array_equal(p_foil.partid, p_ellipse.partid)
+
+
+def test_foil_shape_hits_once():
+    recorded = []
+    foil = ctk.elements.LimitFoil(aperture=foil_openings[0],
+                                  scatter=record_hits(recorded))
+    p_vec = make_foil_particles()
+    foil.track(p_vec)
+    assert len(recorded) == 1
+    assert np.array_equal(recorded[0],
+                          np.where(foil.hits(p_vec.x, p_vec.y))[0])
+
+    # no call without hit particles
+    p_vec.x = np.zeros(5000)
+    p_vec.y = np.zeros(5000)
+    foil.track(p_vec)
+    assert len(recorded) == 1
+
+    p_scalar = pysixtrack.Particles(x=0.029, y=0.02)
+    foil.track(p_scalar)
+    assert len(recorded) == 2
+
+    with pytest.raises(ValueError):
+        ctk.elements.LimitFoil(aperture=foil_openings[0], a=0.01, b=0.01)
+    # an ellipse needs both semiaxes
+    for a, b in [(0.02, 0.0), (0.0, 0.01), (0.02, -0.01)]:
+        with pytest.raises(ValueError):
+            ctk.elements.LimitFoil(a=a, b=b)
+    with pytest.raises(ValueError):
+        foil.scan(p_vec, min_x=[0.0])
@@ -1,6 +1,7 @@
 import pytest
 import numpy as np
 import os
+import json
 import shutil
 import pysixtrack
 import CollimationToolKit as ctk
@@ -243,6 +244,8 @@ def test_Polygon_mad_loader():
     '''.format(tmpdir,tmpdir))
             
     seq = madx.sequence.testseq
+    ctk.patch_pysixtrack_loader()
+    ctk.patch_pysixtrack_loader()   # must not break anything if repeated
     testline = pysixtrack.Line.from_madx_sequence(seq,install_apertures=True)
     poly_aper_mad = testline.elements[3]
     madx.input('stop;')
@@ -270,3 +273,393 @@ def test_Polygon_mad_loader():
     
     
 
+
+
+#-------------------------------------------------------
+#----Test aperture file cache---------------------------
+#-------------------------------------------------------
+def test_aperture_file_cache(tmp_path):
+    from CollimationToolKit.aperture_files import load_aperture_geometry
+
+    aper_path = tmp_path / 'test_poly_cache.aper'
+    with open(aper_path,'w') as aper_file:
+        for row in aper_array:
+            aper_file.write(str(row[0]) + '   ' + str(row[1]) + '\n')
+
+    geometry = load_aperture_geometry(str(aper_path))
+    assert load_aperture_geometry(str(aper_path)) is geometry
+    assert np.array_equal(geometry.aperture, mypolygon)
+    assert not geometry.aperture.flags.writeable
+
+    # elements sharing a profile share the geometry
+    poly_1 = ctk.elements.LimitPolygon.from_geometry(geometry)
+    poly_2 = ctk.elements.LimitPolygon.from_geometry(geometry)
+    assert poly_1.get_geometry() is poly_2.get_geometry()
+
+    p_vec_poly = pysixtrack.Particles()
+    p_vec_poly.x = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    p_vec_poly.y = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    p_vec_poly.state = np.ones_like(p_vec_poly.x, dtype=int)
+    p_vec_rect = p_vec_poly.copy()
+    poly_1.track(p_vec_poly)
+    rect_aper.track(p_vec_rect)
+    assert np.array_equal(p_vec_poly.state,p_vec_rect.state)
+
+    # a changed file is parsed again
+    with open(aper_path,'a') as aper_file:
+        aper_file.write(str(aper_min_x) + '   ' + str(0.0) + '\n')
+    assert load_aperture_geometry(str(aper_path)) is not geometry
+
+
+def test_geometry_cache():
+    aperture = [list(row) for row in mypolygon]
+    poly = ctk.elements.LimitPolygon(aperture=aperture)
+    p_vec = pysixtrack.Particles()
+    p_vec.x = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    p_vec.y = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    p_vec.state = np.ones_like(p_vec.x, dtype=int)
+    p_rect = p_vec.copy()
+    poly.track(p_vec)
+    rect_aper.track(p_rect)
+    assert np.array_equal(p_vec.state, p_rect.state)
+
+    # tracking leaves the aperture as it was given
+    assert poly.aperture is aperture
+    assert poly == ctk.elements.LimitPolygon(aperture=[list(row) for row in mypolygon])
+    as_dict = json.loads(json.dumps(poly.to_dict()))
+    assert ctk.elements.LimitPolygon.from_dict(as_dict) == poly
+    geometry = poly.get_geometry()
+    assert poly.get_geometry() is geometry
+    assert not geometry.aperture.flags.writeable
+
+    # changes in place and replaced apertures give a new geometry
+    poly.aperture[0][0] = 0.04
+    assert poly.get_geometry() is not geometry
+    assert poly.get_geometry().aperture[0][0] == 0.04
+    poly.aperture = 2*mypolygon
+    assert np.array_equal(poly.get_geometry().aperture, 2*mypolygon)
+
+
+#-------------------------------------------------------
+#----Test binary aperture files and libraries-----------
+#-------------------------------------------------------
+def test_binary_aperture_files(tmp_path):
+    from CollimationToolKit import aperture_files
+
+    text_path = str(tmp_path / 'test_poly.aper')
+    with open(text_path,'w') as aper_file:
+        for row in aper_array:
+            aper_file.write(str(row[0]) + '\t' + str(row[1]) + '\n')
+    npy_path = str(tmp_path / 'test_poly.npy')
+    npz_path = str(tmp_path / 'test_poly.npz')
+    lib_path = str(tmp_path / 'test_poly.aplib')
+    aperture_files.convert_aperture_file(text_path, npy_path)
+    aperture_files.convert_aperture_file(text_path, npz_path)
+    aperture_files.write_profile_library(
+        {'H_shape': [[0.0, 1.0, 0.5], [0.0, 0.0, 1.0]], 'rect': text_path},
+        lib_path
+    )
+    # the library is a valid .npy file with all coordinates
+    assert np.load(lib_path, mmap_mode='r').shape == (2, 7)
+    assert aperture_files.read_profile_library_index(lib_path) == {
+        'H_shape': (0, 3), 'rect': (3, 7)}
+
+    # long names are neither cut nor mixed up
+    long_path = str(tmp_path / 'long_names.aplib')
+    long_names = ['LHC_TCP_' + 'X'*70 + suffix for suffix in ['A', 'B']]
+    aperture_files.write_profile_library(
+        {long_names[0]: mypolygon, long_names[1]: 2*mypolygon}, long_path)
+    assert aperture_files.read_profile_library_index(long_path) == {
+        long_names[0]: (0, 4), long_names[1]: (4, 8)}
+    assert np.array_equal(aperture_files.load_aperture_geometry(
+        long_path + '::' + long_names[1]).aperture, 2*mypolygon)
+
+    p_vec = pysixtrack.Particles()
+    p_vec.x = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    p_vec.y = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    p_vec.state = np.ones_like(p_vec.x, dtype=int)
+    p_rect = p_vec.copy()
+    rect_aper.track(p_rect)
+
+    for filename in [npy_path, npz_path, lib_path + '::rect']:
+        poly = ctk.elements.LimitPolygon.from_file(filename)
+        assert np.array_equal(poly.aperture, mypolygon)
+        p_poly = p_vec.copy()
+        poly.track(p_poly)
+        assert np.array_equal(p_poly.state, p_rect.state)
+
+
+def test_profile_library_mad_loader(tmp_path):
+    madx = pytest.importorskip("cpymad.madx")
+    from CollimationToolKit import aperture_files
+
+    lib_path = str(tmp_path / 'test_poly.aplib')
+    aperture_files.write_profile_library({'txq': mypolygon}, lib_path)
+
+    madx = madx.Madx(stdout=False)
+    madx.input('''
+        TXQ: Collimator, l=0.0, apertype='{}';
+        TXQ1: TXQ;
+        TXQ2: TXQ;
+
+        testseq: SEQUENCE, l=2.0;
+            TXQ1, at = 0.5;
+            TXQ2, at = 1.5;
+        ENDSEQUENCE;
+
+        BEAM, Particle=proton, Energy=50000.0, EXN=2.2e-6, EYN=2.2e-6;
+        USE, Sequence=testseq;
+    '''.format(lib_path))
+    ctk.patch_pysixtrack_loader()
+    testline = pysixtrack.Line.from_madx_sequence(madx.sequence.testseq,
+                                                  install_apertures=True)
+    madx.input('stop;')
+
+    apertures, names = testline.get_elements_of_type(ctk.elements.LimitPolygon)
+    assert names == ['txq1_aperture', 'txq2_aperture']
+    assert np.array_equal(apertures[0].aperture, mypolygon)
+    assert apertures[0].get_geometry() is apertures[1].get_geometry()
+
+
+#-------------------------------------------------------
+#----Test demotion to native apertures------------------
+#-------------------------------------------------------
+def test_to_native():
+    angles = np.linspace(0, 2*np.pi, 720, endpoint=False)
+    ellipse = np.array([0.03*np.cos(angles), 0.02*np.sin(angles)])
+    # ellipse cut at |x| = 0.025 and |y| = 0.015
+    t_x, t_y = np.arccos(0.025/0.03), np.arcsin(0.015/0.02)
+    cut_angles = np.sort(np.concatenate([
+        angles, [t_x, t_y, np.pi - t_y, np.pi - t_x,
+                 np.pi + t_x, np.pi + t_y, 2*np.pi - t_y, 2*np.pi - t_x]]))
+    rectellipse = np.array([0.03*np.cos(cut_angles), 0.02*np.sin(cut_angles)])
+    inside = ((np.abs(rectellipse[0]) <= 0.025 + 1e-12)
+              & (np.abs(rectellipse[1]) <= 0.015 + 1e-12))
+    rectellipse = rectellipse[:, inside]
+    # extra (collinear) vertices on the sides of the rectangle
+    rectangle = np.array([[0.03, 0.03, 0.03, -0.04, -0.04],
+                          [0.01, -0.005, -0.02, -0.02, 0.01]])
+    l_shape = np.array([[0.02, 0.02, 0.0, 0.0, -0.02, -0.02],
+                        [0.02, -0.02, -0.02, 0.0, 0.0, 0.02]])
+
+    for aperture, native_class in [
+            (rectangle, pysixtrack.elements.LimitRect),
+            (ellipse, pysixtrack.elements.LimitEllipse),
+            (rectellipse, pysixtrack.elements.LimitRectEllipse),
+            (l_shape, type(None))]:
+        polygon = ctk.elements.LimitPolygon(aperture=aperture)
+        native = polygon.to_native(tolerance=1e-6)
+        assert type(native) is native_class
+        if native is None:
+            continue
+
+        rng = np.random.RandomState(0)
+        p_poly = pysixtrack.Particles()
+        p_poly.x = rng.uniform(low=-5e-2, high=5e-2, size=10000)
+        p_poly.y = rng.uniform(low=-3e-2, high=3e-2, size=10000)
+        p_poly.state = np.ones_like(p_poly.x, dtype=int)
+        p_poly.partid = np.arange(len(p_poly.x))
+        p_native = p_poly.copy()
+        polygon.track(p_poly)
+        native.track(p_native)
+        assert np.array_equal(p_poly.partid, p_native.partid)
+
+    # nothing but a slightly too coarse ellipse
+    assert ctk.elements.LimitPolygon(aperture=ellipse[:, ::10]).to_native() is None
+    assert ctk.elements.LimitPolygon(
+        aperture=ellipse[:, ::10]).to_native(tolerance=1e-4) is not None
+
+
+#-------------------------------------------------------
+#----Test simplification--------------------------------
+#-------------------------------------------------------
+def test_simplify():
+    rng = np.random.RandomState(2)
+    # noisy, dense "measured" profile with a concave notch
+    angles = np.linspace(0, 2*np.pi, 2000, endpoint=False)
+    radius = 0.03 + rng.uniform(-2e-5, 2e-5, size=len(angles))
+    radius[(angles > 1.0) & (angles < 1.3)] -= 0.01
+    measured = np.array([radius*np.cos(angles), radius*np.sin(angles)])
+
+    for aperture in [measured, measured[:, ::-1]]:
+        polygon = ctk.elements.LimitPolygon(aperture=aperture)
+        simplified = polygon.simplify(max_deviation=1e-4)
+        n_vertices = simplified.get_geometry().n_vertices
+        assert 3 <= n_vertices < len(angles)/5
+
+        p_orig = pysixtrack.Particles()
+        p_orig.x = rng.uniform(low=-3.5e-2, high=3.5e-2, size=5000)
+        p_orig.y = rng.uniform(low=-3.5e-2, high=3.5e-2, size=5000)
+        p_orig.state = np.ones_like(p_orig.x, dtype=int)
+        p_orig.partid = np.arange(len(p_orig.x))
+        p_simple = p_orig.copy()
+        polygon.track(p_orig)
+        simplified.track(p_simple)
+        # every particle passing the simplified profile passes the original
+        assert set(p_simple.partid) <= set(p_orig.partid)
+        assert len(p_simple.partid) > 0.99*len(p_orig.partid)
+
+    # the vertices of simple profiles are kept
+    simplified = poly_aper.simplify(max_deviation=1e-3)
+    assert np.array_equal(simplified.aperture, poly_aper.aperture)
+
+
+#-------------------------------------------------------
+#----Test float32 classification------------------------
+#-------------------------------------------------------
+def test_low_precision():
+    rng = np.random.RandomState(5)
+    angles = np.sort(rng.uniform(0, 2*np.pi, size=300))
+    radius = 0.03 + rng.uniform(-5e-3, 5e-3, size=300)
+    # shifted, non-convex polygon with an almost horizontal edge
+    profile = np.array([1.0 + radius*np.cos(angles), -0.5 + radius*np.sin(angles)])
+    profile[1, 1] = profile[1, 0] + 1e-9
+    for aperture in [profile, mypolygon]:
+        vertices = np.asarray(aperture)
+        edges = np.roll(vertices, -1, axis=1) - vertices
+        # random particles and particles on and next to the boundary
+        n_rand = 20000
+        fractions = rng.uniform(size=3000)
+        idx = rng.randint(vertices.shape[1], size=3000)
+        offsets = rng.choice([0.0, 1e-15, -1e-15, 1e-9, -1e-9], size=(2, 3000))
+        on_boundary = vertices[:, idx] + fractions*edges[:, idx] + offsets
+        x = np.concatenate([rng.uniform(vertices[0].min() - 0.01,
+                                        vertices[0].max() + 0.01, size=n_rand),
+                            on_boundary[0], vertices[0]])
+        y = np.concatenate([rng.uniform(vertices[1].min() - 0.01,
+                                        vertices[1].max() + 0.01, size=n_rand),
+                            on_boundary[1], vertices[1]])
+
+        p_double = pysixtrack.Particles(x=x.copy(), y=y.copy())
+        p_double.state = np.ones_like(x, dtype=int)
+        p_double.partid = np.arange(len(x))
+        p_single = p_double.copy()
+        p_single.lost_particles = []
+        ctk.elements.LimitPolygon(aperture=aperture).track(p_double)
+        ctk.elements.LimitPolygon(aperture=aperture, low_precision=True).track(p_single)
+        assert np.array_equal(p_single.partid, p_double.partid)
+        assert np.array_equal(p_single.state, p_double.state)
+
+        inside, uncertain = ctk.elements.LimitPolygon(
+            aperture=aperture).get_geometry().contains_float32(x, y)
+        assert np.mean(uncertain[:n_rand]) < 0.01
+
+
+#-------------------------------------------------------
+#----Test apertures with several rings------------------
+#-------------------------------------------------------
+def join_rings(*rings):
+    x = [list(ring[0]) + [np.nan] for ring in rings]
+    y = [list(ring[1]) + [np.nan] for ring in rings]
+    return np.array([sum(x, [])[:-1], sum(y, [])[:-1]])
+
+
+@pytest.mark.parametrize("fill_rule", ["evenodd", "nonzero"])
+def test_rings(tmp_path, fill_rule):
+    hole = 0.25*mypolygon
+    # a second piece right of the first one
+    piece = mypolygon*[[0.1], [0.5]] + [[0.05], [0.0]]
+    holes = {"evenodd": hole, "nonzero": hole[:, ::-1]}
+    aperture = join_rings(mypolygon, holes[fill_rule], piece)
+
+    rng = np.random.RandomState(7)
+    x = rng.uniform(-0.06, 0.07, size=N_part*5)
+    y = rng.uniform(-0.03, 0.02, size=N_part*5)
+    def in_rect(ring):
+        return ((x > ring[0].min()) & (x < ring[0].max())
+                & (y > ring[1].min()) & (y < ring[1].max()))
+    expected = (in_rect(mypolygon) & ~in_rect(hole)) | in_rect(piece)
+
+    for low_precision in [False, True]:
+        poly = ctk.elements.LimitPolygon(aperture=aperture, fill_rule=fill_rule,
+                                         low_precision=low_precision)
+        assert poly.get_geometry().n_rings == 3
+        assert poly.to_native() is None
+        p_vec = pysixtrack.Particles(x=x.copy(), y=y.copy())
+        p_vec.state = np.ones_like(x, dtype=int)
+        p_vec.partid = np.arange(len(x))
+        poly.track(p_vec)
+        assert np.array_equal(p_vec.partid, np.where(expected)[0])
+
+    for ii in range(50):
+        p_scalar = pysixtrack.Particles(x=x[ii], y=y[ii])
+        p_scalar.state = 1
+        poly.track(p_scalar)
+        assert p_scalar.state == int(expected[ii])
+
+    # the same profile from a text file, rings separated by "nan nan"
+    aper_path = str(tmp_path / 'rings.aper')
+    with open(aper_path,'w') as aper_file:
+        for xx, yy in zip(*aperture):
+            aper_file.write(str(xx) + '   ' + str(yy) + '\n')
+    from_file = ctk.elements.LimitPolygon.from_file(aper_path)
+    assert np.array_equal(from_file.aperture, aperture, equal_nan=True)
+    from_file.fill_rule = fill_rule
+    p_vec = pysixtrack.Particles(x=x.copy(), y=y.copy())
+    p_vec.state = np.ones_like(x, dtype=int)
+    p_vec.partid = np.arange(len(x))
+    from_file.track(p_vec)
+    assert np.array_equal(p_vec.partid, np.where(expected)[0])
+
+    # with the wrong fill rule the hole is filled
+    if fill_rule == "nonzero":
+        poly = ctk.elements.LimitPolygon(aperture=join_rings(mypolygon, hole),
+                                         fill_rule=fill_rule)
+        assert np.all(poly.get_geometry().contains(x, y, fill_rule)[in_rect(hole)])
+
+
+#-------------------------------------------------------
+#----Test scan over aperture settings-------------------
+#-------------------------------------------------------
+@pytest.mark.parametrize("low_precision", [False, True])
+def test_scan(low_precision):
+    rng = np.random.RandomState(11)
+    x = rng.uniform(-8.5e-2, 8.5e-2, size=N_part)
+    y = rng.uniform(-8.5e-2, 8.5e-2, size=N_part)
+    dx = [0.0, 5e-3, -1e-2, 0.0]
+    dy = [0.0, -2e-3, 0.0, 1e-2]
+    tilt = [0.0, 0.1, -0.3, np.pi/2]
+    scale = [1.0, 0.8, 1.5, 1.0]
+
+    poly = ctk.elements.LimitPolygon(aperture=mypolygon, low_precision=low_precision)
+    p_vec = pysixtrack.Particles(x=x.copy(), y=y.copy())
+    p_vec.state = np.ones_like(x, dtype=int)
+    lost = poly.scan(p_vec, dx=dx, dy=dy, tilt=tilt, scale=scale)
+    assert lost.shape == (4, N_part)
+    assert len(p_vec.x) == N_part and np.all(p_vec.state == 1)
+
+    for kk in range(4):
+        rotation = np.array([[np.cos(tilt[kk]), -np.sin(tilt[kk])],
+                             [np.sin(tilt[kk]), np.cos(tilt[kk])]])
+        moved = rotation @ (scale[kk]*mypolygon) + [[dx[kk]], [dy[kk]]]
+        p_track = pysixtrack.Particles(x=x.copy(), y=y.copy())
+        p_track.state = np.ones_like(x, dtype=int)
+        p_track.partid = np.arange(N_part)
+        ctk.elements.LimitPolygon(aperture=moved).track(p_track)
+        assert np.array_equal(np.where(~lost[kk])[0], p_track.partid)
+
+    # a single setting and scalar particles
+    p_scalar = pysixtrack.Particles(x=0.0, y=0.0)
+    assert poly.scan(p_scalar, dx=[0.0, 0.05]).tolist() == [[False], [True]]
+
+
+#-------------------------------------------------------
+#----Test signed distance to the boundary---------------
+#-------------------------------------------------------
+def test_signed_distance():
+    x = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    y = np.random.uniform(low=-8.5e-2, high=8.5e-2, size=N_part)
+    # distance to the rectangle
+    dx = np.maximum(aper_min_x - x, x - aper_max_x)
+    dy = np.maximum(aper_min_y - y, y - aper_max_y)
+    outside = np.hypot(np.maximum(dx, 0), np.maximum(dy, 0))
+    expected = np.where((dx < 0) & (dy < 0), -np.maximum(dx, dy), -outside)
+    for low_precision in [False, True]:
+        poly = ctk.elements.LimitPolygon(aperture=mypolygon,
+                                         low_precision=low_precision)
+        assert np.allclose(poly.signed_distance(x, y), expected, rtol=0, atol=1e-15)
+
+    # the edges of holes count as boundary as well
+    poly = ctk.elements.LimitPolygon(aperture=join_rings(mypolygon, 0.25*mypolygon))
+    distance = poly.signed_distance([0.0, 0.015, 0.0], [0.0, 0.0, -0.008])
+    assert np.allclose(distance, [-0.0025, 0.0075, 0.003], rtol=0, atol=1e-15)
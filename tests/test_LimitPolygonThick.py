@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import pysixtrack
+import CollimationToolKit as ctk
+
+
+def square(half_width):
+    return np.array([[half_width, half_width, -half_width, -half_width],
+                     [half_width, -half_width, -half_width, half_width]])
+
+
+def make_particles(n_part):
+    rng = np.random.RandomState(4)
+    particles = pysixtrack.Particles()
+    particles.x = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.px = rng.uniform(low=-1e-2, high=1e-2, size=n_part)
+    particles.y = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.py = rng.uniform(low=-1e-2, high=1e-2, size=n_part)
+    particles.state = np.ones(n_part, dtype=int)
+    particles.partid = np.arange(n_part)
+    return particles
+
+
+#-------------------------------------------------------
+#----Test against densely sampled thin apertures--------
+#-------------------------------------------------------
+@pytest.mark.parametrize("exit_half_width", [0.02, 0.01])
+def test_thick_vs_thin_slices(exit_half_width):
+    length = 2.0
+    n_slices = 2000
+    thick = ctk.elements.LimitPolygonThick(entry_aperture=square(0.02),
+                                           exit_aperture=square(exit_half_width),
+                                           length=length)
+    p_thick = make_particles(5000)
+    p_thin = make_particles(5000)
+    thick.track(p_thick)
+
+    drift = pysixtrack.elements.Drift(length=length/n_slices)
+    for ii in range(n_slices + 1):
+        half_width = 0.02 + (exit_half_width - 0.02)*ii/n_slices
+        ctk.elements.LimitPolygon(aperture=square(half_width)).track(p_thin)
+        if ii < n_slices:
+            drift.track(p_thin)
+
+    assert np.array_equal(p_thick.partid, p_thin.partid)
+    assert np.allclose(p_thick.x, p_thin.x, rtol=0, atol=1e-12)
+    assert np.allclose(p_thick.zeta, p_thin.zeta, rtol=0, atol=1e-12)
+    assert np.all(p_thick.s == length)
+
+    lost_thick = np.concatenate([p_lost.partid for p_lost in p_thick.lost_particles])
+    s_thick = np.concatenate([p_lost.s for p_lost in p_thick.lost_particles])
+    x_thick = np.concatenate([p_lost.x for p_lost in p_thick.lost_particles])
+    lost_thin = np.concatenate([p_lost.partid for p_lost in p_thin.lost_particles])
+    s_thin = np.concatenate([np.broadcast_to(p_lost.s, len(p_lost.partid))
+                             for p_lost in p_thin.lost_particles])
+    order_thick = np.argsort(lost_thick)
+    order_thin = np.argsort(lost_thin)
+    assert np.array_equal(lost_thick[order_thick], lost_thin[order_thin])
+    # the thin slices find the first slice outside the aperture
+    assert np.all(s_thin[order_thin] - s_thick[order_thick] >= -1e-12)
+    assert np.all(s_thin[order_thin] - s_thick[order_thick] < length/n_slices + 1e-9)
+    # the lost particles are on the boundary
+    s_lost = s_thick[order_thick]
+    x_lost = x_thick[order_thick]
+    half_width = 0.02 + (exit_half_width - 0.02)*s_lost/length
+    inside_entry = s_lost == 0
+    assert np.all(np.abs(x_lost[~inside_entry]) <= half_width[~inside_entry] + 1e-8)
+
+
+def test_thick_scalar():
+    thick = ctk.elements.LimitPolygonThick(entry_aperture=square(0.02),
+                                           exit_aperture=square(0.01),
+                                           length=2.0)
+    particle = pysixtrack.Particles(x=0.0, px=0.01)
+    assert thick.track(particle) == "Particle lost"
+    # |0.01 s| = 0.02 - 0.005 s -> s = 4/3 m
+    assert particle.s == pytest.approx(4/3, abs=1e-8)
+    assert particle.x == pytest.approx(0.04/3, abs=1e-8)
+
+    particle = pysixtrack.Particles(x=0.0, px=0.001)
+    assert thick.track(particle) is None
+    assert particle.state == 1 and particle.s == 2.0 and particle.x == 0.002
+
+    with pytest.raises(ValueError):
+        ctk.elements.LimitPolygonThick(entry_aperture=square(0.02),
+                                       exit_aperture=square(0.01)[:, :3]).track(particle)
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import pytest
+import pysixtrack
+import CollimationToolKit as ctk
+from CollimationToolKit.checkpoint import save_checkpoint, load_checkpoint
+from CollimationToolKit.checkpoint import track_with_checkpoints
+from CollimationToolKit.losses import LossWriter, attach_loss_writer, read_losses
+from CollimationToolKit.losses import read_loss_histogram
+
+
+class Preemption(Exception):
+    pass
+
+
+class Preempt(object):
+    # stops the run in the given turn, after the losses of that turn
+    # were written
+    def __init__(self, turn):
+        self.turn = turn
+
+    def track(self, particles):
+        if particles.turn == self.turn:
+            raise Preemption()
+
+
+def random_kick(self, particle, idx=[]):
+    particle.px[idx] += np.random.normal(size=len(idx)) * 1e-4
+
+
+def make_random_line():
+    # the foil kicks the particles randomly, so the random state matters
+    line = pysixtrack.Line(elements=[], element_names=[])
+    polygon = [[0.03, 0.03, 0.0, -0.03, -0.03],
+               [0.02, -0.02, -0.03, -0.02, 0.02]]
+    for name, element in [
+            ("d1", pysixtrack.elements.Drift(length=1.0)),
+            ("poly", ctk.elements.LimitPolygon(aperture=np.array(polygon))),
+            ("mq", pysixtrack.elements.Multipole(knl=[0.0, 0.3])),
+            ("d2", pysixtrack.elements.Drift(length=1.0)),
+            ("foil", ctk.elements.LimitFoil(min_x=-0.01, max_x=0.01,
+                                            scatter=random_kick))]:
+        line.append_element(element, name)
+    return line
+
+
+def make_particles(n_part):
+    rng = np.random.RandomState(3)
+    particles = pysixtrack.Particles()
+    particles.x = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.px = rng.uniform(low=-1e-3, high=1e-3, size=n_part)
+    particles.y = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.state = np.ones(n_part, dtype=int)
+    particles.partid = np.arange(n_part)
+    return particles
+
+
+#-------------------------------------------------------------------------------
+#--- a resumed run gives the same result as an uninterrupted one -------------
+#-------------------------------------------------------------------------------
+def test_resume(tmp_path):
+    n_turns = 7
+    np.random.seed(1)
+    line = make_random_line()
+    with LossWriter(str(tmp_path / "reference.npy"), chunk_size=10) as writer:
+        attach_loss_writer(line, writer)
+        reference = track_with_checkpoints(line, make_particles(2000), n_turns,
+                                           str(tmp_path / "reference.npz"),
+                                           checkpoint_every=2, loss_writer=writer)
+
+    checkpoint_file = str(tmp_path / "run.npz")
+    loss_file = str(tmp_path / "run.npy")
+    np.random.seed(1)
+    line = make_random_line()
+    line.append_element(Preempt(turn=5), "preempt")
+    with pytest.raises(Preemption):
+        with LossWriter(loss_file, chunk_size=10) as writer:
+            attach_loss_writer(line, writer)
+            track_with_checkpoints(line, make_particles(2000), n_turns,
+                                   checkpoint_file, checkpoint_every=2,
+                                   loss_writer=writer)
+    particles, turn = load_checkpoint(checkpoint_file, restore_random_state=False)
+    assert turn == 4
+    # losses of the turn after the checkpoint are already on disk
+    with np.load(checkpoint_file) as checkpoint:
+        n_written = int(checkpoint["losses/n_written"])
+    assert read_loss_histogram(loss_file)["n_written"] > n_written
+
+    np.random.seed(2)   # the random state comes from the checkpoint
+    line.elements[-1] = Preempt(turn=-1)
+    with LossWriter(loss_file, chunk_size=10, append=True) as writer:
+        attach_loss_writer(line, writer)
+        resumed = track_with_checkpoints(line, make_particles(10), n_turns,
+                                         checkpoint_file, checkpoint_every=2,
+                                         loss_writer=writer)
+
+    assert np.array_equal(resumed.partid, reference.partid)
+    for name in ["x", "px", "y", "py", "state"]:
+        assert np.array_equal(getattr(resumed, name), getattr(reference, name))
+    reference_losses = read_losses(str(tmp_path / "reference.npy"))
+    losses = read_losses(loss_file)
+    for field in reference_losses:
+        assert np.array_equal(losses[field], reference_losses[field])
+    counts = read_loss_histogram(str(tmp_path / "reference.npy"))["counts"]
+    # the line of the resumed run has one element more
+    assert np.array_equal(read_loss_histogram(loss_file)["counts"],
+                          np.append(counts, 0))
+
+    # a finished run is not tracked again
+    again = track_with_checkpoints(line, make_particles(10), n_turns,
+                                   checkpoint_file)
+    assert np.array_equal(again.x, reference.x)
+
+
+def test_checkpoint_attributes(tmp_path):
+    filename = str(tmp_path / "checkpoint.npz")
+    particles = make_particles(100)
+    particles.Z = np.full(100, 92)
+    particles.A = 238
+    particles.qratio = np.linspace(1.0, 1.1, 100)
+    np.random.seed(5)
+    save_checkpoint(filename, particles, 3)
+    expected = np.random.uniform(size=10)
+
+    loaded, turn = load_checkpoint(filename)
+    assert turn == 3
+    assert np.array_equal(np.random.uniform(size=10), expected)
+    for key, value in particles.__dict__.items():
+        if key not in ["_m", "lost_particles"]:
+            assert np.array_equal(loaded.__dict__[key], value), key
+    assert np.array_equal(loaded.chi, particles.chi)
+    assert loaded.lost_particles == []
+    assert not any(name.startswith("checkpoint.npz.tmp")
+                   for name in os.listdir(str(tmp_path)))
@@ -0,0 +1,39 @@
+import subprocess
+import sys
+import CollimationToolKit as ctk
+
+
+def run_python(code):
+    return subprocess.run([sys.executable, "-c", code], check=True,
+                          capture_output=True, text=True).stdout.split()
+
+
+#-------------------------------------------------------------------------------
+#--- importing the package is cheap and has no side effects -----------------
+#-------------------------------------------------------------------------------
+def test_lazy_imports():
+    loaded = run_python(
+        "import sys, CollimationToolKit\n"
+        "print('pysixtrack' in sys.modules, 'scipy' in sys.modules)\n"
+        "from CollimationToolKit import aperture_files\n"
+        "print('pysixtrack' in sys.modules)\n"
+        "import CollimationToolKit as ctk\n"
+        "ctk.elements.LimitFoil\n"
+        "print('CollimationToolKit.ScatterFunctions.GLOBAL_charge_exchange'"
+        " in sys.modules)\n"
+    )
+    assert loaded == ["False", "False", "False", "False"]
+
+
+def test_patch_pysixtrack_loader():
+    patched = run_python(
+        "import pysixtrack, CollimationToolKit as ctk\n"
+        "print(pysixtrack.line.iter_from_madx_sequence.__module__)\n"
+        "ctk.patch_pysixtrack_loader()\n"
+        "ctk.patch_pysixtrack_loader()\n"
+        "print(pysixtrack.line.iter_from_madx_sequence.__module__)\n"
+        "print(pysixtrack.line.iter_from_madx_sequence_old.__module__)\n"
+    )
+    assert patched == ["pysixtrack.loader_mad", "CollimationToolKit.loader_mad",
+                       "pysixtrack.loader_mad"]
+    assert ctk.iter_from_madx_sequence_ctk is ctk.loader_mad.iter_from_madx_sequence_ctk
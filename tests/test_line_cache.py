@@ -0,0 +1,104 @@
+import numpy as np
+import pysixtrack
+import CollimationToolKit as ctk
+from CollimationToolKit import line_cache
+from CollimationToolKit.aperture_files import load_aperture_geometry
+from fake_sequence import FakeElement, FakeSequence, write_aper_file, square
+
+
+def make_test_line(aper_path):
+    geometry = load_aperture_geometry(aper_path)
+    line = pysixtrack.Line(elements=[], element_names=[])
+    line.append_element(pysixtrack.elements.Drift(length=1.0), "drift_0")
+    line.append_element(pysixtrack.elements.Multipole(knl=[0.0, 1e-3], ksl=[0.0]), "mq")
+    line.append_element(ctk.elements.LimitPolygon.from_geometry(geometry), "mq_aperture")
+    line.append_element(pysixtrack.elements.LimitEllipse(a=0.03, b=0.02), "mb_aperture")
+    line.append_element(ctk.elements.LimitFoil(min_x=-0.015,
+                                               scatter=ctk.elements.test_strip_ions),
+                        "foil")
+    line.append_element(ctk.elements.LimitFoil(min_x=-0.018), "foil_default")
+    line.append_element(pysixtrack.elements.Drift(length=0.5), "drift_1")
+    line.append_element(ctk.elements.LimitPolygon.from_geometry(geometry), "tcp_aperture")
+    return line
+
+
+def test_save_load_line(tmp_path):
+    aper_path = str(tmp_path / 'square.aper')
+    write_aper_file(aper_path, square)
+    line = make_test_line(aper_path)
+    filename = str(tmp_path / 'line.npz')
+    line_cache.save_line(line, filename, source_hash="abc")
+
+    assert line_cache.read_source_hash(filename) == "abc"
+    loaded = line_cache.load_line(filename, source_hash="abc")
+
+    assert loaded.element_names == line.element_names
+    for ee, ee_loaded in zip(line.elements, loaded.elements):
+        assert type(ee) is type(ee_loaded)
+    assert loaded.elements[1].knl == [0.0, 1e-3]
+    assert np.array_equal(loaded.elements[2].aperture, square)
+    assert loaded.elements[2].get_geometry() is loaded.elements[7].get_geometry()
+    assert loaded.elements[4].scatter.__func__ is ctk.elements.test_strip_ions
+    assert loaded.elements[5].scatter.__func__ is ctk.elements.default_scatter
+
+    p_orig = pysixtrack.Particles(q0=28)
+    p_orig.x = np.random.uniform(low=-3e-2, high=3e-2, size=1000)
+    p_orig.px = np.random.uniform(low=-1e-3, high=1e-3, size=1000)
+    p_orig.y = np.random.uniform(low=-3e-2, high=3e-2, size=1000)
+    p_orig.state = np.ones_like(p_orig.x, dtype=int)
+    p_orig.partid = np.arange(len(p_orig.x))
+    p_orig.Z = 92
+    p_loaded = p_orig.copy()
+    for name, ee, ee_loaded in zip(line.element_names, line.elements, loaded.elements):
+        ee.track(p_orig)
+        ee_loaded.track(p_loaded)
+    assert np.array_equal(p_orig.partid, p_loaded.partid)
+    assert np.array_equal(p_orig.x, p_loaded.x)
+    assert np.array_equal(p_orig.state, p_loaded.state)
+    assert np.array_equal(p_orig.qratio, p_loaded.qratio)
+
+    try:
+        line_cache.load_line(filename, source_hash="other")
+        assert False, "Outdated line cache not detected"
+    except ValueError:
+        pass
+
+
+def test_line_from_sequence_cached(tmp_path):
+    aper_path = str(tmp_path / 'square.aper')
+    write_aper_file(aper_path, square)
+    seq = FakeSequence([FakeElement("mq", "marker", 1.0, apertype="circle", aperture=[0.03]),
+                        FakeElement("tcp", "marker", 2.0, apertype=aper_path)], 3.0)
+    filename = str(tmp_path / 'line.npz')
+
+    line = line_cache.line_from_madx_sequence_cached(seq, filename,
+                                                     install_apertures=True)
+    source_hash = line_cache.sequence_hash(seq, install_apertures=True)
+    assert line_cache.read_source_hash(filename) == source_hash
+    cached = line_cache.line_from_madx_sequence_cached(seq, filename,
+                                                       install_apertures=True)
+    assert cached.element_names == line.element_names
+
+    # changing an aperture file invalidates the cache
+    write_aper_file(aper_path, [[0.01, 0.01, -0.01, -0.01], [0.01, -0.01, -0.01, 0.01]])
+    assert line_cache.sequence_hash(seq, install_apertures=True) != source_hash
+
+
+def test_shared_list_aperture(tmp_path):
+    aperture = [list(row) for row in square]
+    line = pysixtrack.Line(elements=[], element_names=[])
+    line.append_element(ctk.elements.LimitPolygon(aperture=aperture), "poly_0")
+    line.append_element(ctk.elements.LimitPolygon(aperture=aperture), "poly_1")
+    filename = str(tmp_path / 'line.npz')
+    line_cache.save_line(line, filename)
+    loaded = line_cache.load_line(filename)
+
+    geometry = loaded.elements[0].get_geometry()
+    assert loaded.elements[1].get_geometry() is geometry
+    assert loaded.elements[0].aperture == aperture
+    # the shared geometry cannot be changed behind the cache
+    assert not geometry.aperture.flags.writeable
+    loaded.elements[0].aperture[0][0] = 0.03
+    assert np.array_equal(geometry.aperture, square)
+    assert loaded.elements[0].get_geometry().aperture[0][0] == 0.03
+
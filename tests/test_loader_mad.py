@@ -0,0 +1,386 @@
+import os
+import numpy as np
+import pytest
+import pysixtrack
+import CollimationToolKit as ctk
+from CollimationToolKit import aperture_files
+from CollimationToolKit.loader_mad import iter_from_madx_sequence_ctk
+from fake_sequence import FakeElement, FakeSequence, write_aper_file, square
+
+
+#-------------------------------------------------------------------------------
+#--- aperture types are resolved once per distinct string --------------------
+#-------------------------------------------------------------------------------
+def test_apertype_lookups(tmp_path, monkeypatch):
+    aper_path = str(tmp_path / 'square.aper')
+    write_aper_file(aper_path, square)
+
+    elements = []
+    for ii in range(50):
+        elements.append(FakeElement("mq%d" % ii, "marker", ii*1.0,
+                                    apertype="circle", aperture=[0.03]))
+        elements.append(FakeElement("tcp%d" % ii, "marker", ii*1.0+0.5,
+                                    apertype=aper_path))
+    seq = FakeSequence(elements, 50.0)
+
+    checked_files = []
+    isfile = aperture_files.os.path.isfile
+    def counting_isfile(filename):
+        checked_files.append(filename)
+        return isfile(filename)
+    monkeypatch.setattr(aperture_files.os.path, "isfile", counting_isfile)
+
+    stats = {}
+    line = pysixtrack.Line(elements=[], element_names=[])
+    for name, element in iter_from_madx_sequence_ctk(seq, install_apertures=True,
+                                                     stats=stats):
+        line.append_element(element, name)
+
+    assert checked_files == [aper_path]
+    assert stats["n_apertypes"] == 2
+    assert stats["n_elements"] == len(line)
+    assert stats["io_time"] >= 0.0 and stats["conversion_time"] >= 0.0
+
+    ellipses, names = line.get_elements_of_type(pysixtrack.elements.LimitEllipse)
+    polygons, names = line.get_elements_of_type(ctk.elements.LimitPolygon)
+    assert len(ellipses) == 50
+    assert len(polygons) == 50
+
+    # no filesystem access at all without apertures
+    checked_files.clear()
+    list(iter_from_madx_sequence_ctk(seq))
+    assert checked_files == []
+
+
+#-------------------------------------------------------------------------------
+#--- aperture files can be preloaded in parallel ---------------------------
+#-------------------------------------------------------------------------------
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_preload_apertures(tmp_path, executor):
+    elements = []
+    for ii in range(20):
+        aper_path = str(tmp_path / ('profile%d.aper' % (ii % 5)))
+        write_aper_file(aper_path, np.array(square) * (1 + ii % 5))
+        elements.append(FakeElement("tcp%d" % ii, "marker", ii*1.0,
+                                    apertype=aper_path))
+    seq = FakeSequence(elements, 20.0)
+    aperture_files.clear_aperture_file_cache()
+
+    sequential = list(iter_from_madx_sequence_ctk(seq, install_apertures=True))
+    aperture_files.clear_aperture_file_cache()
+    preloaded = list(iter_from_madx_sequence_ctk(seq, install_apertures=True,
+                                                 preload_workers=4,
+                                                 preload_executor=executor))
+
+    assert [name for name, ee in sequential] == [name for name, ee in preloaded]
+    polygons = [ee for name, ee in preloaded
+                if isinstance(ee, ctk.elements.LimitPolygon)]
+    assert len(polygons) == 20
+    for ii, polygon in enumerate(polygons):
+        assert np.array_equal(polygon.aperture, np.array(square) * (1 + ii % 5))
+        assert polygon.get_geometry() is polygons[ii % 5].get_geometry()
+
+
+#-------------------------------------------------------------------------------
+#--- MadPoints must agree with MadPoint -------------------------------------
+#-------------------------------------------------------------------------------
+def test_madpoints():
+    from types import SimpleNamespace
+    from CollimationToolKit.loader_mad import MadPoint, MadPoints
+
+    n_rows = 30
+    names = np.array(["p%d" % ii for ii in range(n_rows)])
+    rng = np.random.RandomState(1)
+    twiss = SimpleNamespace(name=names,
+                            **{kk: rng.normal(size=n_rows)*1e-3
+                               for kk in ["x", "y", "px", "py"]})
+    survey = SimpleNamespace(name=names,
+                             **{kk: rng.normal(size=n_rows)
+                                for kk in ["x", "y", "z", "theta", "phi", "psi"]})
+    mad = SimpleNamespace(table=SimpleNamespace(twiss=twiss, survey=survey))
+
+    selected = ["p3", "p17", "p0", "p29"]
+    other = ["p4", "p5", "p6", "p7"]
+    for use_twiss, use_survey in [(True, True), (True, False), (False, True)]:
+        points = MadPoints(selected, mad, use_twiss=use_twiss, use_survey=use_survey)
+        other_points = MadPoints(other, mad, use_twiss=use_twiss, use_survey=use_survey)
+        dist = points.dist(other_points)
+        dx, dy = points.distxy(other_points)
+        for ii, (name, other_name) in enumerate(zip(selected, other)):
+            point = MadPoint(name, mad, use_twiss=use_twiss, use_survey=use_survey)
+            other_point = MadPoint(other_name, mad, use_twiss=use_twiss,
+                                   use_survey=use_survey)
+            assert np.allclose(points[ii].p, point.p, rtol=1e-14, atol=1e-14)
+            assert np.allclose(points.ex[ii], point.ex, rtol=1e-14, atol=1e-14)
+            assert np.allclose(points.ez[ii], point.ez, rtol=1e-14, atol=1e-14)
+            assert np.isclose(dist[ii], point.dist(other_point), rtol=1e-14)
+            assert np.allclose([dx[ii], dy[ii]], point.distxy(other_point),
+                               rtol=1e-12, atol=1e-15)
+
+
+#-------------------------------------------------------------------------------
+#--- merging drifts must not change the tracking ----------------------------
+#-------------------------------------------------------------------------------
+def make_fodo_like_sequence():
+    elements = []
+    for ii in range(10):
+        elements.append(FakeElement("m%d" % ii, "marker", ii*2.0))
+        elements.append(FakeElement("bpm%d" % ii, "monitor", ii*2.0 + 0.5,
+                                    apertype="rectangle", aperture=[0.02, 0.015]))
+        elements.append(FakeElement("mq%d" % ii, "multipole", ii*2.0 + 1.0,
+                                    knl=[0.0, (-1)**ii * 0.05], ksl=[0.0], lrad=0.0,
+                                    apertype="circle", aperture=[0.025]))
+        elements.append(FakeElement("tcp%d" % ii, "collimator", ii*2.0 + 1.5,
+                                    l=0.2))
+    return FakeSequence(elements, 21.0)
+
+
+def test_merge_drifts():
+    seq = make_fodo_like_sequence()
+    line = pysixtrack.Line(elements=[], element_names=[])
+    for name, element in iter_from_madx_sequence_ctk(seq, install_apertures=True):
+        line.append_element(element, name)
+    name_map = {}
+    merged_line = pysixtrack.Line(elements=[], element_names=[])
+    for name, element in iter_from_madx_sequence_ctk(seq, install_apertures=True,
+                                                     merge_drifts=True,
+                                                     name_map=name_map):
+        merged_line.append_element(element, name)
+
+    drift = pysixtrack.elements.Drift
+    assert len(merged_line) < len(line)
+    assert merged_line.get_length() == pytest.approx(line.get_length())
+    for ee, ee_next in zip(merged_line.elements[:-1], merged_line.elements[1:]):
+        assert not (isinstance(ee, drift) and isinstance(ee_next, drift))
+    for ee, name in zip(merged_line.elements, merged_line.element_names):
+        if isinstance(ee, drift) and ee.length == 0:
+            assert name + "_aperture" in merged_line.element_names
+    # apertures stay attached to their elements
+    assert "bpm3_aperture" in merged_line.element_names
+    idx = merged_line.element_names.index("bpm3_aperture")
+    assert merged_line.element_names[idx-1] == "bpm3"
+    # every original name can be found
+    all_names = set(merged_line.element_names)
+    for names in name_map.values():
+        all_names.update(names)
+    assert set(line.element_names) <= all_names
+
+    p_orig = pysixtrack.Particles()
+    p_orig.x = np.random.uniform(low=-2e-2, high=2e-2, size=1000)
+    p_orig.px = np.random.uniform(low=-2e-3, high=2e-3, size=1000)
+    p_orig.y = np.random.uniform(low=-2e-2, high=2e-2, size=1000)
+    p_orig.state = np.ones_like(p_orig.x, dtype=int)
+    p_orig.partid = np.arange(len(p_orig.x))
+    p_merged = p_orig.copy()
+    line.track(p_orig)
+    merged_line.track(p_merged)
+    assert np.array_equal(p_orig.partid, p_merged.partid)
+    assert np.allclose(p_orig.x, p_merged.x, rtol=0, atol=1e-15)
+    assert np.allclose(p_orig.zeta, p_merged.zeta, rtol=0, atol=1e-15)
+
+
+#-------------------------------------------------------------------------------
+#--- thinning of repeated apertures must not change the losses -------------
+#-------------------------------------------------------------------------------
+def make_beam_pipe_sequence(apertype, aperture):
+    elements = []
+    for ii in range(20):
+        elements.append(FakeElement("pipe%d" % ii, "marker", ii*1.0,
+                                    apertype=apertype, aperture=aperture))
+        if ii == 10:
+            # a kick breaks the straight line
+            elements.append(FakeElement("kick", "multipole", ii*1.0 + 0.5,
+                                        knl=[1e-3], ksl=[0.0], lrad=0.0))
+    return FakeSequence(elements, 20.0)
+
+
+def track_line(elements, p_orig):
+    line = pysixtrack.Line(elements=[], element_names=[])
+    for name, element in elements:
+        line.append_element(element, name)
+    particles = p_orig.copy()
+    line.track(particles)
+    return line, particles
+
+
+def test_thin_apertures(tmp_path):
+    p_orig = pysixtrack.Particles()
+    p_orig.x = np.random.uniform(low=-3e-2, high=3e-2, size=2000)
+    p_orig.px = np.random.uniform(low=-2e-3, high=2e-3, size=2000)
+    p_orig.y = np.random.uniform(low=-3e-2, high=3e-2, size=2000)
+    p_orig.py = np.random.uniform(low=-2e-3, high=2e-3, size=2000)
+    p_orig.state = np.ones_like(p_orig.x, dtype=int)
+    p_orig.partid = np.arange(len(p_orig.x))
+
+    l_shape = [[0.02, 0.02, 0.0, 0.0, -0.02, -0.02],
+               [0.02, -0.02, -0.02, 0.0, 0.0, 0.02]]
+    aper_path = str(tmp_path / 'l_shape.aper')
+    write_aper_file(aper_path, l_shape)
+
+    for apertype, aperture, n_expected in [("rectangle", [0.02, 0.015], 4),
+                                           ("circle", [0.025], 4),
+                                           (aper_path, [0.0], 20)]:
+        seq = make_beam_pipe_sequence(apertype, aperture)
+        line, particles = track_line(
+            iter_from_madx_sequence_ctk(seq, install_apertures=True), p_orig)
+        name_map = {}
+        thinned_line, thinned_particles = track_line(
+            iter_from_madx_sequence_ctk(seq, install_apertures=True,
+                                        thin_apertures=True,
+                                        name_map=name_map), p_orig)
+
+        n_apertures = sum(name.endswith("_aperture")
+                          for name in thinned_line.element_names)
+        assert n_apertures == n_expected
+        assert np.array_equal(particles.partid, thinned_particles.partid)
+        assert np.array_equal(particles.x, thinned_particles.x)
+        assert thinned_line.get_length() == pytest.approx(line.get_length())
+        removed = [name for names in name_map.values() for name in names]
+        assert len(removed) - len(name_map) == 20 - n_expected
+
+    # with a resolution, checks are kept at least every 3 m
+    seq = make_beam_pipe_sequence("circle", [0.025])
+    line, particles = track_line(
+        iter_from_madx_sequence_ctk(seq, install_apertures=True), p_orig)
+    thinned_line, thinned_particles = track_line(
+        iter_from_madx_sequence_ctk(seq, install_apertures=True,
+                                    thin_apertures=True,
+                                    aperture_s_resolution=3.0), p_orig)
+    s_apertures = [s for s, name in zip(thinned_line.get_s_elements(),
+                                        thinned_line.element_names)
+                   if name.endswith("_aperture")]
+    assert np.max(np.diff(s_apertures)) <= 3.0
+    assert np.array_equal(particles.partid, thinned_particles.partid)
+
+
+#-------------------------------------------------------------------------------
+#--- simple polygon profiles are installed as native apertures --------------
+#-------------------------------------------------------------------------------
+def test_demote_polygons(tmp_path):
+    rect_path = str(tmp_path / 'rect.aper')
+    write_aper_file(rect_path, square)
+    l_path = str(tmp_path / 'l_shape.aper')
+    write_aper_file(l_path, [[0.02, 0.02, 0.0, 0.0, -0.02, -0.02],
+                             [0.02, -0.02, -0.02, 0.0, 0.0, 0.02]])
+    elements = [FakeElement("tcp%d" % ii, "marker", ii*1.0,
+                            apertype=[rect_path, l_path][ii % 2])
+                for ii in range(6)]
+    seq = FakeSequence(elements, 6.0)
+
+    stats = {}
+    apertures = [ee for name, ee in iter_from_madx_sequence_ctk(
+                     seq, install_apertures=True, demote_polygons=True,
+                     stats=stats)
+                 if name.endswith("_aperture")]
+    assert [type(ee) for ee in apertures] == [pysixtrack.elements.LimitRect,
+                                              ctk.elements.LimitPolygon]*3
+    assert stats["demoted_apertures"] == ["tcp0_aperture", "tcp2_aperture",
+                                          "tcp4_aperture"]
+    assert apertures[0].max_x == 0.02 and apertures[0].min_y == -0.02
+    assert apertures[0] is not apertures[2]
+
+
+def test_simplify_polygons(tmp_path):
+    angles = np.linspace(0, 2*np.pi, 1000, endpoint=False)
+    aper_path = str(tmp_path / 'round.aper')
+    write_aper_file(aper_path, [0.03*np.cos(angles), 0.02*np.sin(angles)])
+    elements = [FakeElement("tcp%d" % ii, "marker", ii*1.0, apertype=aper_path)
+                for ii in range(3)]
+    seq = FakeSequence(elements, 3.0)
+
+    stats = {}
+    polygons = [ee for name, ee in iter_from_madx_sequence_ctk(
+                    seq, install_apertures=True, simplify_deviation=1e-5,
+                    stats=stats)
+                if name.endswith("_aperture")]
+    (n_before, n_after), = stats["simplified_profiles"].values()
+    assert n_before == 1000 and n_after < n_before
+    assert all(polygon.get_geometry() is polygons[0].get_geometry()
+               for polygon in polygons)
+    assert polygons[0].get_geometry().n_vertices == n_after
+
+
+#-------------------------------------------------------------------------------
+#--- batched cross-check against MAD-X tracking -----------------------------
+#-------------------------------------------------------------------------------
+def test_mad_benchmark_batch(tmp_path, monkeypatch):
+    pytest.importorskip("cpymad.madx")
+    from CollimationToolKit.loader_mad import mad_benchmark_batch
+
+    monkeypatch.chdir(tmp_path)
+
+    rng = np.random.RandomState(2)
+    elements = []
+    for strength in [-0.05, 0.02, 0.08]:
+        elements.append(("multipole", dict(knl=[0.0, strength, 5*strength],
+                                           ksl=[strength/2])))
+        elements.append(("drift", dict(l=20*abs(strength))))
+        elements.append(("kicker", dict(hkick=strength*1e-2, vkick=-strength*1e-2)))
+    n_part = 50
+    result = mad_benchmark_batch(elements, x=rng.normal(0, 1e-3, n_part),
+                                 px=rng.normal(0, 1e-4, n_part),
+                                 y=rng.normal(0, 1e-3, n_part),
+                                 py=rng.normal(0, 1e-4, n_part),
+                                 pt=rng.normal(0, 1e-3, n_part))
+
+    assert result.deviations.shape == (len(elements), 6)
+    deviations = result.max_deviation_per_type()
+    assert list(deviations) == ["multipole", "drift", "kicker"]
+    for mtype, deviation in deviations.items():
+        assert max(deviation.values()) < 1e-12, mtype
+    assert "multipole" in result.report()
+    # all particles made it through MAD-X, i.e. all were compared
+    assert len(set(result.mad.table.trackone.number)) == n_part
+    # the track output of MAD-X does not end up in the working directory
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_mad_benchmark_batch_apertures(tmp_path, monkeypatch):
+    pytest.importorskip("cpymad.madx")
+    from CollimationToolKit.loader_mad import mad_benchmark_batch
+
+    monkeypatch.chdir(tmp_path)
+
+    rng = np.random.RandomState(3)
+    elements = [("multipole", dict(knl=[0.0, 0.05], apertype="circle",
+                                   aperture=[1e-3])),
+                ("kicker", dict(hkick=1e-4, vkick=-1e-4))]
+    n_part = 50
+    result = mad_benchmark_batch(elements, loader_options=dict(install_apertures=True),
+                                 x=rng.normal(0, 1e-3, n_part),
+                                 px=rng.normal(0, 1e-4, n_part))
+
+    assert "ctk_bench_e0_aperture" in result.line.element_names
+    # some particles are lost at the aperture, the others are still compared
+    aperture = result.line.elements[
+        result.line.element_names.index("ctk_bench_e0_aperture")]
+    p_test = pysixtrack.Particles(x=rng.normal(0, 1e-3, n_part))
+    p_test.state = np.ones(n_part, dtype=int)
+    aperture.track(p_test)
+    assert 0 < len(p_test.x) < n_part
+    assert np.all(np.isfinite(result.deviations))
+    assert np.max(result.deviations) < 1e-12
+
+
+def test_mad_benchmark_batch_merge_drifts(tmp_path, monkeypatch):
+    pytest.importorskip("cpymad.madx")
+    from CollimationToolKit.loader_mad import mad_benchmark_batch
+
+    monkeypatch.chdir(tmp_path)
+
+    rng = np.random.RandomState(4)
+    elements = [("drift", dict(l=1.0)), ("drift", dict(l=0.5)),
+                ("kicker", dict(hkick=1e-4))]
+    n_part = 20
+    name_map = {}
+    result = mad_benchmark_batch(elements,
+                                 loader_options=dict(merge_drifts=True,
+                                                     name_map=name_map),
+                                 x=rng.normal(0, 1e-3, n_part),
+                                 px=rng.normal(0, 1e-4, n_part))
+
+    # the markers between the elements are kept, so every element is compared
+    for ii in range(len(elements) + 1):
+        assert "ctk_bench_m%d" % ii in result.line.element_names
+    assert np.all(np.isfinite(result.deviations))
+    assert np.max(result.deviations) < 1e-12
@@ -0,0 +1,135 @@
+import pickle
+import numpy as np
+import pytest
+import pysixtrack
+import CollimationToolKit as ctk
+from CollimationToolKit.losses import LossWriter, attach_loss_writer
+from CollimationToolKit.losses import read_losses, read_loss_histogram
+from CollimationToolKit.tracking import track_parallel
+
+
+def make_line():
+    # CTK apertures at 1 (polygon) and 4 (foil), a native one at the end
+    line = pysixtrack.Line(elements=[], element_names=[])
+    polygon = [[0.03, 0.03, 0.0, -0.03, -0.03],
+               [0.02, -0.02, -0.03, -0.02, 0.02]]
+    for name, element in [
+            ("d1", pysixtrack.elements.Drift(length=1.0)),
+            ("poly", ctk.elements.LimitPolygon(aperture=np.array(polygon))),
+            ("mq", pysixtrack.elements.Multipole(knl=[0.0, 0.3])),
+            ("d2", pysixtrack.elements.Drift(length=1.0)),
+            ("foil", ctk.elements.LimitFoil(min_x=-0.025, max_x=0.025,
+                                            min_y=-1.0, max_y=1.0)),
+            ("rect", pysixtrack.elements.LimitRect(min_x=-0.03, max_x=0.03,
+                                                   min_y=-0.02, max_y=0.02))]:
+        line.append_element(element, name)
+    return line
+
+
+def make_particles(n_part):
+    rng = np.random.RandomState(5)
+    particles = pysixtrack.Particles()
+    particles.x = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.px = rng.uniform(low=-1e-3, high=1e-3, size=n_part)
+    particles.y = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.state = np.ones(n_part, dtype=int)
+    particles.partid = np.arange(n_part)
+    return particles
+
+
+#-------------------------------------------------------------------------------
+#--- losses are streamed to disk while tracking ------------------------------
+#-------------------------------------------------------------------------------
+def test_loss_writer(tmp_path):
+    filename = str(tmp_path / "losses.npy")
+    line = make_line()
+    particles = make_particles(3000)
+    reference = particles.copy()
+
+    with LossWriter(filename, chunk_size=100) as writer:
+        attach_loss_writer(line, writer)
+        for turn in range(3):
+            particles.turn = turn
+            line.track(particles)
+            histogram = read_loss_histogram(filename)
+            # the histogram on disk is at most one chunk behind
+            assert 0 <= writer.counts.sum() - histogram["counts"].sum() < 100
+        attach_loss_writer(line, None)
+    assert line.elements[1].loss_writer is None
+
+    losses = read_losses(filename)
+    result = track_parallel(line, reference, n_turns=3, n_processes=1)
+    at_ctk_elements = np.isin(result.losses["element"], [1, 4])
+    assert len(losses["partid"]) == np.sum(at_ctk_elements)
+    order = np.lexsort((losses["partid"], losses["element"], losses["turn"]))
+    for field in ["partid", "turn", "element", "x", "y"]:
+        assert np.array_equal(losses[field][order],
+                              result.losses[field][at_ctk_elements])
+    histogram = read_loss_histogram(filename)
+    assert histogram["n_written"] == len(losses["partid"])
+    assert np.array_equal(histogram["counts"], np.bincount(losses["element"],
+                                                           minlength=len(line)))
+    assert np.array_equal(histogram["s"], line.get_s_elements())
+    assert list(histogram["names"]) == line.element_names
+
+    # losses of parallel tracking, appended to the same file, an incomplete
+    # chunk at the end is dropped
+    with open(filename, 'ab') as loss_file:
+        loss_file.write(b'\x93NUMPY garbage')
+    with LossWriter(filename, append=True) as writer:
+        writer.push_records(result.losses)
+    appended = read_losses(filename)
+    n_before = len(losses["partid"])
+    assert len(appended["partid"]) == n_before + result.n_lost
+    assert np.array_equal(appended["x"][n_before:], result.losses["x"])
+    assert read_loss_histogram(filename)["counts"].sum() == n_before + result.n_lost
+
+
+def test_loss_writer_memory(tmp_path):
+    # only CTK apertures, all losses go to the writer
+    filename = str(tmp_path / "losses.npy")
+    line = pysixtrack.Line(elements=[], element_names=[])
+    line.append_element(pysixtrack.elements.Drift(length=1.0), "d1")
+    line.append_element(ctk.elements.LimitPolygon(
+        aperture=[[0.02, 0.02, -0.02, -0.02], [0.02, -0.02, -0.02, 0.02]]), "poly")
+    line.append_element(ctk.elements.LimitFoil(min_x=-0.01, max_x=0.01), "foil")
+    particles = make_particles(2000)
+    with LossWriter(filename, chunk_size=100) as writer:
+        attach_loss_writer(line, writer)
+        line.track(particles)
+    # the lost particles are written, not kept in memory
+    assert particles.lost_particles == []
+    assert len(read_losses(filename)["partid"]) == 2000 - len(particles.x) > 0
+
+
+def test_loss_writer_not_shared(tmp_path):
+    filename = str(tmp_path / "losses.npy")
+    line = make_line()
+    particles = make_particles(1000)
+    with LossWriter(filename) as writer:
+        attach_loss_writer(line, writer)
+        # the workers would each write a copy of the buffer into the file
+        with pytest.raises(ValueError):
+            track_parallel(line, particles, n_processes=2)
+        for index in [1, 4]:
+            element = pickle.loads(pickle.dumps(line.elements[index]))
+            assert element.loss_writer is None
+            assert line.elements[index].loss_writer is writer
+        attach_loss_writer(line, None)
+        result = track_parallel(line, particles, n_processes=2)
+        writer.push_records(result.losses)
+    assert len(read_losses(filename)["partid"]) == result.n_lost > 0
+
+
+def test_loss_writer_scalar(tmp_path):
+    filename = str(tmp_path / "losses.npy")
+    polygon = ctk.elements.LimitPolygon()
+    line = pysixtrack.Line(elements=[polygon], element_names=["poly"])
+    with LossWriter(filename) as writer:
+        attach_loss_writer(line, writer)
+        for x in [0.5, 2.0, -3.0]:
+            particle = pysixtrack.Particles(x=x)
+            polygon.track(particle)
+    losses = read_losses(filename)
+    assert list(losses["x"]) == [2.0, -3.0]
+    assert list(losses["element"]) == [0, 0]
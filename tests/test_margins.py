@@ -0,0 +1,98 @@
+import numpy as np
+import pysixtrack
+import CollimationToolKit as ctk
+from CollimationToolKit.margins import track_with_margins, inscribed_radius
+
+
+def make_aperture_line(n_cells, drift_length):
+    # a straight line with the same (shared) polygon after every drift and
+    # a narrower collimator profile in every 10th cell
+    angle = -np.linspace(0, 2*np.pi, 40, endpoint=False)
+    screen = ctk.polygon.PolygonGeometry(np.array([0.03*np.cos(angle),
+                                                   0.02*np.sin(angle)]))
+    collimator = np.array([[0.01, 0.01, -0.012, -0.012],
+                           [0.03, -0.03, -0.03, 0.03]])
+    line = pysixtrack.Line(elements=[], element_names=[])
+    for ii in range(n_cells):
+        line.append_element(pysixtrack.elements.Drift(length=drift_length),
+                            "drift_%d" % ii)
+        if ii % 10 == 9:
+            line.append_element(ctk.elements.LimitPolygon(aperture=collimator),
+                                "tcp_%d" % ii)
+        else:
+            line.append_element(ctk.elements.LimitPolygon.from_geometry(screen),
+                                "screen_%d" % ii)
+    return line
+
+
+def make_particles(n_part):
+    rng = np.random.RandomState(4)
+    particles = pysixtrack.Particles()
+    particles.x = rng.normal(0, 5e-3, n_part)
+    particles.px = rng.normal(0, 2e-4, n_part)
+    particles.y = rng.normal(0, 5e-3, n_part)
+    particles.py = rng.normal(0, 2e-4, n_part)
+    particles.state = np.ones(n_part, dtype=int)
+    particles.partid = np.arange(n_part)
+    return particles
+
+
+#-------------------------------------------------------------------------------
+#--- skipping checks by the aperture margin does not change the result ------
+#-------------------------------------------------------------------------------
+def test_track_with_margins():
+    drift_length = 1.0
+    line = make_aperture_line(60, drift_length)
+    reference = make_particles(3000)
+    particles = reference.copy()
+    particles.lost_particles = []
+    line.track(reference)
+
+    max_excursion = drift_length*np.max(np.hypot(particles.px, particles.py))
+    stats = track_with_margins(line, particles, max_excursion*(1 + 1e-9))
+    assert stats["skipped"] > stats["checked"]
+    assert np.array_equal(particles.partid, reference.partid)
+    assert np.array_equal(particles.x, reference.x)
+    lost = np.concatenate([pp.partid for pp in particles.lost_particles])
+    lost_reference = np.concatenate([pp.partid for pp in reference.lost_particles])
+    assert np.array_equal(np.sort(lost), np.sort(lost_reference))
+    assert not hasattr(particles, "_margin_distance")
+    assert "_dict_vars" not in particles.__dict__
+
+
+def test_margin_precision():
+    # a wide rectangle, the particles are inside but outside of its
+    # inscribed radius
+    geometry = ctk.polygon.PolygonGeometry(np.array([[0.03, 0.03, -0.03, -0.03],
+                                                     [0.01, -0.01, -0.01, 0.01]]))
+    def make_line(low_precision):
+        line = pysixtrack.Line(elements=[], element_names=[])
+        for name, precision in [("first", False), ("second", low_precision)]:
+            polygon = ctk.elements.LimitPolygon.from_geometry(geometry)
+            polygon.low_precision = precision
+            line.append_element(polygon, name)
+        return line
+    rng = np.random.RandomState(6)
+    particles = pysixtrack.Particles()
+    particles.x = rng.uniform(low=0.019, high=0.021, size=100)
+    particles.y = rng.uniform(low=-1e-3, high=1e-3, size=100)
+    particles.state = np.ones(100, dtype=int)
+    particles.partid = np.arange(100)
+    # right at the edge, within rounding errors
+    particles.x[:10] = np.nextafter(0.03, 0.0)
+
+    stats = track_with_margins(make_line(False), particles.copy(), 0.0)
+    assert stats == {"checked": 110, "skipped": 90}
+    # a margin computed for the float64 check does not hold in float32
+    stats = track_with_margins(make_line(True), particles.copy(), 0.0)
+    assert stats == {"checked": 200, "skipped": 0}
+
+
+def test_inscribed_radius():
+    line = make_aperture_line(10, 1.0)
+    # the vertices are on an ellipse with the half axes 0.03 and 0.02
+    assert 0.0199 < inscribed_radius(line.elements[1]) < 0.02
+    assert np.isclose(inscribed_radius(line.elements[-1]), 0.01)
+    shifted = ctk.elements.LimitPolygon(aperture=[[0.01, 0.01, 0.02, 0.02],
+                                                  [0.01, -0.01, -0.01, 0.01]])
+    assert inscribed_radius(shifted) == 0.0
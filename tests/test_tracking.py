@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+import pysixtrack
+import CollimationToolKit as ctk
+from CollimationToolKit.tracking import track_parallel
+
+
+def make_line():
+    line = pysixtrack.Line(elements=[], element_names=[])
+    polygon = [[0.03, 0.03, 0.0, -0.03, -0.03],
+               [0.02, -0.02, -0.03, -0.02, 0.02]]
+    for name, element in [
+            ("d1", pysixtrack.elements.Drift(length=1.0)),
+            ("poly", ctk.elements.LimitPolygon(aperture=np.array(polygon))),
+            ("mq", pysixtrack.elements.Multipole(knl=[0.0, 0.3])),
+            ("d2", pysixtrack.elements.Drift(length=1.0)),
+            ("foil", ctk.elements.LimitFoil(min_x=-0.025, max_x=0.025,
+                                            min_y=-1.0, max_y=1.0)),
+            ("rect", pysixtrack.elements.LimitRect(min_x=-0.03, max_x=0.03,
+                                                   min_y=-0.02, max_y=0.02))]:
+        line.append_element(element, name)
+    return line
+
+
+def make_particles(n_part):
+    rng = np.random.RandomState(3)
+    particles = pysixtrack.Particles()
+    particles.x = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.px = rng.uniform(low=-1e-3, high=1e-3, size=n_part)
+    particles.y = rng.uniform(low=-3e-2, high=3e-2, size=n_part)
+    particles.state = np.ones(n_part, dtype=int)
+    particles.partid = np.arange(n_part) + 1000
+    return particles
+
+
+#-------------------------------------------------------------------------------
+#--- sharded tracking gives the same result as tracking in one piece --------
+#-------------------------------------------------------------------------------
+@pytest.mark.parametrize("n_processes", [1, 2])
+def test_track_parallel(n_processes):
+    line = make_line()
+    particles = make_particles(3000)
+    n_turns = 3
+
+    reference = particles.copy()
+    lost_per_element = np.zeros(len(line), dtype=int)
+    lost_partid = []
+    for turn in range(n_turns):
+        for ii, element in enumerate(line.elements):
+            n_before = len(reference.state)
+            element.track(reference)
+            lost_per_element[ii] += n_before - len(reference.state)
+    for lost in reference.lost_particles:
+        lost_partid.extend(lost.partid)
+
+    result = track_parallel(line, particles, n_turns=n_turns,
+                            n_processes=n_processes, n_shards=5, seed=1)
+
+    assert np.array_equal(result.particles.partid, reference.partid)
+    assert np.array_equal(result.particles.x, reference.x)
+    assert np.array_equal(result.particles.px, reference.px)
+    assert np.array_equal(result.lost_per_element, lost_per_element)
+    assert result.n_lost + len(reference.x) == 3000
+    assert sorted(result.losses["partid"]) == sorted(lost_partid)
+    assert np.array_equal(result.losses["partid"] - 1000, result.losses["index"])
+    assert np.all(np.diff(result.losses["turn"]) >= 0)
+    # the input is not changed
+    assert len(particles.x) == 3000
+    assert result.element_names == line.element_names
+
+
+def random_kick(self, particle, idx=[]):
+    particle.px[idx] += np.random.normal(size=len(idx)) * 1e-4
+
+
+def test_track_parallel_random_scatter():
+    line = make_line()
+    line.elements[4] = ctk.elements.LimitFoil(min_x=-0.01, max_x=0.01,
+                                              scatter=random_kick)
+    particles = make_particles(2000)
+    results = [track_parallel(line, particles, n_turns=2, n_processes=n_processes,
+                              n_shards=4, seed=7)
+               for n_processes in [1, 2]]
+    assert np.array_equal(results[0].particles.px, results[1].particles.px)
+    assert not np.array_equal(results[0].particles.px,
+                              particles.px[results[0].particles.partid - 1000])
+    other_seed = track_parallel(line, particles, n_turns=2, n_processes=1,
+                                n_shards=4, seed=8)
+    assert not np.array_equal(results[0].particles.px, other_seed.particles.px)